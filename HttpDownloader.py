@@ -0,0 +1,202 @@
+import httpx
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Callable
+from PikPakApiLimiter import TokenBucket
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_CHUNK_SIZE = 4 << 20
+# 每攒够这么多数据写一次磁盘
+WRITE_BUFFER_SIZE = 1 << 20
+# 这些状态码说明下载链接已经失效，需要重新获取
+DEAD_LINK_STATUS_CODES = {401, 403, 404, 410}
+
+class HttpDownloadError(Exception):
+    def __init__(self, status_code : int, message : str):
+        super().__init__(f"http download failed with status {status_code}: {message}")
+        self.status_code : int = status_code
+
+    @property
+    def DeadLink(self) -> bool:
+        return self.status_code in DEAD_LINK_STATUS_CODES
+
+class ChunkBitmap:
+    # 记录哪些分块已经写入磁盘，保存在"<文件>.chunks"里用于断点续传
+    def __init__(self, path : str, size : int, chunk_size : int, identity : str = None):
+        self.path : str = path
+        self.size : int = size
+        self.chunk_size : int = chunk_size
+        self.identity : str = identity
+        self.count : int = max(1, (size + chunk_size - 1) // chunk_size)
+        self._bits : bytearray = bytearray((self.count + 7) // 8)
+
+    @classmethod
+    def Load(cls, path : str, size : int, chunk_size : int, identity : str = None) -> "ChunkBitmap":
+        bitmap = cls(path, size, chunk_size, identity)
+        if not os.path.exists(path):
+            return bitmap
+        try:
+            with open(path, "r", encoding = "utf-8") as file:
+                data = json.load(file)
+            # 文件、文件大小或分块大小变了，之前的进度作废
+            if data["size"] == size and data["chunk_size"] == chunk_size and data.get("identity") == identity:
+                bitmap._bits = bytearray.fromhex(data["bits"])
+        except Exception as e:
+            logging.warning(f"ignoring broken chunk bitmap {path}: {e}")
+        return bitmap
+
+    def IsDone(self, index : int) -> bool:
+        return bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+    def MarkDone(self, index : int) -> None:
+        self._bits[index >> 3] |= 1 << (index & 7)
+
+    def Missing(self) -> list[int]:
+        return [index for index in range(self.count) if not self.IsDone(index)]
+
+    def DoneBytes(self) -> int:
+        return sum(min(self.chunk_size, self.size - index * self.chunk_size) for index in range(self.count) if self.IsDone(index))
+
+    def Save(self) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding = "utf-8") as file:
+            json.dump({"size": self.size, "chunk_size": self.chunk_size, "identity": self.identity, "bits": self._bits.hex()}, file)
+        os.replace(temp_path, self.path)
+
+    def Remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def _write_at(file, offset : int, data : bytes) -> None:
+    file.seek(offset)
+    file.write(data)
+
+def _preallocate(path : str, size : int) -> None:
+    # truncate扩展出的部分在大多数文件系统上是稀疏的，不会真正占用磁盘
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    with open(path, mode) as file:
+        if os.path.getsize(path) != size:
+            file.truncate(size)
+
+class HttpDownloader:
+    # 内置的多连接分块下载器：多个Range请求并发写入预先分配的文件，进度保存在分块位图里
+    def __init__(self, base_path : str, connections : int = DEFAULT_CONNECTIONS, chunk_size : int = DEFAULT_CHUNK_SIZE,
+                 proxy_address : str = None, timeout : float = 30, max_connections : int = 32):
+        self.base_path : str = base_path
+        self.connections : int = connections
+        self.chunk_size : int = chunk_size
+        # 累计下载的字节数，用于统计吞吐量
+        self.downloaded_bytes : int = 0
+        # 所有下载共享的限速，0表示不限速
+        self._rate_limiter : TokenBucket = TokenBucket(0, 0)
+        self._client : httpx.AsyncClient = httpx.AsyncClient(
+            proxy = proxy_address,
+            follow_redirects = True,
+            timeout = httpx.Timeout(timeout),
+            limits = httpx.Limits(max_connections = max_connections, max_keepalive_connections = max_connections))
+
+    def SetRateLimit(self, rate : int) -> None:
+        # 令牌桶容量为一秒的流量
+        self._rate_limiter.rate = rate
+        self._rate_limiter.burst = rate
+
+    def LocalPath(self, path : str) -> str:
+        return os.path.join(self.base_path, *path.split("/"))
+
+    async def _probe(self, url : str) -> tuple[int, bool]:
+        # 请求第一个字节，得到文件大小以及服务端是否支持Range
+        async with self._client.stream("GET", url, headers = {"Range": "bytes=0-0"}) as response:
+            if response.status_code >= 400:
+                raise HttpDownloadError(response.status_code, "probe failed")
+            match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+            if response.status_code == 206 and match is not None:
+                return int(match.group(1)), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length is not None else -1), False
+
+    async def _fetch(self, url : str, file, start : int, end : int, on_bytes : Callable[[int], None]) -> None:
+        # 下载[start, end]区间，end为None表示直到文件末尾
+        headers = {"Range": f"bytes={start}-{end}" if end is not None else f"bytes={start}-"} if start > 0 or end is not None else {}
+        async with self._client.stream("GET", url, headers = headers) as response:
+            if response.status_code >= 400:
+                raise HttpDownloadError(response.status_code, f"range {start}-{end}")
+            if len(headers) > 0 and response.status_code != 206:
+                raise HttpDownloadError(response.status_code, "server ignored range request")
+            offset = start
+            buffer = bytearray()
+            async for data in response.aiter_bytes():
+                await self._rate_limiter.Acquire(len(data))
+                self.downloaded_bytes += len(data)
+                buffer += data
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    await asyncio.to_thread(_write_at, file, offset, bytes(buffer))
+                    offset += len(buffer)
+                    on_bytes(len(buffer))
+                    buffer.clear()
+            if len(buffer) > 0:
+                await asyncio.to_thread(_write_at, file, offset, bytes(buffer))
+                offset += len(buffer)
+                on_bytes(len(buffer))
+            if end is not None and offset != end + 1:
+                raise HttpDownloadError(response.status_code, f"short read in range {start}-{end}")
+
+    def Discard(self, path : str) -> None:
+        # 删除已下载的文件和进度，下次从头下载
+        local_path = self.LocalPath(path)
+        for file_path in (local_path, local_path + ".chunks"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    async def Download(self, url : str, path : str, on_progress : Callable[[int, int], None] = None, identity : str = None,
+                       connections : int = None) -> None:
+        # identity标识文件内容(例如文件id)，和保存的进度不一致时从头下载；connections为None时使用默认连接数
+        local_path = self.LocalPath(path)
+        size, ranged = await self._probe(url)
+        downloaded = 0
+
+        def _on_bytes(length : int):
+            nonlocal downloaded
+            downloaded += length
+            if on_progress is not None:
+                on_progress(downloaded, size)
+
+        if not ranged or size <= 0:
+            # 服务端不支持Range时只能单连接从头下载
+            _preallocate(local_path, 0)
+            with open(local_path, "r+b") as file:
+                await self._fetch(url, file, 0, None, _on_bytes)
+            return
+
+        bitmap = ChunkBitmap.Load(local_path + ".chunks", size, self.chunk_size, identity)
+        _preallocate(local_path, size)
+        downloaded = bitmap.DoneBytes()
+        pending = asyncio.Queue()
+        for index in bitmap.Missing():
+            pending.put_nowait(index)
+
+        async def _worker():
+            # 每个连接使用自己的文件句柄，seek和write互不干扰
+            with open(local_path, "r+b") as file:
+                while not pending.empty():
+                    index = pending.get_nowait()
+                    start = index * bitmap.chunk_size
+                    end = min(size, start + bitmap.chunk_size) - 1
+                    await self._fetch(url, file, start, end, _on_bytes)
+                    await asyncio.to_thread(file.flush)
+                    bitmap.MarkDone(index)
+                    bitmap.Save()
+
+        workers = [asyncio.create_task(_worker()) for _ in range(max(1, min(connections or self.connections, pending.qsize())))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        bitmap.Remove()
+
+    async def Close(self) -> None:
+        await self._client.aclose()
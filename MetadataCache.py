@@ -0,0 +1,158 @@
+import sqlite3
+import logging
+import threading
+from typing import Any, Iterable
+
+# 缓存结构变化时增加版本号，旧的缓存会被直接丢弃重建
+SCHEMA_VERSION = 2
+
+class NodeRecord:
+    __slots__ = ("id", "name", "father_id", "is_dir", "last_update", "position", "size", "modified_time", "hash")
+
+    def __init__(self, id : str, name : str, father_id : str, is_dir : bool, last_update : float, position : int,
+                 size : int = None, modified_time : float = None, hash : str = None):
+        self.id : str = id
+        self.name : str = name
+        self.father_id : str = father_id
+        self.is_dir : bool = is_dir
+        self.last_update : float = last_update
+        self.position : int = position
+        self.size : int = size
+        self.modified_time : float = modified_time
+        self.hash : str = hash
+
+class MetadataCache:
+    def __init__(self, path : str):
+        self._path : str = path
+        self._conn : sqlite3.Connection = None
+        # 加载在工作线程中进行，连接在线程间共用，所有访问都要持有这个锁
+        self._lock : threading.Lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self._path, check_same_thread = False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS nodes")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS nodes (
+                    root_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    father_id TEXT,
+                    is_dir INTEGER NOT NULL,
+                    last_update REAL,
+                    position INTEGER NOT NULL DEFAULT 0,
+                    size INTEGER,
+                    modified_time REAL,
+                    hash TEXT,
+                    PRIMARY KEY (root_id, id)
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS nodes_father ON nodes (root_id, father_id)")
+        self._conn = conn
+        return conn
+
+    @staticmethod
+    def _key(id : str) -> str:
+        # 根目录的id可能为None
+        return "" if id is None else id
+
+    @staticmethod
+    def _unkey(key : str) -> str:
+        return None if key == "" else key
+
+    def Load(self, root_id : str) -> list[NodeRecord]:
+        try:
+            with self._lock:
+                rows = self._connect().execute(
+                    "SELECT id, name, father_id, is_dir, last_update, position, size, modified_time, hash FROM nodes WHERE root_id = ? ORDER BY father_id, position",
+                    (self._key(root_id),)).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"failed to load metadata cache, exception occurred: {e}")
+            return []
+        return [NodeRecord(self._unkey(id), name, None if father_id is None else self._unkey(father_id), bool(is_dir), last_update, position, size, modified_time, hash)
+                for id, name, father_id, is_dir, last_update, position, size, modified_time, hash in rows]
+
+    def SaveDir(self, root_id : str, dir_record : NodeRecord, children : list[NodeRecord]) -> None:
+        root_key = self._key(root_id)
+        dir_key = self._key(dir_record.id)
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen_ids (id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM seen_ids")
+                conn.executemany("INSERT OR IGNORE INTO seen_ids (id) VALUES (?)", [(child.id,) for child in children])
+                vanished = conn.execute(
+                    "SELECT id FROM nodes WHERE root_id = ? AND father_id = ? AND id NOT IN (SELECT id FROM seen_ids)",
+                    (root_key, dir_key)).fetchall()
+                self._delete_subtrees(conn, root_key, [id for id, in vanished])
+                self._upsert(conn, root_key, [dir_record] + children)
+        except sqlite3.Error as e:
+            logging.error(f"failed to save metadata cache, exception occurred: {e}")
+
+    def Save(self, root_id : str, records : Iterable[NodeRecord]) -> None:
+        try:
+            with self._lock, self._connect() as conn:
+                self._upsert(conn, self._key(root_id), list(records))
+        except sqlite3.Error as e:
+            logging.error(f"failed to save metadata cache, exception occurred: {e}")
+
+    def Remove(self, root_id : str, ids : Iterable[str]) -> None:
+        # 同时删除这些节点的所有后代
+        try:
+            with self._lock, self._connect() as conn:
+                self._delete_subtrees(conn, self._key(root_id), [self._key(id) for id in ids])
+        except sqlite3.Error as e:
+            logging.error(f"failed to save metadata cache, exception occurred: {e}")
+
+    def Invalidate(self, root_id : str, ids : Iterable[str]) -> None:
+        try:
+            with self._lock, self._connect() as conn:
+                conn.executemany("UPDATE nodes SET last_update = NULL WHERE root_id = ? AND id = ?",
+                    [(self._key(root_id), self._key(id)) for id in ids])
+        except sqlite3.Error as e:
+            logging.error(f"failed to save metadata cache, exception occurred: {e}")
+
+    def Close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _delete_subtrees(self, conn : sqlite3.Connection, root_key : str, keys : list[str]) -> None:
+        # 沿father_id递归找出以keys为根的所有子树，一条语句删除
+        if len(keys) == 0:
+            return
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS subtree_roots (id TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM subtree_roots")
+        conn.executemany("INSERT OR IGNORE INTO subtree_roots (id) VALUES (?)", [(key,) for key in keys])
+        conn.execute("""
+            WITH RECURSIVE subtree(id) AS (
+                SELECT id FROM subtree_roots
+                UNION
+                SELECT nodes.id FROM nodes JOIN subtree ON nodes.father_id = subtree.id WHERE nodes.root_id = ?)
+            DELETE FROM nodes WHERE root_id = ? AND id IN (SELECT id FROM subtree)""", (root_key, root_key))
+
+    def _upsert(self, conn : sqlite3.Connection, root_key : str, records : list[NodeRecord]) -> None:
+        # 只有根目录自身的father_id存为NULL
+        rows : list[tuple[Any, ...]] = [
+            (root_key, self._key(record.id), record.name, None if self._key(record.id) == root_key else self._key(record.father_id),
+             1 if record.is_dir else 0, record.last_update, record.position, record.size, record.modified_time, record.hash)
+            for record in records]
+        conn.executemany("""
+            INSERT INTO nodes (root_id, id, name, father_id, is_dir, last_update, position, size, modified_time, hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (root_id, id) DO UPDATE SET
+                name = excluded.name,
+                father_id = excluded.father_id,
+                is_dir = excluded.is_dir,
+                last_update = excluded.last_update,
+                position = excluded.position,
+                size = excluded.size,
+                modified_time = excluded.modified_time,
+                hash = excluded.hash""", rows)
@@ -0,0 +1,84 @@
+import heapq
+from typing import Dict, Iterable
+
+# 短于这个长度的查询词没有完整的n-gram，退化为逐个比较
+NGRAM_SIZE = 3
+
+class NameIndex:
+    # 文件名的n-gram倒排索引，不区分大小写，支持任意子串查找
+    def __init__(self):
+        self._names : Dict[str, str] = {}
+        self._postings : Dict[str, set[str]] = {}
+
+    @staticmethod
+    def _ngrams(text : str) -> set[str]:
+        return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def Add(self, id : str, name : str) -> None:
+        lowered = name.lower()
+        old = self._names.get(id)
+        if old == lowered:
+            return
+        if old is not None:
+            self.Remove(id)
+        self._names[id] = lowered
+        for gram in self._ngrams(lowered):
+            self._postings.setdefault(gram, set()).add(id)
+
+    def Remove(self, id : str) -> None:
+        lowered = self._names.pop(id, None)
+        if lowered is None:
+            return
+        for gram in self._ngrams(lowered):
+            ids = self._postings.get(gram)
+            if ids is None:
+                continue
+            ids.discard(id)
+            if len(ids) == 0:
+                del self._postings[gram]
+
+    def _candidates(self, term : str) -> Iterable[str]:
+        grams = self._ngrams(term)
+        if len(grams) == 0:
+            return self._names.keys()
+        # 从最短的倒排表开始求交集
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key = len)
+        result = set(postings[0])
+        for ids in postings[1:]:
+            result &= ids
+            if len(result) == 0:
+                break
+        return result
+
+    @staticmethod
+    def _score(name : str, query : str, terms : list[str]) -> int:
+        # 分数越小越靠前：完全相同 < 前缀 < 词首匹配 < 任意位置
+        if name == query:
+            return 0
+        if name.startswith(query):
+            return 1
+        score = 2
+        for term in terms:
+            position = name.find(term)
+            if position > 0 and name[position - 1].isalnum():
+                score = 3
+        return score
+
+    def Search(self, query : str, limit : int) -> list[str]:
+        # 返回名字包含query中所有词的id，按匹配程度和名字长度排序
+        query = query.strip().lower()
+        terms = query.split()
+        if len(terms) == 0:
+            return []
+        # 最长的词过滤效果最好
+        terms.sort(key = len, reverse = True)
+        ranked : list[tuple[int, int, str, str]] = []
+        for id in self._candidates(terms[0]):
+            name = self._names[id]
+            if not all(term in name for term in terms):
+                continue
+            ranked.append((self._score(name, query, terms), len(name), name, id))
+        return [id for _, _, _, id in heapq.nsmallest(limit, ranked)]
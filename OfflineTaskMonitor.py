@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict
+from pikpakapi import DownloadStatus
+from PikPakFileSystem import PikPakFileSystem
+
+# 轮询间隔的上下限，没有进展时按倍数退避
+MIN_POLL_INTERVAL = 3
+MAX_POLL_INTERVAL = 60
+POLL_BACKOFF = 1.5
+
+class OfflineTaskMonitor:
+    # 共享的离线任务监视器：每轮只用一次offline_list查询所有被等待的离线任务，
+    # 根据progress估计剩余时间决定下次轮询的时间，任务离开列表时立即唤醒等待者
+    def __init__(self, client : PikPakFileSystem):
+        self._client : PikPakFileSystem = client
+        self._waiters : Dict[str, list[asyncio.Future]] = {}
+        self._node_ids : Dict[str, str] = {}
+        self._progress_callbacks : Dict[str, list[Callable[[int], None]]] = {}
+        # 每个任务上次观测到的(进度, 时间)和它自己的轮询间隔
+        self._last_progress : Dict[str, tuple[int, float]] = {}
+        self._intervals : Dict[str, float] = {}
+        self._wakeup : asyncio.Event = asyncio.Event()
+        self._poll_task : asyncio.Task = None
+
+    def Start(self) -> None:
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll_loop())
+
+    def Stop(self) -> None:
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        self._poll_task = None
+
+    async def Wait(self, task_id : str, node_id : str, on_progress : Callable[[int], None] = None) -> DownloadStatus:
+        # 等待离线任务结束，返回done、error或not_found
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(task_id, []).append(future)
+        self._node_ids[task_id] = node_id
+        if on_progress is not None:
+            self._progress_callbacks.setdefault(task_id, []).append(on_progress)
+        self._intervals.setdefault(task_id, MIN_POLL_INTERVAL)
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            waiters = self._waiters.get(task_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            callbacks = self._progress_callbacks.get(task_id, [])
+            if on_progress in callbacks:
+                callbacks.remove(on_progress)
+            if len(waiters) == 0:
+                self._forget(task_id)
+
+    def _forget(self, task_id : str) -> None:
+        self._waiters.pop(task_id, None)
+        self._node_ids.pop(task_id, None)
+        self._progress_callbacks.pop(task_id, None)
+        self._last_progress.pop(task_id, None)
+        self._intervals.pop(task_id, None)
+
+    def _next_interval(self, task_id : str, progress : int) -> float:
+        # 有进展时按进度速度估计剩余时间，在一半剩余时间后再查；没有进展时退避
+        now = time.monotonic()
+        last = self._last_progress.get(task_id)
+        self._last_progress[task_id] = (progress, now)
+        interval = self._intervals.get(task_id, MIN_POLL_INTERVAL)
+        if last is not None and progress > last[0] and now > last[1]:
+            rate = (progress - last[0]) / (now - last[1])
+            interval = (100 - progress) / rate / 2
+        elif last is not None:
+            interval *= POLL_BACKOFF
+        interval = max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval))
+        self._intervals[task_id] = interval
+        return interval
+
+    def _settle(self, task_id : str, status : DownloadStatus) -> None:
+        for future in self._waiters.pop(task_id, []):
+            if not future.done():
+                future.set_result(status)
+        self._forget(task_id)
+
+    async def _poll_loop(self) -> None:
+        interval = MIN_POLL_INTERVAL
+        while True:
+            try:
+                if len(self._waiters) == 0:
+                    await self._wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout = interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                interval = await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"offline task monitor poll failed, exception occurred: {e}")
+                interval = MAX_POLL_INTERVAL
+
+    async def _poll(self) -> float:
+        # 返回下次轮询前等待的秒数
+        if len(self._waiters) == 0:
+            return MIN_POLL_INTERVAL
+        # 只处理请求发出前就在等待的任务：请求期间新加入的任务可能还没出现在返回的列表里，不能当作已结束
+        task_ids = list(self._waiters.keys())
+        active : Dict[str, Dict[str, Any]] = await self._client.ListOfflineTasks()
+        finished : list[str] = []
+        interval = MAX_POLL_INTERVAL
+        for task_id in task_ids:
+            if task_id not in self._waiters:
+                continue
+            info = active.get(task_id)
+            if info is None:
+                finished.append(task_id)
+                continue
+            if info.get("phase") == "PHASE_TYPE_ERROR":
+                logging.warning(f"offline task {task_id} failed: {info.get('message', '')}")
+                self._settle(task_id, DownloadStatus.error)
+                continue
+            progress = int(info.get("progress", 0))
+            for callback in self._progress_callbacks.get(task_id, []):
+                callback(progress)
+            interval = min(interval, self._next_interval(task_id, progress))
+        # 不在进行中列表里的任务，根据保存的文件是否存在判断是否完成
+        statuses = await asyncio.gather(*[self._client.QueryOfflineFile(self._node_ids[task_id]) for task_id in finished])
+        for task_id, status in zip(finished, statuses):
+            self._settle(task_id, status)
+        if any(task_id not in task_ids for task_id in self._waiters):
+            # 有新加入的任务，尽快轮询一次
+            interval = MIN_POLL_INTERVAL
+        return interval
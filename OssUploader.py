@@ -0,0 +1,143 @@
+import httpx
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import re
+from email.utils import formatdate
+from typing import Any, Callable, Dict
+from urllib.parse import quote
+
+# OSS要求每片至少100KB、最多10000片；分片从8MB起，文件太大时翻倍
+MIN_PART_SIZE = 8 << 20
+MAX_PART_NUMBER = 10000
+DEFAULT_PART_CONCURRENCY = 4
+
+def GcidBlockSize(size : int) -> int:
+    # PikPak(迅雷)gcid的分块大小：从256KB开始翻倍，直到块数不超过512或块大小达到2MB
+    block_size = 0x40000
+    while size / block_size > 0x200 and block_size < 0x200000:
+        block_size <<= 1
+    return block_size
+
+def ComputeGcid(path : str) -> str:
+    # gcid = sha1(每块sha1摘要拼接)，逐块读取，内存占用和文件大小无关
+    block_size = GcidBlockSize(os.path.getsize(path))
+    gcid = hashlib.sha1()
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            gcid.update(hashlib.sha1(block).digest())
+    return gcid.hexdigest().upper()
+
+def PartSize(size : int) -> int:
+    part_size = MIN_PART_SIZE
+    while part_size * MAX_PART_NUMBER < size:
+        part_size <<= 1
+    return part_size
+
+def _read_part(path : str, offset : int, length : int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return file.read(length)
+
+class OssError(Exception):
+    def __init__(self, status_code : int, code : str, message : str):
+        super().__init__(f"oss error {status_code} {code}: {message}")
+        self.status_code : int = status_code
+        self.code : str = code
+        self.message : str = message
+
+    @property
+    def CredentialExpired(self) -> bool:
+        return self.status_code == 403 and self.code in {"SecurityTokenExpired", "InvalidAccessKeyId"}
+
+class OssUploader:
+    # 用PikPak创建文件时返回的临时凭证(resumable.params)向阿里云OSS做分片上传
+    def __init__(self, params : Dict[str, Any], proxy_address : str = None, timeout : float = 60):
+        self._access_key_id : str = params["access_key_id"]
+        self._access_key_secret : str = params["access_key_secret"]
+        self._security_token : str = params["security_token"]
+        self._bucket : str = params["bucket"]
+        self._key : str = params["key"]
+        self._url : str = f"https://{self._bucket}.{params['endpoint']}/{quote(self._key)}"
+        self._client : httpx.AsyncClient = httpx.AsyncClient(proxy = proxy_address, timeout = httpx.Timeout(timeout))
+
+    def _headers(self, method : str, sub_resource : str, content_type : str = "") -> Dict[str, str]:
+        # OSS V1签名，子资源需要按字典序排列
+        date = formatdate(usegmt = True)
+        oss_headers = {"x-oss-security-token": self._security_token}
+        canonical_headers = "".join(f"{key}:{value}\n" for key, value in sorted(oss_headers.items()))
+        resource = f"/{self._bucket}/{self._key}" + (f"?{sub_resource}" if sub_resource else "")
+        string_to_sign = f"{method}\n\n{content_type}\n{date}\n{canonical_headers}{resource}"
+        signature = base64.b64encode(hmac.new(self._access_key_secret.encode(), string_to_sign.encode(), hashlib.sha1).digest()).decode()
+        headers = {"Date": date, "Authorization": f"OSS {self._access_key_id}:{signature}", **oss_headers}
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
+    async def _request(self, method : str, sub_resource : str, content : bytes = None, content_type : str = "") -> httpx.Response:
+        response = await self._client.request(method, self._url + (f"?{sub_resource}" if sub_resource else ""),
+                                              content = content, headers = self._headers(method, sub_resource, content_type))
+        if response.status_code >= 300:
+            code = re.search(r"<Code>(.*?)</Code>", response.text)
+            message = re.search(r"<Message>(.*?)</Message>", response.text)
+            raise OssError(response.status_code, code.group(1) if code else "", message.group(1) if message else response.text)
+        return response
+
+    async def Initiate(self) -> str:
+        response = await self._request("POST", "uploads")
+        upload_id = re.search(r"<UploadId>(.*?)</UploadId>", response.text)
+        if upload_id is None:
+            raise OssError(response.status_code, "", "no upload id in response")
+        return upload_id.group(1)
+
+    async def UploadPart(self, upload_id : str, part_number : int, data : bytes) -> str:
+        response = await self._request("PUT", f"partNumber={part_number}&uploadId={upload_id}", data)
+        return response.headers["ETag"]
+
+    async def Complete(self, upload_id : str, parts : Dict[int, str]) -> None:
+        body = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{parts[number]}</ETag></Part>" for number in sorted(parts))
+        await self._request("POST", f"uploadId={upload_id}", f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode(), "application/xml")
+
+    async def Abort(self, upload_id : str) -> None:
+        await self._request("DELETE", f"uploadId={upload_id}")
+
+    async def Upload(self, path : str, upload_id : str, parts : Dict[int, str], concurrency : int = DEFAULT_PART_CONCURRENCY,
+                     on_part_done : Callable[[int, str, int], None] = None) -> None:
+        # 上传parts中还没有的分片，每个分片上传时才从磁盘读取，内存占用不超过concurrency个分片；
+        # parts会被就地更新，调用方保存下来即可断点续传
+        size = os.path.getsize(path)
+        part_size = PartSize(size)
+        part_count = max(1, (size + part_size - 1) // part_size)
+        pending = asyncio.Queue()
+        for number in range(1, part_count + 1):
+            if number not in parts:
+                pending.put_nowait(number)
+
+        async def _worker():
+            while not pending.empty():
+                number = pending.get_nowait()
+                offset = (number - 1) * part_size
+                length = min(part_size, size - offset)
+                data = await asyncio.to_thread(_read_part, path, offset, length)
+                etag = await self.UploadPart(upload_id, number, data)
+                parts[number] = etag
+                logging.debug(f"uploaded part {number}/{part_count} of {path}")
+                if on_part_done is not None:
+                    on_part_done(number, etag, length)
+
+        workers = [asyncio.create_task(_worker()) for _ in range(max(1, concurrency))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        await self.Complete(upload_id, parts)
+
+    async def Close(self) -> None:
+        await self._client.aclose()
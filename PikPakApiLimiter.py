@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Iterator
+from pikpakapi import PikPakApi
+
+class ApiPriority(IntEnum):
+    # 数值越小越优先
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    PREFETCH = 2
+
+_current_priority : ContextVar[ApiPriority] = ContextVar("pikpak_api_priority", default = ApiPriority.INTERACTIVE)
+
+class FlightPriority:
+    # SingleFlight中一次共享执行的优先级：更优先的调用者加入时提升，执行中正在排队的令牌请求随之提升；
+    # 嵌套的共享执行取自己和所有外层执行中最优先的一个
+    def __init__(self, priority : int, parent : "FlightPriority" = None):
+        self._priority : int = priority
+        self.parent : FlightPriority = parent
+        self._listeners : list[Callable[[], None]] = []
+
+    @property
+    def Value(self) -> int:
+        priority = self._priority
+        parent = self.parent
+        while parent is not None:
+            priority = min(priority, parent._priority)
+            parent = parent.parent
+        return priority
+
+    def Raise(self, priority : int) -> None:
+        if priority >= self._priority:
+            return
+        self._priority = priority
+        for listener in list(self._listeners):
+            listener()
+
+    def Subscribe(self, listener : Callable[[], None]) -> None:
+        # 自己或任意一层外层执行被提升时调用listener
+        flight = self
+        while flight is not None:
+            flight._listeners.append(listener)
+            flight = flight.parent
+
+    def Unsubscribe(self, listener : Callable[[], None]) -> None:
+        flight = self
+        while flight is not None:
+            if listener in flight._listeners:
+                flight._listeners.remove(listener)
+            flight = flight.parent
+
+_current_flight : ContextVar[FlightPriority] = ContextVar("pikpak_api_flight", default = None)
+
+@contextmanager
+def ApiPriorityScope(priority : ApiPriority) -> Iterator[None]:
+    # 在当前上下文(及其中创建的asyncio任务)内发出的请求使用指定的优先级
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+def CurrentApiPriority() -> ApiPriority:
+    priority = _current_priority.get()
+    flight = _current_flight.get()
+    return ApiPriority(min(priority, flight.Value)) if flight is not None else priority
+
+class TokenBucket:
+    # 令牌桶限速，令牌不足时按(优先级, 先后顺序)排队发放
+    def __init__(self, rate : float, burst : float):
+        self.rate : float = rate
+        self.burst : float = burst
+        self._tokens : float = burst
+        self._last_refill : float = time.monotonic()
+        self._waiters : list[tuple[int, int, float, asyncio.Future, FlightPriority]] = []
+        self._counter = itertools.count()
+        self._drainer : asyncio.Task = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def Acquire(self, amount : float = 1, priority : int = ApiPriority.INTERACTIVE, flight : FlightPriority = None) -> None:
+        # 在flight中排队时，flight被提升后请求按新的优先级重新排队
+        if self.rate <= 0:
+            return
+        self._refill()
+        if len(self._waiters) == 0 and self._tokens >= amount:
+            self._tokens -= amount
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._counter), amount, future, flight))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+        if flight is None:
+            await future
+            return
+        flight.Subscribe(self._reprioritize)
+        try:
+            await future
+        finally:
+            flight.Unsubscribe(self._reprioritize)
+
+    def _reprioritize(self) -> None:
+        self._waiters = [(min(priority, flight.Value) if flight is not None else priority, counter, amount, future, flight)
+                         for priority, counter, amount, future, flight in self._waiters]
+        heapq.heapify(self._waiters)
+
+    async def _drain(self) -> None:
+        while len(self._waiters) > 0:
+            self._refill()
+            _, _, amount, future, _ = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            # 单次请求超过桶容量时，攒满桶后直接放行
+            needed = min(amount, self.burst)
+            if self._tokens >= needed:
+                heapq.heappop(self._waiters)
+                self._tokens -= needed
+                future.set_result(None)
+                continue
+            await asyncio.sleep((needed - self._tokens) / self.rate)
+
+class SingleFlight:
+    # 相同key的并发调用共享同一次执行的结果；更优先的调用者加入时提升这次执行的优先级
+    def __init__(self):
+        self._calls : Dict[Any, tuple[asyncio.Task, FlightPriority]] = {}
+
+    async def Do(self, key : Any, func : Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            flight = FlightPriority(CurrentApiPriority(), _current_flight.get())
+
+            async def _run() -> Any:
+                # 任务有自己的上下文副本，这里的设置只对这次执行生效
+                _current_flight.set(flight)
+                return await func()
+            task = asyncio.ensure_future(_run())
+            call = (task, flight)
+            self._calls[key] = call
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        else:
+            task, flight = call
+            flight.Raise(CurrentApiPriority())
+        # 某个调用者被取消时不影响其他共享结果的调用者
+        return await asyncio.shield(task)
+
+    def InFlight(self, key : Any) -> bool:
+        return key in self._calls
+
+class LimitedPikPakApi:
+    # 包装PikPakApi：所有网络请求经过令牌桶限速，只读请求在并发时合并为一次
+    DEDUPLICATED_METHODS = {"file_list", "offline_file_info", "offline_list", "get_task_status", "get_download_url", "events"}
+
+    def __init__(self, get_client : Callable[[], PikPakApi], rate : float, burst : float):
+        self._get_client : Callable[[], PikPakApi] = get_client
+        self._bucket : TokenBucket = TokenBucket(rate, burst)
+        self._flights : SingleFlight = SingleFlight()
+
+    def __getattr__(self, name : str) -> Any:
+        attr = getattr(self._get_client(), name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def _call(*args, **kwargs):
+            async def _limited_call():
+                await self._bucket.Acquire(1, CurrentApiPriority(), _current_flight.get())
+                return await attr(*args, **kwargs)
+            if name not in self.DEDUPLICATED_METHODS:
+                return await _limited_call()
+            key = (name, json.dumps([args, kwargs], sort_keys = True, default = str))
+            return await self._flights.Do(key, _limited_call)
+        return _call
@@ -1,41 +1,308 @@
 import httpx
-from pikpakapi import PikPakApi, DownloadStatus
+from pikpakapi import PikPakApi, DownloadStatus, PikpakException
 from typing import Dict
 from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+import bisect
+import fnmatch
+import math
+import struct
+import sys
+import time
+from enum import Enum
+import asyncio
 import json
 import os
 import logging
-from typing import Any
+from typing import Any, AsyncIterator, Callable, Iterator
+from collections import deque
+from collections.abc import Mapping
+from MetadataCache import MetadataCache, NodeRecord
+from NameIndex import NameIndex
+from PikPakApiLimiter import LimitedPikPakApi, SingleFlight, ApiPriority, ApiPriorityScope, CurrentApiPriority
+
+# 文件的(大小, 修改时间, 哈希的存储方式)，后面接着哈希本身；未知的大小和修改时间分别存为-1和NaN
+FILE_META = struct.Struct("<qdB")
+HASH_NONE = 0
+HASH_HEX_UPPER = 1
+HASH_HEX_LOWER = 2
+HASH_TEXT = 3
 
 class NodeBase:
+    # 节点数量可能上百万，使用__slots__并驻留id字符串，id在_nodes和各级children索引中只存一份；
+    # 绝大多数节点是文件，所以只有目录才有的状态都放在DirNode上
+    __slots__ = ("id", "name", "_father_id")
+
     def __init__(self, id : str, name : str, fatherId : str):
-        self.id = id
+        self.id = sys.intern(id) if id is not None else None
         self.name = name
-        self._father_id = fatherId
-        self.lastUpdate : datetime = None
+        self._father_id = sys.intern(fatherId) if fatherId is not None else None
 
 class DirNode(NodeBase):
+    __slots__ = ("lastUpdate", "modified_time", "_path", "_depth", "_path_epoch", "children", "_sorted_names")
+
     def __init__(self, id : str, name : str, fatherId : str):
         super().__init__(id, name, fatherId)
-        self.children_id : list[str] = []
+        # 时间均为time.time()的时间戳
+        self.lastUpdate : float = None
+        self.modified_time : float = None
+        # 缓存的绝对路径和深度，_path_epoch和文件系统的当前纪元不同时失效；文件的路径由所在目录拼接，不单独缓存
+        self._path : str = None
+        self._depth : int = 0
+        self._path_epoch : int = -1
+        # 名字 -> id，同名的子节点有多个时为按加入顺序排列的id列表；按名字查找和增删子节点都是O(1)
+        self.children : Dict[str, str | list[str]] = {}
+        # 排好序的子节点名字，用于前缀查找，子节点的名字集合变化后下次查找时重建
+        self._sorted_names : list[str] = None
+
+    def _names_with_prefix(self, prefix : str) -> list[str]:
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.children.keys())
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        names : list[str] = []
+        for name in self._sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    def _child_ids(self) -> Iterator[str]:
+        for entry in self.children.values():
+            if isinstance(entry, list):
+                yield from entry
+            else:
+                yield entry
+
+    def _child_id(self, name : str) -> str:
+        # 同名时返回先加入的节点，和线性查找的语义一致
+        entry = self.children.get(name)
+        return entry[0] if isinstance(entry, list) else entry
+
+    def _has_child(self, id : str, name : str) -> bool:
+        entry = self.children.get(name)
+        return entry == id or (isinstance(entry, list) and id in entry)
+
+    def _add_child(self, id : str, name : str) -> None:
+        entry = self.children.get(name)
+        if entry is None:
+            self.children[name] = id
+            self._sorted_names = None
+        elif isinstance(entry, list):
+            if id not in entry:
+                entry.append(id)
+        elif entry != id:
+            self.children[name] = [entry, id]
+
+    def _remove_child(self, id : str, name : str) -> None:
+        # name必须是子节点加入索引时的名字，改名前先摘除
+        entry = self.children.get(name)
+        if entry == id:
+            del self.children[name]
+            self._sorted_names = None
+        elif isinstance(entry, list) and id in entry:
+            entry.remove(id)
+            if len(entry) == 1:
+                self.children[name] = entry[0]
+
+    def _retain_children(self, ids : set[str]) -> list[str]:
+        # 一次遍历摘除id不在ids中的子节点，返回被摘除的id
+        removed : list[str] = []
+        for name, entry in list(self.children.items()):
+            if not isinstance(entry, list):
+                if entry not in ids:
+                    removed.append(entry)
+                    del self.children[name]
+                continue
+            kept = [id for id in entry if id in ids]
+            if len(kept) == len(entry):
+                continue
+            removed.extend(id for id in entry if id not in ids)
+            if len(kept) == 0:
+                del self.children[name]
+            else:
+                self.children[name] = kept if len(kept) > 1 else kept[0]
+        if len(removed) > 0:
+            self._sorted_names = None
+        return removed
+
+    def _clear_children(self) -> None:
+        self._sorted_names = None
+        self.children.clear()
 
 class FileNode(NodeBase):
+    # 大小、修改时间和哈希打包在一个bytes里(40位十六进制的哈希存为20字节)，比分别存成int、float和str省一半以上；
+    # 下载链接不在节点上，由PikPakFileSystem._file_urls保存
+    __slots__ = ("_meta",)
+    _EMPTY_META : bytes = FILE_META.pack(-1, math.nan, HASH_NONE)
+
     def __init__(self, id : str, name : str, fatherId : str):
         super().__init__(id, name, fatherId)
-        self.url : str = None
+        self._meta : bytes = FileNode._EMPTY_META
+
+    def _set_meta(self, size : int, modified_time : float, hash : str) -> None:
+        kind, payload = HASH_NONE, b""
+        if hash:
+            try:
+                payload = bytes.fromhex(hash)
+                kind = HASH_HEX_UPPER if payload.hex().upper() == hash else HASH_HEX_LOWER if payload.hex() == hash else HASH_TEXT
+            except ValueError:
+                kind = HASH_TEXT
+            if kind == HASH_TEXT:
+                payload = hash.encode()
+        self._meta = FILE_META.pack(-1 if size is None else size, math.nan if modified_time is None else modified_time, kind) + payload
+
+    @property
+    def size(self) -> int:
+        size = FILE_META.unpack_from(self._meta)[0]
+        return None if size < 0 else size
+
+    @size.setter
+    def size(self, size : int) -> None:
+        self._set_meta(size, self.modified_time, self.hash)
+
+    @property
+    def modified_time(self) -> float:
+        modified_time = FILE_META.unpack_from(self._meta)[1]
+        return None if math.isnan(modified_time) else modified_time
+
+    @modified_time.setter
+    def modified_time(self, modified_time : float) -> None:
+        self._set_meta(self.size, modified_time, self.hash)
+
+    @property
+    def hash(self) -> str:
+        kind = self._meta[FILE_META.size - 1]
+        payload = self._meta[FILE_META.size:]
+        if kind == HASH_HEX_UPPER:
+            return payload.hex().upper()
+        if kind == HASH_HEX_LOWER:
+            return payload.hex()
+        if kind == HASH_TEXT:
+            return payload.decode()
+        return None
+
+    @hash.setter
+    def hash(self, hash : str) -> None:
+        self._set_meta(self.size, self.modified_time, hash)
+
+class RequestHeaders(Mapping):
+    # 每次被读取时重新生成请求头：PikPakApi._make_request刷新access_token后重试时，会带上新的Authorization
+    def __init__(self, client : PikPakApi, captcha_token : str):
+        self._client : PikPakApi = client
+        self._captcha_token : str = captcha_token
+
+    def _build(self) -> Dict[str, str]:
+        headers = self._client.get_headers()
+        headers["User-Agent"] = self._client.build_custom_user_agent()
+        headers["X-Captcha-Token"] = self._captcha_token
+        return headers
+
+    def __getitem__(self, key : str) -> str:
+        return self._build()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._build())
+
+    def __len__(self) -> int:
+        return len(self._build())
+
+    def items(self):
+        return self._build().items()
+
+class CachePolicy:
+    def __init__(self, ttl : float = None, max_staleness : float = None):
+        # 缓存时间不超过ttl秒时直接使用；超过ttl但不超过max_staleness秒时先返回旧数据并在后台刷新；
+        # 超过max_staleness秒时同步刷新。为None表示对应的限制不生效
+        self.ttl : float = ttl
+        self.max_staleness : float = max_staleness
+
+class CacheFreshness(Enum):
+    FRESH = "fresh"
+    STALE = "stale"
+    EXPIRED = "expired"
+
+class BatchResult:
+    # 批量操作的结果：成功的路径，以及失败的(路径, 原因)
+    def __init__(self):
+        self.succeeded : list[str] = []
+        self.failed : list[tuple[str, str]] = []
+
+# 下载链接在过期前多少秒就视为失效，重新获取
+URL_REFRESH_MARGIN = 300
+# 无法从返回值中解析出过期时间时，假定链接的有效期
+DEFAULT_URL_LIFETIME = 3600
+URL_RESOLVE_CONCURRENCY = 8
+# 默认的API限速：每秒请求数和突发容量
+DEFAULT_API_RATE = 5
+DEFAULT_API_BURST = 10
+# 预取时同时进行的目录请求数，以及排队等待预取的目录数上限
+PREFETCH_CONCURRENCY = 2
+PREFETCH_MAX_PENDING = 32
+# 从缓存列目录时每批产出的名字数
+LIST_PAGE_SIZE = 1000
+# 批量删除、移动、复制时每次请求包含的文件数，以及并发解析路径的数量
+BATCH_OPERATION_SIZE = 100
+PATH_RESOLVE_CONCURRENCY = 8
+# 列出离线任务时包含的阶段：已完成的任务不在列表中，历史记录再多也只需要一次请求
+OFFLINE_ACTIVE_PHASES = ["PHASE_TYPE_PENDING", "PHASE_TYPE_RUNNING", "PHASE_TYPE_ERROR"]
+
+DEFAULT_CACHE_POLICIES : Dict[type, CachePolicy] = {
+    DirNode: CachePolicy(ttl = 60, max_staleness = 3600),
+    FileNode: CachePolicy(),
+}
 
 class PikPakFileSystem:
     #region 内部接口
-    def __init__(self, auth_cache_path : str = None, proxy_address : str = None, root_id : str = None):
+    def __init__(self, auth_cache_path : str = None, proxy_address : str = None, root_id : str = None, cache_policies : Dict[type, CachePolicy] = None, metadata_cache_path : str = None,
+                 api_rate : float = DEFAULT_API_RATE, api_burst : float = DEFAULT_API_BURST,
+                 prefetch_children : int = 0, prefetch_depth : int = 1):
         # 初始化虚拟文件节点
         self._nodes : Dict[str, NodeBase] = {} 
         self._root : DirNode = DirNode(root_id, "", None)
         self._cwd : DirNode = self._root
+        # 有节点改名或移动时纪元加一，所有缓存的路径在下次使用时重新计算
+        self._path_epoch : int = 0
+        self._root._path = ""
+
+        # 文件id -> (下载链接, 过期时间, 获取时间)，链接只在少数要下载的文件上有，不占用每个节点的空间
+        self._file_urls : Dict[str, tuple[str, float, float]] = {}
+
+        # 初始化缓存策略
+        self._cache_policies : Dict[type, CachePolicy] = dict(DEFAULT_CACHE_POLICIES)
+        if cache_policies is not None:
+            self._cache_policies.update(cache_policies)
+        self._background_refreshes : Dict[str, asyncio.Task] = {}
+        # 同一节点的并发刷新共享一次请求
+        self._refresh_flights : SingleFlight = SingleFlight()
+        # 同一路径的并发创建目录共享一次请求
+        self._make_dir_flights : SingleFlight = SingleFlight()
+
+        # 初始化本地元数据缓存，第一次访问节点时在后台加载
+        self._metadata_cache : MetadataCache = MetadataCache(metadata_cache_path) if metadata_cache_path is not None else None
+        self._metadata_load : asyncio.Task = None
+        # 待执行的缓存写入和执行它们的后台协程
+        self._metadata_writes : deque[Callable[[], None]] = deque()
+        self._metadata_writer : asyncio.Task = None
+        self._revalidate_ids : set[str] = set()
+        # 文件名索引，第一次搜索时建立，之后随目录树增量更新
+        self._name_index : NameIndex = None
+
+        # 初始化目录预取，prefetch_children为0时关闭
+        self._prefetch_children : int = prefetch_children
+        self._prefetch_depth : int = prefetch_depth
+        self._prefetch_semaphore : asyncio.Semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        self._prefetch_pending : set[str] = set()
+        # 保存预取任务的引用，避免还没执行完就被垃圾回收
+        self._prefetch_tasks : set[asyncio.Task] = set()
+        self._prefetched_ids : set[str] = set()
+        self._prefetch_stats : Dict[str, int] = {"issued": 0, "hits": 0, "late": 0, "misses": 0}
 
         # 初始化鉴权和代理信息
         self._auth_cache_path : str = auth_cache_path
         self.proxy_address : str = proxy_address
         self._pikpak_client : PikPakApi = None
+        # 所有网络请求都经过限速和请求合并
+        self._api : LimitedPikPakApi = LimitedPikPakApi(lambda: self._pikpak_client, api_rate, api_burst)
         self._try_login_from_cache()
         
         
@@ -118,7 +385,139 @@ class PikPakFileSystem:
         def Walk(self) -> list[str]:
             return self._path_spots
 
+    #region 元数据缓存相关
+    def _start_metadata_load(self) -> bool:
+        # 第一次访问节点时在后台开始加载元数据缓存，返回是否已经加载完
+        if self._metadata_cache is None:
+            return True
+        if self._metadata_load is None:
+            self._metadata_load = asyncio.ensure_future(self._load_metadata_cache())
+        return self._metadata_load.done()
+
+    async def _wait_metadata_loaded(self) -> None:
+        if not self._start_metadata_load():
+            # 调用方被取消时加载继续进行
+            await asyncio.shield(self._metadata_load)
+
+    async def _load_metadata_cache(self) -> None:
+        # 读取和构建节点都在工作线程中进行，事件循环只负责把建好的节点并入目录树
+        try:
+            root, nodes, revalidate_ids = await asyncio.to_thread(self._build_cached_tree)
+        except Exception as e:
+            logging.error(f"failed to load metadata cache, exception occurred: {e}")
+            return
+        # 加载期间已经从网络得到的节点更新，优先保留
+        nodes.update(self._nodes)
+        self._nodes = nodes
+        if self._root.lastUpdate is None and root.lastUpdate is not None:
+            self._root.lastUpdate = root.lastUpdate
+            for name, entry in root.children.items():
+                for child_id in (entry if isinstance(entry, list) else [entry]):
+                    self._root._add_child(child_id, name)
+        self._revalidate_ids |= revalidate_ids
+
+    def _build_cached_tree(self) -> tuple[DirNode, Dict[str, NodeBase], set[str]]:
+        # 在工作线程中执行，只创建新的节点对象，不访问正在使用的目录树；根目录先用一个替身节点承接
+        records = self._metadata_cache.Load(self._root.id)
+        root = DirNode(self._root.id, "", None)
+        nodes : Dict[str, NodeBase] = {}
+        revalidate_ids : set[str] = set()
+        for record in records:
+            if record.id == root.id:
+                node = root
+            elif record.is_dir:
+                node = DirNode(record.id, record.name, record.father_id)
+            else:
+                node = FileNode(record.id, record.name, record.father_id)
+            if isinstance(node, FileNode):
+                node._set_meta(record.size, record.modified_time, record.hash)
+            else:
+                node.modified_time = record.modified_time
+                if record.last_update is not None:
+                    node.lastUpdate = record.last_update
+                    # 磁盘上的列表先直接使用，第一次访问时在后台重新校验
+                    revalidate_ids.add(node.id)
+            if node is not root:
+                nodes[node.id] = node
+        for record in records:
+            if record.id == root.id:
+                continue
+            father = root if record.father_id == root.id else nodes.get(record.father_id)
+            if isinstance(father, DirNode):
+                # 使用节点上驻留过的id和名字，避免同一个字符串存多份
+                node = nodes[record.id]
+                father._add_child(node.id, node.name)
+        logging.info(f"loaded {len(records)} nodes from metadata cache")
+        return root, nodes, revalidate_ids
+
+    def _to_record(self, node : NodeBase, position : int = 0) -> NodeRecord:
+        last_update = node.lastUpdate if isinstance(node, DirNode) else None
+        record = NodeRecord(node.id, node.name, node._father_id, isinstance(node, DirNode), last_update, position)
+        record.modified_time = node.modified_time
+        if isinstance(node, FileNode):
+            record.size = node.size
+            record.hash = node.hash
+        return record
+
+    def _snapshot(self, node : NodeBase, position : int = 0) -> NodeRecord | tuple:
+        # 文件节点只取出名字和打包好的元数据(都是不可变对象)，解包推迟到工作线程里的_from_snapshots；目录节点直接生成记录
+        if isinstance(node, FileNode):
+            return (node.id, node.name, node._father_id, node._meta, position)
+        return self._to_record(node, position)
+
+    def _from_snapshots(self, snapshots : list[NodeRecord | tuple]) -> list[NodeRecord]:
+        records : list[NodeRecord] = []
+        for snapshot in snapshots:
+            if isinstance(snapshot, NodeRecord):
+                records.append(snapshot)
+                continue
+            id, name, father_id, meta, position = snapshot
+            file = FileNode(id, name, father_id)
+            file._meta = meta
+            records.append(self._to_record(file, position))
+        return records
+
+    def _persist_dir(self, node : DirNode) -> None:
+        if self._metadata_cache is None:
+            return
+        children = [self._snapshot(self._nodes[child_id], position) for position, child_id in enumerate(node._child_ids()) if child_id in self._nodes]
+        record = self._to_record(node)
+        self._write_metadata(lambda: self._metadata_cache.SaveDir(self._root.id, record, self._from_snapshots(children)))
+
+    def _persist_nodes(self, nodes : list[NodeBase]) -> None:
+        if self._metadata_cache is None:
+            return
+        snapshots = [self._snapshot(node) for node in nodes]
+        self._write_metadata(lambda: self._metadata_cache.Save(self._root.id, self._from_snapshots(snapshots)))
+
+    def _unpersist_nodes(self, nodes : list[NodeBase]) -> None:
+        if self._metadata_cache is None:
+            return
+        ids = [node.id for node in nodes]
+        self._write_metadata(lambda: self._metadata_cache.Remove(self._root.id, ids))
+
+    def _write_metadata(self, write : Callable[[], None]) -> None:
+        # 记录在事件循环上取好快照，写入交给后台协程在工作线程中按提交顺序逐个执行，不阻塞事件循环
+        self._metadata_writes.append(write)
+        if self._metadata_writer is None or self._metadata_writer.done():
+            self._metadata_writer = asyncio.ensure_future(self._drain_metadata_writes())
+
+    async def _drain_metadata_writes(self) -> None:
+        while len(self._metadata_writes) > 0:
+            write = self._metadata_writes.popleft()
+            try:
+                await asyncio.to_thread(write)
+            except Exception as e:
+                logging.error(f"failed to write metadata cache, exception occurred: {e}")
+
+    async def _flush_metadata_writes(self) -> None:
+        # 等待已提交的写入全部完成
+        while self._metadata_writer is not None and not self._metadata_writer.done():
+            await asyncio.shield(self._metadata_writer)
+    #endregion
+
     async def _get_node_by_id(self, id : str) -> NodeBase:
+        await self._wait_metadata_loaded()
         if id == self._root.id:
             return self._root
         if id not in self._nodes:
@@ -134,55 +533,289 @@ class PikPakFileSystem:
         self._nodes[node.id] = node
         father = await self._get_father_node(node)
         if father is not None and isinstance(father, DirNode):
-            father.children_id.append(node.id)
+            father._add_child(node.id, node.name)
+        if self._name_index is not None:
+            self._name_index.Add(node.id, node.name)
 
     async def _remove_node(self, node : NodeBase) -> None:
         father = await self._get_father_node(node)
         if father is not None and isinstance(father, DirNode):
-            father.children_id.remove(node.id)
+            father._remove_child(node.id, node.name)
         self._nodes.pop(node.id)
+        self._file_urls.pop(node.id, None)
+        self._path_epoch += 1
+        if self._name_index is not None:
+            self._name_index.Remove(node.id)
 
     async def _find_child_in_dir_by_name(self, dir : DirNode, name : str) -> NodeBase:
         if dir is self._root and name == "":
             return self._root
-        for child_id in dir.children_id:
-            node = await self._get_node_by_id(child_id)
-            if node.name == name:
-                return node
-        return None
+        child_id = dir._child_id(name)
+        if child_id is None:
+            return None
+        return await self._get_node_by_id(child_id)
 
-    async def _refresh(self, node : NodeBase):
+    def _get_freshness(self, node : NodeBase) -> CacheFreshness:
+        if isinstance(node, FileNode):
+            # 文件的缓存就是它的下载链接
+            link = self._file_urls.get(node.id)
+            if link is None or time.time() + URL_REFRESH_MARGIN >= link[1]:
+                return CacheFreshness.EXPIRED
+            last_update = link[2]
+        else:
+            last_update = node.lastUpdate
+        if last_update is None:
+            return CacheFreshness.EXPIRED
+        policy = self._cache_policies.get(type(node))
+        if policy is None or policy.ttl is None:
+            return CacheFreshness.FRESH
+        age = time.time() - last_update
+        if age < policy.ttl:
+            return CacheFreshness.FRESH
+        if policy.max_staleness is None or age < policy.max_staleness:
+            return CacheFreshness.STALE
+        return CacheFreshness.EXPIRED
+
+    def _refresh_in_background(self, node : NodeBase, priority : ApiPriority = ApiPriority.BACKGROUND) -> None:
+        if node.id in self._background_refreshes:
+            return
+        async def _background_refresh():
+            try:
+                with ApiPriorityScope(priority):
+                    await self._do_refresh(node)
+            except Exception as e:
+                logging.error(f"background refresh of {node.id} failed, exception occurred: {e}")
+            finally:
+                self._background_refreshes.pop(node.id, None)
+        self._background_refreshes[node.id] = asyncio.create_task(_background_refresh())
+
+    #region 目录预取相关
+    def _schedule_prefetch(self, node : DirNode, depth : int) -> None:
+        # 在后台以最低优先级列出node的前N个子目录
+        if self._prefetch_children <= 0 or depth > self._prefetch_depth:
+            return
+        candidates = 0
+        for child_id in node._child_ids():
+            if candidates >= self._prefetch_children:
+                break
+            child = self._nodes.get(child_id)
+            if not isinstance(child, DirNode):
+                continue
+            candidates += 1
+            if child.id in self._prefetch_pending or self._get_freshness(child) == CacheFreshness.FRESH:
+                continue
+            if len(self._prefetch_pending) >= PREFETCH_MAX_PENDING:
+                return
+            self._prefetch_pending.add(child.id)
+            task = asyncio.create_task(self._prefetch(child, depth))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, node : DirNode, depth : int) -> None:
+        try:
+            async with self._prefetch_semaphore:
+                with ApiPriorityScope(ApiPriority.PREFETCH):
+                    if self._get_freshness(node) != CacheFreshness.FRESH:
+                        await self._do_refresh(node)
+                        self._prefetched_ids.add(node.id)
+                        self._prefetch_stats["issued"] += 1
+            self._schedule_prefetch(node, depth + 1)
+        except Exception as e:
+            logging.debug(f"prefetch of {node.id} failed, exception occurred: {e}")
+        finally:
+            self._prefetch_pending.discard(node.id)
+
+    def _record_prefetch_outcome(self, node : DirNode, freshness : CacheFreshness) -> None:
+        # 只统计交互命令对目录的访问
+        if self._prefetch_children <= 0 or CurrentApiPriority() != ApiPriority.INTERACTIVE:
+            return
+        if freshness == CacheFreshness.FRESH:
+            if node.id in self._prefetched_ids:
+                self._prefetched_ids.discard(node.id)
+                self._prefetch_stats["hits"] += 1
+        elif freshness == CacheFreshness.EXPIRED:
+            if node.id in self._prefetch_pending:
+                self._prefetch_stats["late"] += 1
+            else:
+                self._prefetch_stats["misses"] += 1
+
+    def _after_interactive_listing(self, node : NodeBase) -> None:
+        if isinstance(node, DirNode) and CurrentApiPriority() == ApiPriority.INTERACTIVE:
+            self._schedule_prefetch(node, 1)
+    #endregion
+
+    async def _invalidate(self, node : NodeBase, recursive : bool) -> None:
+        stack : list[NodeBase] = [node]
+        invalidated_ids : list[str] = []
+        while len(stack) > 0:
+            current = stack.pop()
+            self._forget_update(current)
+            invalidated_ids.append(current.id)
+            if recursive and isinstance(current, DirNode):
+                for child_id in list(current._child_ids()):
+                    child = await self._get_node_by_id(child_id)
+                    if child is not None:
+                        stack.append(child)
+        if self._metadata_cache is not None:
+            self._write_metadata(lambda: self._metadata_cache.Invalidate(self._root.id, invalidated_ids))
+
+    def _forget_update(self, node : NodeBase) -> None:
+        # 让节点的缓存失效，下次访问时重新获取
         if isinstance(node, DirNode):
-            if node.lastUpdate != None:
+            node.lastUpdate = None
+        else:
+            self._file_urls.pop(node.id, None)
+
+    async def _refresh(self, node : NodeBase):
+        await self._wait_metadata_loaded()
+        if node.id in self._revalidate_ids:
+            self._revalidate_ids.discard(node.id)
+            if node.lastUpdate is not None:
+                self._refresh_in_background(node)
                 return
+        freshness = self._get_freshness(node)
+        if isinstance(node, DirNode):
+            self._record_prefetch_outcome(node, freshness)
+        if freshness == CacheFreshness.FRESH:
+            return
+        if freshness == CacheFreshness.STALE:
+            self._refresh_in_background(node)
+            return
+        await self._do_refresh(node)
+
+    def _refresh_without_waiting(self, node : NodeBase) -> None:
+        # 不等待网络：缓存不新鲜时只在后台刷新，调用方直接使用现有数据；元数据缓存还在加载时等它加载完再说
+        if not self._start_metadata_load():
+            return
+        if node.id in self._revalidate_ids or self._get_freshness(node) != CacheFreshness.FRESH:
+            self._revalidate_ids.discard(node.id)
+            self._refresh_in_background(node, ApiPriority.INTERACTIVE)
+
+    async def _do_refresh(self, node : NodeBase):
+        await self._refresh_flights.Do(node.id, lambda: self._fetch_node(node))
+
+    async def _fetch_node(self, node : NodeBase, on_page : Callable[[list[NodeBase]], None] = None):
+        if isinstance(node, DirNode):
+            # 每收到一页就更新目录树，全部收完后再摘除已不存在的子节点
             next_page_token : str = None
-            children_info : list[Dict[str, Any]] = []
+            seen_ids : set[str] = set()
             while True:
-                dir_info : Dict[str, Any] = await self._pikpak_client.file_list(parent_id = node.id, next_page_token=next_page_token)
+                dir_info : Dict[str, Any] = await self._api.file_list(parent_id = node.id, next_page_token=next_page_token)
                 next_page_token = dir_info["next_page_token"]
-                children_info.extend(dir_info["files"])
+                page : list[NodeBase] = []
+                for child_info in dir_info["files"]:
+                    child = await self._merge_child(node, child_info)
+                    seen_ids.add(child.id)
+                    page.append(child)
+                if on_page is not None:
+                    on_page(page)
                 if next_page_token is None or next_page_token == "":
                     break
-            
-            node.children_id.clear()
-            for child_info in children_info:
-                id : str = child_info["id"]
-                name : str = child_info["name"]
-                
-                child : NodeBase = await self._get_node_by_id(id)
-                if child is None:
-                    if child_info["kind"].endswith("folder"):
-                        child = DirNode(id, name, node.id)
-                    else:
-                        child = FileNode(id, name, node.id)
-                child.name = name
-                child._father_id = node.id
-                await self._add_node(child)
+
+            removed_ids = node._retain_children(seen_ids)
+            if len(removed_ids) > 0:
+                # 脱离目录树的节点不能再用缓存的路径
+                self._path_epoch += 1
+            for child_id in removed_ids:
+                if self._name_index is not None:
+                    self._name_index.Remove(child_id)
         elif isinstance(node, FileNode):
-            result = await self._pikpak_client.get_download_url(node.id)
-            node.url = result["web_content_link"]
-        
-        node.lastUpdate = datetime.now()
+            result = await self._get_download_info(node.id)
+            self._file_urls[node.id] = (result["web_content_link"], self._parse_url_expire(result), time.time())
+            return
+
+        node.lastUpdate = time.time()
+        self._persist_dir(node)
+
+    async def _merge_child(self, father : DirNode, child_info : Dict[str, Any]) -> NodeBase:
+        # 把API返回的一个子节点合并进目录树
+        id : str = child_info["id"]
+        name : str = child_info["name"]
+
+        child : NodeBase = await self._get_node_by_id(id)
+        if child is not None and child._father_id == father.id:
+            # 已经在这个目录下(重新列目录时的常见情况)：原地更新，只有改名时才改动名字索引
+            if child.name != name:
+                father._remove_child(child.id, child.name)
+                child.name = name
+                self._path_epoch += 1
+                if self._name_index is not None:
+                    self._name_index.Add(child.id, name)
+            father._add_child(child.id, child.name)
+            self._apply_file_info(child, child_info)
+            return child
+        if child is None:
+            if child_info["kind"].endswith("folder"):
+                child = DirNode(id, name, father.id)
+            else:
+                child = FileNode(id, name, father.id)
+        else:
+            # 节点被移动到了当前目录，先从旧父节点的索引中摘除
+            old_father = await self._get_father_node(child)
+            if isinstance(old_father, DirNode) and old_father is not father:
+                old_father._remove_child(child.id, child.name)
+            self._path_epoch += 1
+        child.name = name
+        child._father_id = father.id
+        self._apply_file_info(child, child_info)
+        await self._add_node(child)
+        return child
+
+    async def _list_children_filtered(self, node : DirNode, filters : Dict[str, Any]) -> list[NodeBase]:
+        # 由服务端过滤后列出子节点；结果只是目录的一部分，所以只合并节点，不更新目录的刷新时间
+        children : list[NodeBase] = []
+        next_page_token : str = None
+        while True:
+            dir_info : Dict[str, Any] = await self._api.file_list(parent_id = node.id, next_page_token = next_page_token, additional_filters = filters)
+            next_page_token = dir_info["next_page_token"]
+            for child_info in dir_info["files"]:
+                children.append(await self._merge_child(node, child_info))
+            if next_page_token is None or next_page_token == "":
+                break
+        return children
+
+    def _apply_file_info(self, node : NodeBase, info : Dict[str, Any]) -> None:
+        # 从API返回的文件信息中取出大小、修改时间和哈希
+        modified_time = node.modified_time
+        if info.get("modified_time"):
+            try:
+                modified_time = datetime.fromisoformat(info["modified_time"]).timestamp()
+            except ValueError:
+                pass
+        if isinstance(node, FileNode):
+            size = info.get("size")
+            node._set_meta(int(size) if size not in (None, "") else None, modified_time, info.get("hash") or None)
+        else:
+            node.modified_time = modified_time
+
+    async def _get_download_info(self, file_id : str) -> Dict[str, Any]:
+        # PikPakApi.get_download_url把captcha_token存在共享的client上，并发调用时会互相覆盖，
+        # 所以这里每个请求单独携带自己的captcha_token；其余请求头在每次重试时重新生成
+        client = self._api
+        captcha = await client.captcha_init(action = f"GET:/drive/v1/files/{file_id}")
+        headers = RequestHeaders(self._pikpak_client, captcha.get("captcha_token"))
+        return await client._make_request("get", f"https://{PikPakApi.PIKPAK_API_HOST}/drive/v1/files/{file_id}", headers = headers)
+
+    def _file_url(self, node : FileNode) -> str:
+        link = self._file_urls.get(node.id)
+        return link[0] if link is not None else None
+
+    def _parse_url_expire(self, info : Dict[str, Any]) -> float:
+        link : Dict[str, Any] = info.get("links", {}).get("application/octet-stream", {})
+        expire = link.get("expire")
+        if expire:
+            try:
+                return datetime.fromisoformat(expire).timestamp()
+            except ValueError:
+                pass
+        query = parse_qs(urlparse(info.get("web_content_link") or "").query)
+        for key in ("expire", "e"):
+            if key in query:
+                try:
+                    return float(query[key][0])
+                except ValueError:
+                    pass
+        return time.time() + DEFAULT_URL_LIFETIME
 
     async def _path_to_node(self, path : str) -> NodeBase:
         father, son_name = await self._path_to_father_node_and_son_name(path)
@@ -192,7 +825,7 @@ class PikPakFileSystem:
             return await self._find_child_in_dir_by_name(father, son_name)
         return None
 
-    async def _path_to_father_node_and_son_name(self, path : str) -> tuple[NodeBase, str]:
+    async def _path_to_father_node_and_son_name(self, path : str, cached_only : bool = False) -> tuple[NodeBase, str]:
         path_walker : PikPakFileSystem.PathWalker = PikPakFileSystem.PathWalker(path)
         father : NodeBase = None
         son_name : str = None
@@ -209,7 +842,10 @@ class PikPakFileSystem:
             if not isinstance(current, DirNode):
                 current = None
                 continue
-            await self._refresh(current)
+            if cached_only:
+                self._refresh_without_waiting(current)
+            else:
+                await self._refresh(current)
             if spot == ".":
                 continue
             sonName = spot
@@ -221,29 +857,137 @@ class PikPakFileSystem:
         
         return father, sonName
 
+    def _cached_path(self, node : NodeBase, attached_only : bool = False) -> str:
+        # 返回节点的绝对路径(根目录为"")，同时更新目录的深度；只重新计算缓存已失效的那一段祖先，文件的路径由所在目录拼接。
+        # 重新计算时顺便检查是否还挂在目录树上，只缓存挂在树上的目录(节点脱离目录树时纪元也会加一，所以缓存有效就说明还在树上)；
+        # attached_only为True时，节点已脱离目录树则返回None
+        if isinstance(node, FileNode):
+            father = self._root if node._father_id == self._root.id else self._nodes.get(node._father_id)
+            if not isinstance(father, DirNode):
+                return None if attached_only else "/" + node.name
+            if attached_only and not father._has_child(node.id, node.name):
+                return None
+            father_path = self._cached_path(father, attached_only)
+            return father_path + "/" + node.name if father_path is not None else None
+        chain : list[DirNode] = []
+        current = node
+        attached = True
+        while current is not self._root and current._path_epoch != self._path_epoch:
+            chain.append(current)
+            father = self._root if current._father_id == self._root.id else self._nodes.get(current._father_id)
+            if not isinstance(father, DirNode):
+                # 父节点还没加载，暂时按挂在根目录下处理
+                current = self._root
+                attached = False
+                break
+            attached = attached and father._has_child(current.id, current.name)
+            current = father
+        if attached_only and not attached:
+            return None
+        path, depth = current._path, current._depth
+        for item in reversed(chain):
+            path, depth = path + "/" + item.name, depth + 1
+            if attached:
+                item._path, item._depth, item._path_epoch = path, depth, self._path_epoch
+        return path
+
+    async def _resolve_paths(self, paths : list[str], result : BatchResult) -> list[tuple[str, NodeBase]]:
+        # 并发解析多个路径，最后一级可以是通配符；解析失败的路径记入result.failed，同一个节点只返回一次
+        semaphore = asyncio.Semaphore(PATH_RESOLVE_CONCURRENCY)
+
+        async def _resolve(path : str) -> list[tuple[str, NodeBase]]:
+            async with semaphore:
+                # 去掉空的路径段(末尾的/和连续的//)，否则最后一级会是空名字；最后一级为空时和_path_to_node一样指目录本身
+                normalized = ("/" if path.startswith("/") else "") + "/".join(spot for spot in path.split("/") if spot != "")
+                father, son_name = await self._path_to_father_node_and_son_name(normalized)
+                if son_name and any(char in son_name for char in "*?["):
+                    matched = [child for child in await self.GetChildren(father) if child is not None and fnmatch.fnmatchcase(child.name, son_name)]
+                    if len(matched) == 0:
+                        result.failed.append((path, "no match"))
+                    return [(await self._node_to_path(child), child) for child in matched]
+                if not son_name:
+                    node = father
+                else:
+                    node = await self._find_child_in_dir_by_name(father, son_name) if isinstance(father, DirNode) else None
+                if node is None:
+                    result.failed.append((path, "not found"))
+                    return []
+                return [(path, node)]
+
+        resolved : Dict[str, tuple[str, NodeBase]] = {}
+        for items in await asyncio.gather(*[_resolve(path) for path in paths]):
+            for path, node in items:
+                resolved.setdefault(node.id, (path, node))
+        return list(resolved.values())
+
+    async def _run_in_batches(self, items : list[tuple[str, NodeBase]], operation : Callable[[list[str]], Any], result : BatchResult) -> list[tuple[str, NodeBase]]:
+        # 按BATCH_OPERATION_SIZE分批并发调用operation，返回成功的部分；某一批失败不影响其他批
+        batches = [items[start:start + BATCH_OPERATION_SIZE] for start in range(0, len(items), BATCH_OPERATION_SIZE)]
+
+        async def _run(batch : list[tuple[str, NodeBase]]) -> list[tuple[str, NodeBase]]:
+            try:
+                await operation([node.id for _, node in batch])
+            except Exception as e:
+                logging.error(f"batch operation failed, exception occurred: {e}")
+                result.failed.extend((path, str(e)) for path, _ in batch)
+                return []
+            result.succeeded.extend(path for path, _ in batch)
+            return batch
+
+        done : list[tuple[str, NodeBase]] = []
+        for batch in await asyncio.gather(*[_run(batch) for batch in batches]):
+            done.extend(batch)
+        return done
+
+    async def _move_in_tree(self, node : NodeBase, new_father : DirNode, new_name : str = None) -> None:
+        # 服务端已经完成移动或改名，直接修改本地目录树而不重新列目录
+        old_father = await self._get_father_node(node)
+        if isinstance(old_father, DirNode):
+            old_father._remove_child(node.id, node.name)
+        node._father_id = new_father.id
+        if new_name is not None:
+            node.name = new_name
+        await self._add_node(node)
+        self._path_epoch += 1
+        self._persist_nodes([node])
+
     async def _node_to_path(self, node : NodeBase, root : NodeBase = None) -> str:
         if root is None:
             root = self._root
         if node is root:
             return "/"
-        spots : list[str] = []
-        current = node
-        while current is not root:
-            spots.append(current.name)
-            current = await self._get_father_node(current)
-        spots.append("")
-        return "/".join(reversed(spots))
-    
+        if root is not self._root and not await self._is_ancestors_of(root, node):
+            raise Exception("Not an ancestor")
+        # 相对路径就是去掉root自身路径后的部分
+        return self._cached_path(node)[len(self._cached_path(root)):]
+
     async def _is_ancestors_of(self, node_a : NodeBase, node_b : NodeBase) -> bool:
-        if node_b is node_a:
+        if node_b is node_a or not isinstance(node_a, DirNode):
             return False
         if node_a is self._root:
             return True
-        while node_b._father_id != self._root.id:
+        if isinstance(node_b, FileNode):
+            # 文件没有缓存深度，改为判断它所在的目录
+            father = await self._get_father_node(node_b)
+            return father is node_a or (isinstance(father, DirNode) and await self._is_ancestors_of(node_a, father))
+        path_a, path_b = self._cached_path(node_a, True), self._cached_path(node_b, True)
+        if path_a is None or path_b is None:
+            # 脱离目录树的节点深度没有更新，不能用来剪枝，直接沿父节点上溯(记录走过的节点以防成环)
+            visited : set[str] = set()
+            while node_b is not None and node_b is not self._root and node_b.id not in visited:
+                visited.add(node_b.id)
+                node_b = await self._get_father_node(node_b)
+                if node_b is node_a:
+                    return True
+            return False
+        # 深度或路径前缀对不上时一定不是祖先；对上时(同名兄弟目录可能误判)再沿父节点上溯确认
+        if node_b._depth <= node_a._depth or not path_b.startswith(path_a + "/"):
+            return False
+        for _ in range(node_b._depth - node_a._depth):
             node_b = await self._get_father_node(node_b)
-            if node_b is node_a:
-                return True
-        return False
+            if node_b is None:
+                return False
+        return node_b is node_a
     #endregion
 
     #endregion
@@ -274,50 +1018,236 @@ class PikPakFileSystem:
         if not isinstance(node, FileNode):
             return None
         await self._refresh(node)
-        return node.url
+        return self._file_url(node)
 
     async def GetFileUrlByPath(self, path : str) -> str:
         node = await self._path_to_node(path)
         if not isinstance(node, FileNode):
             return None
         await self._refresh(node)
-        return node.url
+        return self._file_url(node)
+
+    async def ResolveFileUrls(self, node_ids : list[str], max_concurrency : int = URL_RESOLVE_CONCURRENCY) -> Dict[str, str]:
+        # 并发获取一批文件的下载链接，仍然有效的链接直接使用缓存
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def _resolve(node_id : str) -> str:
+            node = await self._get_node_by_id(node_id)
+            if not isinstance(node, FileNode):
+                return None
+            async with semaphore:
+                try:
+                    await self._refresh(node)
+                except Exception as e:
+                    logging.error(f"failed to resolve url of {node_id}, exception occurred: {e}")
+                    return None
+            return self._file_url(node)
+        urls = await asyncio.gather(*[_resolve(node_id) for node_id in node_ids])
+        return dict(zip(node_ids, urls))
+
+    async def InvalidateFileUrl(self, node_id : str) -> None:
+        node = await self._get_node_by_id(node_id)
+        if not isinstance(node, FileNode):
+            return
+        self._forget_update(node)
+
+    async def CompletePath(self, path : str, ignore_files : bool) -> tuple[str, list[tuple[str, bool]]]:
+        # 只使用内存中的目录树补全路径，返回(待补全的名字, [(候选名字, 是否目录)])；
+        # 未加载或已过期的目录在后台刷新，下次补全时生效；元数据缓存还在后台加载时不等待，直接返回空
+        if not self._start_metadata_load():
+            return PikPakFileSystem.PathWalker(path).Walk()[-1], []
+        father, son_name = await self._path_to_father_node_and_son_name(path, cached_only = True)
+        if not isinstance(father, DirNode):
+            return son_name, []
+        self._after_interactive_listing(father)
+        candidates : list[tuple[str, bool]] = []
+        for name in father._names_with_prefix(son_name):
+            child = self._nodes.get(father._child_id(name))
+            if child is None:
+                continue
+            is_dir = isinstance(child, DirNode)
+            if ignore_files and not is_dir:
+                continue
+            candidates.append((name, is_dir))
+        return son_name, candidates
 
     async def GetChildrenNames(self, path : str, ignore_files : bool) -> list[str]:
         node = await self._path_to_node(path)
         if not isinstance(node, DirNode):
             return []
         await self._refresh(node)
+        self._after_interactive_listing(node)
         children_names : list[str] = []
-        for child_id in node.children_id:
+        for child_id in list(node._child_ids()):
             child = await self._get_node_by_id(child_id)
             if ignore_files and isinstance(child, FileNode):
                 continue
             children_names.append(child.name)
         return children_names
 
-    async def Delete(self, paths : list[str]) -> None:
-        nodes = [await self._path_to_node(path) for path in paths]
-        for node in nodes:
-            if await self._is_ancestors_of(node, self._cwd):
-                raise Exception("Cannot delete ancestors")
-        await self._pikpak_client.delete_to_trash([node.id for node in nodes])
-        for node in nodes:
+    async def ListChildrenNames(self, path : str, ignore_files : bool) -> AsyncIterator[list[str]]:
+        # 按页产出子节点名字；需要从网络加载时每收到一页就产出一页，不必等整个目录加载完
+        node = await self._path_to_node(path)
+        if not isinstance(node, DirNode):
+            return
+
+        def _names(children : list[NodeBase]) -> list[str]:
+            return [child.name for child in children if child is not None and not (ignore_files and isinstance(child, FileNode))]
+
+        await self._wait_metadata_loaded()
+        freshness = self._get_freshness(node)
+        if freshness == CacheFreshness.EXPIRED and node.id not in self._revalidate_ids and not self._refresh_flights.InFlight(node.id):
+            self._record_prefetch_outcome(node, freshness)
+            pages : asyncio.Queue[list[NodeBase]] = asyncio.Queue()
+            fetch = asyncio.ensure_future(self._refresh_flights.Do(node.id, lambda: self._fetch_node(node, pages.put_nowait)))
+            fetch.add_done_callback(lambda _: pages.put_nowait(None))
+            try:
+                while (page := await pages.get()) is not None:
+                    if len(names := _names(page)) > 0:
+                        yield names
+                await fetch
+            finally:
+                fetch.cancel()
+        else:
+            await self._refresh(node)
+            children = [await self._get_node_by_id(child_id) for child_id in list(node._child_ids())]
+            for start in range(0, len(children), LIST_PAGE_SIZE):
+                if len(names := _names(children[start:start + LIST_PAGE_SIZE])) > 0:
+                    yield names
+        self._after_interactive_listing(node)
+
+    async def Delete(self, paths : list[str]) -> BatchResult:
+        result = BatchResult()
+        targets : list[tuple[str, NodeBase]] = []
+        for path, node in await self._resolve_paths(paths, result):
+            if node is self._cwd or await self._is_ancestors_of(node, self._cwd):
+                result.failed.append((path, "cannot delete ancestors of the current directory"))
+                continue
+            targets.append((path, node))
+        deleted = await self._run_in_batches(targets, self._api.delete_to_trash, result)
+        for _, node in deleted:
             await self._remove_node(node)
-    
+        self._unpersist_nodes([node for _, node in deleted])
+        return result
+
+    async def Move(self, paths : list[str], target_path : str) -> BatchResult:
+        result = BatchResult()
+        target = await self._path_to_node(target_path)
+        if not isinstance(target, DirNode):
+            raise Exception("Target is not a directory")
+        sources : list[tuple[str, NodeBase]] = []
+        for path, node in await self._resolve_paths(paths, result):
+            if node is target or node._father_id == target.id:
+                result.failed.append((path, "already in target directory"))
+                continue
+            if await self._is_ancestors_of(node, target):
+                result.failed.append((path, "cannot move a directory into itself"))
+                continue
+            sources.append((path, node))
+        moved = await self._run_in_batches(sources, lambda ids: self._api.file_batch_move(ids, target.id), result)
+        conflicted = False
+        for _, node in moved:
+            # 目标目录里有同名节点时服务端可能自动改名，此时重新列一次目标目录
+            conflicted = conflicted or node.name in target.children
+            await self._move_in_tree(node, target)
+        if conflicted:
+            await self._invalidate(target, False)
+        return result
+
+    async def Copy(self, paths : list[str], target_path : str) -> BatchResult:
+        result = BatchResult()
+        target = await self._path_to_node(target_path)
+        if not isinstance(target, DirNode):
+            raise Exception("Target is not a directory")
+        sources : list[tuple[str, NodeBase]] = []
+        for path, node in await self._resolve_paths(paths, result):
+            if node is target or await self._is_ancestors_of(node, target):
+                result.failed.append((path, "cannot copy a directory into itself"))
+                continue
+            sources.append((path, node))
+        copied = await self._run_in_batches(sources, lambda ids: self._api.file_batch_copy(ids, target.id), result)
+        # 复制出的节点id由服务端生成，只能让目标目录下次访问时重新列出
+        if len(copied) > 0:
+            await self._invalidate(target, False)
+        return result
+
+    async def Rename(self, path : str, new_name : str) -> None:
+        node = await self._path_to_node(path)
+        if node is None:
+            raise Exception("File not found")
+        if node is self._root:
+            raise Exception("Cannot rename root")
+        info = await self._api.file_rename(node.id, new_name)
+        await self._move_in_tree(node, await self._get_father_node(node), info.get("name") or new_name)
+
     async def MakeDir(self, path : str) -> None:
         father, son_name = await self._path_to_father_node_and_son_name(path)
-        result = await self._pikpak_client.create_folder(son_name, father.id)
+        result = await self._api.create_folder(son_name, father.id)
         id = result["file"]["id"]
         name = result["file"]["name"]
         son = DirNode(id, name, father.id)
         await self._add_node(son)
+        self._persist_nodes([son])
+        await self._invalidate(father, False)
+
+    async def EnsureDir(self, path : str) -> DirNode:
+        # 逐级创建不存在的目录(类似mkdir -p)，返回最后一级目录
+        current : DirNode = self._root if path.startswith("/") else self._cwd
+        for name in [spot for spot in path.split("/") if spot not in ("", ".")]:
+            if name == "..":
+                current = await self._get_father_node(current)
+                continue
+            await self._refresh(current)
+            child = await self._find_child_in_dir_by_name(current, name)
+            if child is None:
+                father = current
+                child = await self._make_dir_flights.Do((father.id, name), lambda: self._make_dir_in(father, name))
+            if not isinstance(child, DirNode):
+                raise Exception(f"{name} is not a directory")
+            current = child
+        return current
+
+    async def _make_dir_in(self, father : DirNode, name : str) -> DirNode:
+        existing = await self._find_child_in_dir_by_name(father, name)
+        if existing is not None:
+            return existing
+        result = await self._api.create_folder(name, father.id)
+        son = DirNode(result["file"]["id"], result["file"]["name"], father.id)
+        await self._add_node(son)
+        self._persist_nodes([son])
+        return son
+
+    async def CreateUpload(self, father : DirNode, name : str, size : int, gcid : str) -> tuple[Dict[str, Any], Dict[str, Any]]:
+        # 在PikPak上创建待上传的文件，返回(文件信息, OSS上传凭证)；服务端已有相同gcid的文件(秒传)时凭证为None
+        data = {
+            "kind": "drive#file",
+            "name": name,
+            "size": str(size),
+            "hash": gcid,
+            "upload_type": "UPLOAD_TYPE_RESUMABLE",
+            "objProvider": {"provider": "UPLOAD_TYPE_UNKNOWN"},
+            "parent_id": father.id,
+            "folder_type": "NORMAL",
+        }
+        result = await self._api._request_post(f"https://{PikPakApi.PIKPAK_API_HOST}/drive/v1/files", data)
+        resumable = result.get("resumable")
+        return result["file"], resumable.get("params") if resumable else None
+
+    async def FinishUpload(self, father_id : str, file_info : Dict[str, Any]) -> NodeBase:
+        # 上传完成后直接把文件合并进目录树，不重新列目录
+        father = await self._get_node_by_id(father_id)
+        if not isinstance(father, DirNode):
+            return None
+        node = await self._merge_child(father, file_info)
+        self._persist_nodes([node])
+        return node
 
     async def SetCwd(self, path : str) -> None:
         node = await self._path_to_node(path)
         if not isinstance(node, DirNode):
             raise Exception("Not a directory")
         self._cwd = node
+        await self._refresh(node)
+        self._after_interactive_listing(node)
 
     async def GetCwd(self) -> str:
         return await self._node_to_path(self._cwd)
@@ -326,7 +1256,130 @@ class PikPakFileSystem:
         if not isinstance(node, DirNode):
             return []
         await self._refresh(node)
-        return [await self._get_node_by_id(child_id) for child_id in node.children_id]
+        return [await self._get_node_by_id(child_id) for child_id in list(node._child_ids())]
+
+    async def Walk(self, node : NodeBase, max_concurrency : int = 8, include_dirs : bool = False) -> AsyncIterator[tuple[str, NodeBase]]:
+        # 并发遍历node下的整棵子树，边遍历边产出(相对node的路径, 节点)
+        async for item in self._walk(node, self.GetChildren, max_concurrency, include_dirs):
+            yield item
+
+    async def _walk(self, node : NodeBase, list_children : Callable[[DirNode], Any], max_concurrency : int, include_dirs : bool) -> AsyncIterator[tuple[str, NodeBase]]:
+        # 调用方提前关闭生成器时取消所有工作协程，不再发出新的请求
+        if not isinstance(node, DirNode):
+            return
+        dirs : asyncio.Queue[tuple[DirNode, str]] = asyncio.Queue()
+        results : asyncio.Queue = asyncio.Queue(maxsize = 1024)
+        pending_number = 1
+        dirs.put_nowait((node, ""))
+
+        async def _worker():
+            nonlocal pending_number
+            while True:
+                current, current_path = await dirs.get()
+                try:
+                    for child in await list_children(current):
+                        if child is None:
+                            continue
+                        # 子路径由父路径增量拼接，不再逐个回溯祖先
+                        child_path = current_path + "/" + child.name
+                        if isinstance(child, DirNode):
+                            pending_number += 1
+                            dirs.put_nowait((child, child_path))
+                            if not include_dirs:
+                                continue
+                        await results.put((child_path, child))
+                except Exception as e:
+                    await results.put(e)
+                finally:
+                    pending_number -= 1
+                    if pending_number == 0:
+                        await results.put(None)
+
+        workers = [asyncio.create_task(_worker()) for _ in range(max(1, max_concurrency))]
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def Find(self, path : str, name : str = None, min_size : int = None, max_size : int = None, kind : str = None,
+                   limit : int = None, max_concurrency : int = 8) -> AsyncIterator[tuple[str, NodeBase]]:
+        # 在path下查找名字匹配通配符name(不区分大小写)、大小和类型("file"或"dir")都符合的节点，边找边产出(绝对路径, 节点)，
+        # 找到limit个后停止遍历
+        if kind not in (None, "file", "dir"):
+            raise ValueError(f"unknown kind {kind}")
+        node = await self._path_to_node(path)
+        if not isinstance(node, DirNode):
+            return
+        base_path = await self._node_to_path(node)
+        if base_path == "/":
+            base_path = ""
+        pattern = name.lower() if name is not None else None
+
+        async def _list_children(current : DirNode) -> list[NodeBase]:
+            # 只找目录时可以让服务端只返回目录，但缓存仍然新鲜时直接用缓存
+            if kind == "dir" and self._get_freshness(current) != CacheFreshness.FRESH:
+                return await self._list_children_filtered(current, {"kind": {"eq": "drive#folder"}})
+            return await self.GetChildren(current)
+
+        def _match(child : NodeBase) -> bool:
+            if kind == "file" and not isinstance(child, FileNode):
+                return False
+            if kind == "dir" and not isinstance(child, DirNode):
+                return False
+            if pattern is not None and not fnmatch.fnmatchcase(child.name.lower(), pattern):
+                return False
+            if min_size is not None or max_size is not None:
+                size = child.size if isinstance(child, FileNode) else None
+                if size is None:
+                    return False
+                if min_size is not None and size < min_size:
+                    return False
+                if max_size is not None and size > max_size:
+                    return False
+            return True
+
+        found = 0
+        walker = self._walk(node, _list_children, max_concurrency, True)
+        try:
+            async for child_path, child in walker:
+                if not _match(child):
+                    continue
+                yield base_path + child_path, child
+                found += 1
+                if limit is not None and found >= limit:
+                    break
+        finally:
+            await walker.aclose()
+
+    async def Search(self, query : str, limit : int = 50) -> list[tuple[str, NodeBase]]:
+        # 只在本地已加载的目录树中按名字搜索，不发网络请求；返回按匹配程度排序的(绝对路径, 节点)
+        await self._wait_metadata_loaded()
+        if self._name_index is None:
+            self._name_index = NameIndex()
+            for node in self._nodes.values():
+                self._name_index.Add(node.id, node.name)
+        while True:
+            results : list[tuple[str, NodeBase]] = []
+            detached_ids : list[str] = []
+            for id in self._name_index.Search(query, limit):
+                node = self._nodes.get(id)
+                path = self._cached_path(node, True) if node is not None else None
+                if path is None:
+                    detached_ids.append(id)
+                    continue
+                results.append((path, node))
+            if len(detached_ids) == 0:
+                return results
+            # 已经脱离目录树的节点(例如所在目录被删除)顺便移出索引，再搜一次补足数量
+            for id in detached_ids:
+                self._name_index.Remove(id)
 
     async def PathToNode(self, path : str) -> NodeBase:
         node = await self._path_to_node(path)
@@ -339,16 +1392,54 @@ class PikPakFileSystem:
 
     async def RemoteDownload(self, torrent : str, remote_base_path : str) -> tuple[str, str]:
         node = await self._path_to_node(remote_base_path)
-        info = await self._pikpak_client.offline_download(torrent, node.id)
+        info = await self._api.offline_download(torrent, node.id)
         return info["task"]["file_id"], info["task"]["id"]
 
     async def QueryTaskStatus(self, task_id : str, node_id : str) -> DownloadStatus:
-        return await self._pikpak_client.get_task_status(task_id, node_id)
+        return await self._api.get_task_status(task_id, node_id)
+
+    async def ListOfflineTasks(self) -> Dict[str, Dict[str, Any]]:
+        # 列出所有未完成或失败的离线任务，按任务id索引
+        tasks : Dict[str, Dict[str, Any]] = {}
+        page_token = None
+        while True:
+            result = await self._api.offline_list(size = LIST_PAGE_SIZE, next_page_token = page_token, phase = OFFLINE_ACTIVE_PHASES)
+            for task in result.get("tasks", []):
+                tasks[task["id"]] = task
+            page_token = result.get("next_page_token")
+            if not page_token:
+                return tasks
+
+    async def QueryOfflineFile(self, node_id : str) -> DownloadStatus:
+        # 离线任务不在进行中的列表里之后，根据保存的文件是否存在判断是否完成
+        try:
+            info = await self._api.offline_file_info(file_id = node_id)
+        except PikpakException:
+            return DownloadStatus.error
+        if not info:
+            return DownloadStatus.not_found
+        # 文件存在但还没写完(例如任务刚离开进行中的列表)时不算完成
+        return DownloadStatus.done if info.get("phase") == "PHASE_TYPE_COMPLETE" else DownloadStatus.not_found
     
+    async def Invalidate(self, path : str, recursive : bool = False) -> None:
+        node = await self._path_to_node(path)
+        if node is None:
+            return
+        await self._invalidate(node, recursive)
+
+    def GetPrefetchStats(self) -> Dict[str, int]:
+        return dict(self._prefetch_stats)
+
+    async def InvalidateNode(self, node_id : str, recursive : bool = False) -> None:
+        node = await self._get_node_by_id(node_id)
+        if node is None:
+            return
+        await self._invalidate(node, recursive)
+
     async def UpdateNode(self, node_id : str) -> NodeBase:
         node : NodeBase = await self._get_node_by_id(node_id)
         if node is None:
-            info = await self._pikpak_client.offline_file_info(node_id)
+            info = await self._api.offline_file_info(node_id)
             kind = info["kind"]
             parent_id = info["parent_id"]
             name = info["name"]
@@ -356,8 +1447,10 @@ class PikPakFileSystem:
                 node = DirNode(node_id, name, parent_id)    
             else:
                 node = FileNode(node_id, name, parent_id)
+            self._apply_file_info(node, info)
             await self._add_node(node)
-        node.lastUpdate = None
+            self._persist_nodes([node])
+        self._forget_update(node)
         return node
 
     #endregion
\ No newline at end of file
@@ -0,0 +1,34 @@
+import json
+import logging
+import os
+from typing import Any, Dict
+
+class SyncManifest:
+    # 记录每个同步目录上次同步完成时各文件的远程元数据，保存为JSON：
+    # {同步根节点id: {下载路径: {"id", "size", "mtime", "hash"}}}
+    def __init__(self, path : str):
+        self._path : str = path
+        self._manifests : Dict[str, Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        if self._manifests is not None:
+            return self._manifests
+        self._manifests = {}
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, "r", encoding = "utf-8") as file:
+                    self._manifests = json.load(file)
+            except Exception as e:
+                logging.error(f"failed to load sync manifest, exception occurred: {e}")
+        return self._manifests
+
+    def Get(self, root_id : str) -> Dict[str, Dict[str, Any]]:
+        return dict(self._load().get(root_id, {}))
+
+    def Set(self, root_id : str, entries : Dict[str, Dict[str, Any]]) -> None:
+        self._load()[root_id] = entries
+        # 先写临时文件再替换，避免写到一半崩溃后清单损坏
+        temp_path = self._path + ".tmp"
+        with open(temp_path, "w", encoding = "utf-8") as file:
+            json.dump(self._manifests, file, ensure_ascii = False)
+        os.replace(temp_path, self._path)
@@ -1,15 +1,46 @@
 from enum import Enum
-from typing import Awaitable, Callable, Dict
+from typing import Any, Awaitable, Callable, Dict
 import asyncio
 import logging
+import os
 import shortuuid
-from PikPakFileSystem import PikPakFileSystem, FileNode, DirNode
-from aria2helper import Aria2Status, addUri, tellStatus, pause, unpause
+from PikPakFileSystem import PikPakFileSystem, NodeBase, FileNode, DirNode
+from PikPakApiLimiter import ApiPriority, ApiPriorityScope
+from aria2helper import Aria2Status, Aria2Client, Aria2Monitor
 from pikpakapi import DownloadStatus
 import random
-import pickle
+import time
+import heapq
+import itertools
+from collections import deque
+from TaskStore import TaskStore
+from OssUploader import OssUploader, OssError, ComputeGcid, PartSize
+from SyncManifest import SyncManifest
+from HttpDownloader import HttpDownloader, HttpDownloadError
+from TransferBudget import TransferBudget, TransferGate, BudgetLimits
+from OfflineTaskMonitor import OfflineTaskMonitor
 
-DB_PATH = "task.db"
+DB_PATH = "task.sqlite3"
+# 旧版本整体pickle保存的任务文件，启动时自动导入
+LEGACY_DB_PATH = "task.db"
+SYNC_MANIFEST_PATH = "sync_manifest.json"
+# 文件下载引擎：外部的aria2，或者内置的HTTP下载器(下载到HTTP_DOWNLOAD_PATH)
+ENGINE_ARIA2 = "aria2"
+ENGINE_HTTP = "http"
+HTTP_DOWNLOAD_PATH = "downloads"
+WALK_CONCURRENCY = 8
+# 派发文件下载时在后台预先获取下载链接的任务数：链接在快要用到时才获取，不会提前太久而过期
+URL_LOOKAHEAD = 8
+# 链接失效导致的aria2错误，重新获取链接后最多重试的次数
+MAX_DEAD_LINK_RETRY = 3
+# aria2中表示链接失效的错误码：资源不存在、HTTP响应异常（如403）、鉴权失败
+DEAD_LINK_ERROR_CODES = {"3", "22", "24"}
+# 就绪队列的调度策略：同一优先级内在各个所属任务之间轮转，轮到的任务内部按先后、文件大小或截止时间排序；
+# deadline策略下有截止时间的任务优先于轮转
+SCHEDULE_FAIR = "fair"
+SCHEDULE_SMALLEST = "smallest"
+SCHEDULE_DEADLINE = "deadline"
+SCHEDULE_POLICIES = [SCHEDULE_FAIR, SCHEDULE_SMALLEST, SCHEDULE_DEADLINE]
 
 class TaskStatus(Enum):
     PENDING = "pending"
@@ -29,15 +60,35 @@ class FileDownloadTaskStatus(Enum):
     DOWNLOADING = "downloading"
     DONE = "done"
 
+class UploadTaskStatus(Enum):
+    PENDING = "pending"
+    UPLOADING = "uploading"
+    DONE = "done"
+
 class TaskBase:
     TAG = ""
     MAX_CONCURRENT_NUMBER = 5
 
     def __init__(self):
+        self.status_listener : Callable[["TaskBase", TaskStatus], None] = None
         self.id : str = shortuuid.uuid() 
         self.status : TaskStatus = TaskStatus.PENDING
         self.worker : asyncio.Task = None
         self.handler : Callable[..., Awaitable] = None
+        # 数值越大越先调度；截止时间为时间戳，None表示没有
+        self.priority : int = 0
+        self.deadline : float = None
+
+    @property
+    def status(self) -> TaskStatus:
+        return self._status
+
+    @status.setter
+    def status(self, status : TaskStatus):
+        old_status = self.__dict__.get("_status")
+        self._status = status
+        if old_status != status and self.status_listener is not None:
+            self.status_listener(self, old_status)
 
     def Resume(self):
         if self.status in {TaskStatus.PAUSED, TaskStatus.ERROR}:
@@ -49,12 +100,20 @@ class TaskBase:
             del state['handler']
         if 'worker' in state:
             del state['worker']
+        if 'status_listener' in state:
+            del state['status_listener']
         return state
 
     def __setstate__(self, state):
+        # 兼容status还是普通属性时保存的任务
+        if 'status' in state:
+            state['_status'] = state.pop('status')
+        state.setdefault('priority', 0)
+        state.setdefault('deadline', None)
         self.__dict__.update(state)
         self.worker = None
         self.handler = None
+        self.status_listener = None
     
 
 class TorrentTask(TaskBase):
@@ -72,6 +131,20 @@ class TorrentTask(TaskBase):
         self.remote_base_path : str = None
         self.node_id : str = None
         self.task_id : str = None
+
+        # 同步模式：只下载新增或变化的文件，local_dir是下载目录在本机的位置，用于校验和删除多余文件
+        self.sync : bool = False
+        self.local_dir : str = None
+        self.delete_orphans : bool = False
+        # 子任务使用的下载引擎，为None时使用TaskManager的默认引擎
+        self.engine : str = None
+
+    def __setstate__(self, state):
+        state.setdefault("engine", None)
+        state.setdefault("sync", False)
+        state.setdefault("local_dir", None)
+        state.setdefault("delete_orphans", False)
+        super().__setstate__(state)
     
 class FileDownloadTask(TaskBase):
     TAG = "FileDownloadTask"
@@ -85,13 +158,229 @@ class FileDownloadTask(TaskBase):
         self.owner_id : str = owner_id
         self.gid : str = None
         self.url : str = None
+        self.aria2_backend : str = None
+        self.engine : str = ENGINE_ARIA2
+        self.info : str = ""
+        # 文件大小，用于折算占用的连接数，未知时为None
+        self.size : int = None
+
+    def __setstate__(self, state):
+        state.setdefault("aria2_backend", None)
+        state.setdefault("engine", ENGINE_ARIA2)
+        state.setdefault("info", "")
+        state.setdefault("size", None)
+        super().__setstate__(state)
+
+class UploadTask(TaskBase):
+    TAG = "UploadTask"
+    MAX_CONCURRENT_NUMBER = 2
+
+    def __init__(self, local_path : str, remote_dir : str):
+        super().__init__()
+        self.upload_status : UploadTaskStatus = UploadTaskStatus.PENDING
+        self.local_path : str = local_path
+        self.remote_dir : str = remote_dir
+        self.size : int = None
+        self.gcid : str = None
+        self.info : str = ""
+
+        # 和PikPak及OSS交互需要的信息，保存下来用于断点续传
+        self.node_id : str = None
+        self.father_id : str = None
+        self.file_info : Dict[str, Any] = None
+        self.oss_params : Dict[str, Any] = None
+        self.upload_id : str = None
+        self.parts : Dict[int, str] = {}
+
+class DeadLinkError(Exception):
+    pass
     
+class TaskRegistry:
+    # 按id、类型、状态、所属任务和node_id建立索引，避免每次查询都扫描全部任务
+    def __init__(self):
+        self._by_id : Dict[str, TaskBase] = {}
+        self._by_tag : Dict[str, Dict[str, TaskBase]] = {}
+        self._by_status : Dict[tuple[str, TaskStatus], Dict[str, TaskBase]] = {}
+        self._by_owner : Dict[str, Dict[str, TaskBase]] = {}
+        self._by_node : Dict[str, Dict[str, TaskBase]] = {}
+        self._owner_status_counts : Dict[str, Dict[TaskStatus, int]] = {}
+        self.on_status_changed : Callable[[TaskBase, TaskStatus], None] = None
+
+    def Add(self, task : TaskBase) -> None:
+        self._by_id[task.id] = task
+        self._by_tag.setdefault(task.TAG, {})[task.id] = task
+        self._by_status.setdefault((task.TAG, task.status), {})[task.id] = task
+        owner_id = getattr(task, "owner_id", None)
+        if owner_id is not None:
+            self._by_owner.setdefault(owner_id, {})[task.id] = task
+            counts = self._owner_status_counts.setdefault(owner_id, {})
+            counts[task.status] = counts.get(task.status, 0) + 1
+        node_id = getattr(task, "node_id", None)
+        if node_id is not None:
+            self._by_node.setdefault(node_id, {})[task.id] = task
+        task.status_listener = self._on_status_changed
+
+    def Get(self, task_id : str) -> TaskBase:
+        return self._by_id.get(task_id)
+
+    def Tags(self) -> list[str]:
+        return list(self._by_tag.keys())
+
+    def ByTag(self, tag : str) -> list[TaskBase]:
+        return list(self._by_tag.get(tag, {}).values())
+
+    def ByStatus(self, tag : str, status : TaskStatus) -> list[TaskBase]:
+        return list(self._by_status.get((tag, status), {}).values())
+
+    def ByOwner(self, owner_id : str) -> list[TaskBase]:
+        return list(self._by_owner.get(owner_id, {}).values())
+
+    def ByNode(self, node_id : str) -> list[TaskBase]:
+        return list(self._by_node.get(node_id, {}).values())
+
+    def CountByOwner(self, owner_id : str) -> Dict[TaskStatus, int]:
+        return dict(self._owner_status_counts.get(owner_id, {}))
+
+    def SetNodeId(self, task : TaskBase, node_id : str) -> None:
+        old_node_id = getattr(task, "node_id", None)
+        if old_node_id == node_id:
+            return
+        if old_node_id is not None:
+            self._by_node.get(old_node_id, {}).pop(task.id, None)
+        task.node_id = node_id
+        if node_id is not None:
+            self._by_node.setdefault(node_id, {})[task.id] = task
+
+    def _on_status_changed(self, task : TaskBase, old_status : TaskStatus) -> None:
+        self._by_status.get((task.TAG, old_status), {}).pop(task.id, None)
+        self._by_status.setdefault((task.TAG, task.status), {})[task.id] = task
+        owner_id = getattr(task, "owner_id", None)
+        if owner_id is not None:
+            counts = self._owner_status_counts.setdefault(owner_id, {})
+            counts[old_status] = counts.get(old_status, 0) - 1
+            counts[task.status] = counts.get(task.status, 0) + 1
+        if self.on_status_changed is not None:
+            self.on_status_changed(task, old_status)
+
+class ReadyQueue:
+    # 一种任务的就绪队列：优先级高的先出队；同一优先级按所属任务分道，各道轮流出队，
+    # 避免一个包含大量文件的任务占满所有槽位。任务重新入队时旧的条目惰性作废
+    def __init__(self, policy : str = SCHEDULE_FAIR):
+        self.policy : str = policy
+        self._lanes : Dict[int, Dict[str, list[tuple[tuple, int, TaskBase]]]] = {}
+        self._rotations : Dict[int, deque[str]] = {}
+        self._entries : Dict[str, tuple[tuple, int, TaskBase]] = {}
+        self._counter = itertools.count()
+        self._changed : asyncio.Event = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, task : TaskBase) -> tuple:
+        if self.policy == SCHEDULE_SMALLEST:
+            size = getattr(task, "size", None)
+            return (size if size is not None else float("inf"),)
+        if self.policy == SCHEDULE_DEADLINE:
+            return (task.deadline if task.deadline is not None else float("inf"),)
+        return ()
+
+    def Put(self, task : TaskBase) -> None:
+        entry = (self._key(task), next(self._counter), task)
+        self._entries[task.id] = entry
+        lanes = self._lanes.setdefault(task.priority, {})
+        owner_id = getattr(task, "owner_id", None) or ""
+        if owner_id not in lanes:
+            lanes[owner_id] = []
+            self._rotations.setdefault(task.priority, deque()).append(owner_id)
+        heapq.heappush(lanes[owner_id], entry)
+        self._changed.set()
+
+    def Discard(self, task : TaskBase) -> None:
+        self._entries.pop(task.id, None)
+
+    def SetPolicy(self, policy : str) -> None:
+        # 按新策略重建所有分道
+        tasks = [task for _, _, task in sorted(self._entries.values(), key = lambda entry: entry[1])]
+        self.policy = policy
+        self._lanes.clear()
+        self._rotations.clear()
+        self._entries.clear()
+        for task in tasks:
+            self.Put(task)
+
+    def _head(self, lane : list[tuple[tuple, int, TaskBase]]) -> tuple[tuple, int, TaskBase]:
+        while len(lane) > 0 and self._entries.get(lane[0][2].id) is not lane[0]:
+            heapq.heappop(lane)
+        return lane[0] if len(lane) > 0 else None
+
+    def _select(self) -> tuple[int, str]:
+        # 返回下一个出队条目所在的(优先级, 分道)，顺便清理作废的条目和空的分道
+        for priority in sorted(self._lanes, reverse = True):
+            lanes = self._lanes[priority]
+            rotation = self._rotations[priority]
+            for owner_id in list(rotation):
+                if self._head(lanes[owner_id]) is None:
+                    del lanes[owner_id]
+                    rotation.remove(owner_id)
+            if len(rotation) == 0:
+                del self._lanes[priority]
+                del self._rotations[priority]
+                continue
+            if self.policy == SCHEDULE_DEADLINE:
+                deadline, owner_id = min((lanes[owner_id][0][0], owner_id) for owner_id in rotation)
+                if deadline[0] != float("inf"):
+                    return priority, owner_id
+            return priority, rotation[0]
+        return None
+
+    def Upcoming(self, count : int) -> list[TaskBase]:
+        # 大致按出队顺序返回接下来的至多count个任务，不改变队列
+        tasks : list[TaskBase] = []
+        for priority in sorted(self._lanes, reverse = True):
+            lanes = self._lanes[priority]
+            heads = [[entry[2] for entry in heapq.nsmallest(count, lanes[owner_id]) if self._entries.get(entry[2].id) is entry]
+                     for owner_id in self._rotations[priority]]
+            # 各分道轮流出队
+            for round in itertools.zip_longest(*heads):
+                tasks.extend(task for task in round if task is not None)
+            if len(tasks) >= count:
+                break
+        return tasks[:count]
+
+    def Peek(self) -> TaskBase:
+        selected = self._select()
+        if selected is None:
+            return None
+        priority, owner_id = selected
+        return self._lanes[priority][owner_id][0][2]
+
+    def Pop(self) -> TaskBase:
+        selected = self._select()
+        if selected is None:
+            return None
+        priority, owner_id = selected
+        _, _, task = heapq.heappop(self._lanes[priority][owner_id])
+        del self._entries[task.id]
+        # 出过队的分道排到本轮最后
+        rotation = self._rotations[priority]
+        rotation.remove(owner_id)
+        rotation.append(owner_id)
+        return task
+
+    async def Wait(self) -> None:
+        # 等到队列非空
+        while len(self._entries) == 0:
+            self._changed.clear()
+            await self._changed.wait()
+
 async def TaskWorker(task : TaskBase):
     try:
         if task.status != TaskStatus.PENDING:
             return
         task.status = TaskStatus.RUNNING
-        await task.handler(task)
+        # 后台任务的API请求让位于交互命令
+        with ApiPriorityScope(ApiPriority.BACKGROUND):
+            await task.handler(task)
         task.status = TaskStatus.DONE
     except asyncio.CancelledError:
         task.status = TaskStatus.PAUSED
@@ -101,119 +390,366 @@ async def TaskWorker(task : TaskBase):
 
 class TaskManager:
     #region 内部实现
-    def __init__(self, client : PikPakFileSystem):
-        self.taskQueues : Dict[str, list[TaskBase]] = {}
-        self.loop : asyncio.Task = None
+    def __init__(self, client : PikPakFileSystem, aria2 : Aria2Client = None, default_engine : str = ENGINE_ARIA2, http_downloader : HttpDownloader = None,
+                 budget : TransferBudget = None, policy : str = SCHEDULE_FAIR):
+        self.tasks : TaskRegistry = self._new_registry()
         self.client = client
+        self.aria2 : Aria2Client = aria2 if aria2 is not None else Aria2Client.FromConfig()
+        self.default_engine : str = default_engine
+        self.http_downloader : HttpDownloader = http_downloader if http_downloader is not None else HttpDownloader(HTTP_DOWNLOAD_PATH, proxy_address = client.proxy_address)
+        self.budget : TransferBudget = budget if budget is not None else TransferBudget.FromConfig()
+        # 已完成的任务只在需要时才从数据库中加载
+        self._store : TaskStore = TaskStore(DB_PATH)
+        self._sync_manifest : SyncManifest = SyncManifest(SYNC_MANIFEST_PATH)
+        self._history_loaded : bool = False
+        self._loaded_owners : set[str] = set()
+        self._loaded_nodes : set[str] = set()
+        self._aria2_monitor : Aria2Monitor = None
+        self._offline_monitor : OfflineTaskMonitor = None
+        # 等待子任务状态变化的TorrentTask
+        self._owner_events : Dict[str, asyncio.Event] = {}
+        # 每种任务一个就绪队列和一个并发准入闸门，由各自的分发协程按需调度；
+        # 文件下载的闸门按连接数预算准入，其余任务每个占一个槽位
+        self.policy : str = policy
+        self._ready_queues : Dict[str, ReadyQueue] = {}
+        self._slots : Dict[str, TransferGate] = {}
+        self._dispatchers : Dict[str, asyncio.Task] = {}
+        self._started : bool = False
+        # 定期观测吞吐量、调整并发和限速的协程，以及上次推送给各aria2后端的选项
+        self._budget_task : asyncio.Task = None
+        self._pushed_aria2_options : Dict[str, Dict[str, int]] = {}
+        self._last_downloaded_bytes : int = 0
+        self.throughput : float = 0
+        # 正在预先获取下载链接的后台协程，同时只有一个
+        self._url_lookahead : asyncio.Task = None
     
-    async def _loop(self):
+    def _schedule(self, task : TaskBase):
+        if task.status != TaskStatus.PENDING:
+            return
+        if task.TAG not in self._ready_queues:
+            self._ready_queues[task.TAG] = ReadyQueue(self.policy)
+            if task.TAG == FileDownloadTask.TAG:
+                self._slots[task.TAG] = TransferGate(self.budget.Limits().connections, self.budget.download_limit)
+            else:
+                self._slots[task.TAG] = TransferGate(task.MAX_CONCURRENT_NUMBER)
+        if self._started and task.TAG not in self._dispatchers:
+            self._dispatchers[task.TAG] = asyncio.create_task(self._dispatch(task.TAG))
+        self._ready_queues[task.TAG].Put(task)
+
+    async def _dispatch(self, tag : str):
+        queue = self._ready_queues[tag]
+        slots = self._slots[tag]
         while True:
             try:
-                await asyncio.sleep(0.5)
-                for taskQueue in self.taskQueues.values():
-                    notRunningTasks = [task for task in taskQueue if task.worker is None or task.worker.done()]
-                    runningTasksNumber = len(taskQueue) - len(notRunningTasks)
-                    for task in [task for task in notRunningTasks if task.status == TaskStatus.PENDING]:
-                        if runningTasksNumber >= task.MAX_CONCURRENT_NUMBER:
-                            break
-                        task.worker = asyncio.create_task(TaskWorker(task))
-                        runningTasksNumber += 1
+                await queue.Wait()
+                task = queue.Peek()
+                if task.status != TaskStatus.PENDING or (task.worker is not None and not task.worker.done()):
+                    queue.Pop()
+                    continue
+                if tag == FileDownloadTask.TAG:
+                    self._resolve_upcoming_urls(queue)
+                cost = self._transfer_cost(task)
+                await slots.Acquire(cost)
+                # 等待槽位期间可能有更优先的任务入队，或者任务已被暂停、重复调度
+                if queue.Peek() is not task:
+                    slots.Release(cost)
+                    continue
+                queue.Pop()
+                if task.status != TaskStatus.PENDING or (task.worker is not None and not task.worker.done()):
+                    slots.Release(cost)
+                    continue
+                task.worker = asyncio.create_task(TaskWorker(task))
+                task.worker.add_done_callback(lambda _, cost = cost: slots.Release(cost))
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logging.error(f"task loop failed, exception occurred: {e}")
+                logging.error(f"task dispatch failed, exception occurred: {e}")
+
+    def _resolve_upcoming_urls(self, queue : ReadyQueue):
+        # 不等待结果：在后台批量获取即将派发的下载任务的链接，任务开始时直接使用缓存的链接
+        if self._url_lookahead is not None and not self._url_lookahead.done():
+            return
+        node_ids = [task.node_id for task in queue.Upcoming(URL_LOOKAHEAD)
+                    if task.status == TaskStatus.PENDING and task.file_download_status == FileDownloadTaskStatus.PENDING]
+        if len(node_ids) == 0:
+            return
+
+        async def _resolve():
+            with ApiPriorityScope(ApiPriority.BACKGROUND):
+                await self.client.ResolveFileUrls(node_ids)
+        self._url_lookahead = asyncio.create_task(_resolve())
+
+    def _transfer_cost(self, task : TaskBase) -> int:
+        # 文件下载按大小折算占用的连接数
+        if isinstance(task, FileDownloadTask):
+            return self.budget.Connections(task.size)
+        return 1
+
+    #region 传输预算部分
+    async def _budget_loop(self):
+        last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self.budget.interval)
+            try:
+                now = time.monotonic()
+                await self._apply_budget(now - last_time)
+                last_time = now
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"transfer budget update failed, exception occurred: {e}")
+
+    async def _observe_throughput(self, running : list[FileDownloadTask], elapsed : float) -> float:
+        # aria2的速度取各后端当前的总下载速度，内置下载器按这段时间内下载的字节数计算
+        downloaded_bytes = self.http_downloader.downloaded_bytes
+        throughput = (downloaded_bytes - self._last_downloaded_bytes) / max(elapsed, 1e-6)
+        self._last_downloaded_bytes = downloaded_bytes
+        backends = list({self.aria2.Backend(task.aria2_backend).name for task in running if task.engine == ENGINE_ARIA2 and task.gid is not None})
+        speeds = await asyncio.gather(*[self.aria2.DownloadSpeed(name) for name in backends], return_exceptions=True)
+        for name, speed in zip(backends, speeds):
+            if isinstance(speed, BaseException):
+                logging.warning(f"aria2 {name} speed query failed, exception occurred: {speed}")
+                continue
+            throughput += speed
+        return throughput
+
+    async def _push_speed_limits(self, limits : BudgetLimits, running : list[FileDownloadTask]):
+        # 总限速按正在下载的任务数分给内置下载器和各个aria2后端，只在选项变化时推送
+        counts : Dict[str, int] = {}
+        for task in running:
+            key = self.aria2.Backend(task.aria2_backend).name if task.engine == ENGINE_ARIA2 else ENGINE_HTTP
+            counts[key] = counts.get(key, 0) + 1
+        total = max(len(running), 1)
+
+        def _share(count : int) -> int:
+            return max(1, limits.speed * count // total) if limits.speed > 0 else 0
+
+        http_count = counts.pop(ENGINE_HTTP, 0)
+        # 没有内置下载任务时先放开，新任务开始后下一轮再按份额限制
+        self.http_downloader.SetRateLimit(_share(http_count) if http_count > 0 else limits.speed)
+        for name, count in counts.items():
+            # TaskManager自己控制并发(最多每个连接一个下载)，aria2不应再把下载放进等待队列
+            options = {"max-overall-download-limit": _share(count), "max-concurrent-downloads": limits.connections}
+            if self._pushed_aria2_options.get(name) == options:
+                continue
+            await self.aria2.ChangeGlobalOption(name, options)
+            self._pushed_aria2_options[name] = options
+
+    async def _apply_budget(self, elapsed : float):
+        running = self.tasks.ByStatus(FileDownloadTask.TAG, TaskStatus.RUNNING)
+        limits = self.budget.Limits()
+        self.throughput = await self._observe_throughput(running, elapsed)
+        download_limit = self.budget.Adapt(self.throughput, len(running), limits)
+        gate = self._slots.get(FileDownloadTask.TAG)
+        if gate is not None:
+            gate.SetLimits(limits.connections, download_limit)
+        await self._push_speed_limits(limits, running)
+    #endregion
+
+    def _new_registry(self) -> TaskRegistry:
+        registry = TaskRegistry()
+        registry.on_status_changed = self._on_task_status_changed
+        return registry
+
+    def _on_task_status_changed(self, task : TaskBase, old_status : TaskStatus):
+        self._save_task(task)
+        owner_id = getattr(task, "owner_id", None)
+        if owner_id in self._owner_events:
+            self._owner_events[owner_id].set()
 
     async def _get_task_by_id(self, task_id : str) -> TaskBase:
-        for queue in self.taskQueues.values():
-            for task in queue:
-                if task.id == task_id:
-                    return task
-        return None
+        task = self.tasks.Get(task_id)
+        if task is None and not self._history_loaded:
+            loaded = self._store.LoadById(task_id)
+            if loaded is not None:
+                self._adopt_tasks([loaded])
+                task = self.tasks.Get(task_id)
+        return task
+
+    #region 持久化部分
+    def _save_task(self, task : TaskBase):
+        self._store.Save([task])
+
+    def _adopt_tasks(self, tasks : list[TaskBase]):
+        for task in tasks:
+            if self.tasks.Get(task.id) is not None:
+                continue
+            if task.status == TaskStatus.RUNNING:
+                task.status = TaskStatus.PENDING
+            if isinstance(task, TorrentTask):
+                task.handler = self._torrent_task_handler
+                task.info = ""
+            if isinstance(task, FileDownloadTask):
+                task.handler = self._file_download_task_handler
+            if isinstance(task, UploadTask):
+                task.handler = self._upload_task_handler
+            self.tasks.Add(task)
+
+    def _load_history(self):
+        if self._history_loaded:
+            return
+        self._history_loaded = True
+        self._adopt_tasks(self._store.LoadFinished(TaskStatus.DONE.value))
+
+    def _ensure_owner_loaded(self, owner_id : str):
+        if self._history_loaded or owner_id in self._loaded_owners:
+            return
+        self._loaded_owners.add(owner_id)
+        self._adopt_tasks(self._store.LoadByOwner(owner_id))
+
+    def _ensure_node_loaded(self, node_id : str):
+        if self._history_loaded or node_id in self._loaded_nodes:
+            return
+        self._loaded_nodes.add(node_id)
+        self._adopt_tasks(self._store.LoadByNode(node_id))
+    #endregion
 
     #region 远程下载部分
     
     async def _append_task(self, task : TaskBase):
-        queue = self.taskQueues.get(task.TAG, [])
-        queue.append(task)
-        self.taskQueues[task.TAG] = queue
-
-    async def _get_torrent_queue(self):
-        if TorrentTask.TAG not in self.taskQueues:
-            self.taskQueues[TorrentTask.TAG] = []
-        return self.taskQueues[TorrentTask.TAG]
-    
+        self.tasks.Add(task)
+        self._save_task(task)
+        self._schedule(task)
+
     async def _get_file_download_queue(self, owner_id : str):
-        if FileDownloadTask.TAG not in self.taskQueues:
-            self.taskQueues[FileDownloadTask.TAG] = []
-        queue = self.taskQueues[FileDownloadTask.TAG]
-        return [task for task in queue if task.owner_id == owner_id]
+        return self.tasks.ByOwner(owner_id)
 
     async def _on_torrent_task_pending(self, task : TorrentTask):
-        task.node_id, task.task_id = await self.client.RemoteDownload(task.torrent, task.remote_base_path)
+        node_id, task.task_id = await self.client.RemoteDownload(task.torrent, task.remote_base_path)
+        self.tasks.SetNodeId(task, node_id)
         task.torrent_status = TorrentTaskStatus.REMOTE_DOWNLOADING
 
     async def _on_torrent_task_offline_downloading(self, task : TorrentTask):
-        wait_seconds = 3
-        while True:
-            status = await self.client.QueryTaskStatus(task.task_id, task.node_id)
-            if status in {DownloadStatus.not_found, DownloadStatus.not_downloading, DownloadStatus.error}:
-                task.torrent_status = TorrentTaskStatus.PENDING
-                raise Exception(f"remote download failed, status: {status}")
-            elif status == DownloadStatus.done:
-                break
-            await asyncio.sleep(wait_seconds)
-            wait_seconds = wait_seconds * 1.5
-        
+        def _on_progress(progress : int):
+            task.info = f"remote {progress}%"
+
+        # 所有离线任务共用一个监视器，离线任务结束时立即被唤醒
+        status = await self._offline_monitor.Wait(task.task_id, task.node_id, _on_progress)
+        if status != DownloadStatus.done:
+            task.torrent_status = TorrentTaskStatus.PENDING
+            raise Exception(f"remote download failed, status: {status}")
+
+        # 离线下载完成后只让保存目录的缓存失效
+        await self.client.Invalidate(task.remote_base_path, False)
         task.torrent_status = TorrentTaskStatus.LOCAL_DOWNLOADING
 
     async def _on_torrent_local_downloading(self, task : TorrentTask):
         node = await self.client.UpdateNode(task.node_id)
         task.name = node.name
-        task.node_id = node.id
+        self.tasks.SetNodeId(task, node.id)
+        # 重新遍历前先加载该任务已有的子任务，用于去重
+        self._ensure_owner_loaded(task.id)
         
-        if isinstance(node, FileNode):
-            await self._init_file_download_task(task.node_id, task.name, task.id) 
+        if task.sync:
+            synced = await self._create_sync_tasks(task, node)
+        elif isinstance(node, FileNode):
+            await self._init_file_download_task(task.node_id, task.name, task.id, engine = task.engine, size = node.size)
         elif isinstance(node, DirNode):
-            # 使用广度优先遍历
-            queue : list[str] = [node]
-            while len(queue) > 0:
-                current = queue.pop(0)
-                for child in await self.client.GetChildren(current):
-                    if isinstance(child, DirNode):
-                        queue.append(child)
-                    if isinstance(child, FileNode):
-                        child_path = task.name + await self.client.NodeToPath(node, child)
-                        await self._init_file_download_task(child.id, child_path, task.id)
+            # 并发遍历，遍历到的文件立即创建下载任务；下载链接在派发时才获取
+            async for child_path, child in self.client.Walk(node, WALK_CONCURRENCY):
+                if isinstance(child, FileNode):
+                    await self._init_file_download_task(child.id, task.name + child_path, task.id, engine = task.engine, size = child.size)
         else:
             raise Exception("unknown node type")
         
-        # 开始等待下载任务完成
-        while True:
-            file_download_tasks = await self._get_file_download_queue(task.id)
-            all_number = len(file_download_tasks)
-            not_completed_number = 0
-            paused_number = 0
-            error_number = 0
-            for file_download_task in file_download_tasks:
-                if file_download_task.status == TaskStatus.PAUSED:
-                    paused_number += 1
-                if file_download_task.status == TaskStatus.ERROR:
-                    error_number += 1
-                if file_download_task.status in {TaskStatus.PENDING, TaskStatus.RUNNING}:
-                    not_completed_number += 1
-            
-            running_number = all_number - not_completed_number - paused_number - error_number
-            task.info = f"{running_number}/{all_number} ({paused_number}|{error_number})"
-            
-            if not_completed_number > 0:
-                await asyncio.sleep(0.5)
-                continue
-            if error_number > 0:
-                raise Exception("file download failed")
-            if paused_number > 0:
-                raise asyncio.CancelledError()
-            break
+        # 开始等待下载任务完成，子任务状态变化时被唤醒
+        event = self._owner_events.setdefault(task.id, asyncio.Event())
+        try:
+            while True:
+                event.clear()
+                counts = self.tasks.CountByOwner(task.id)
+                all_number = sum(counts.values())
+                paused_number = counts.get(TaskStatus.PAUSED, 0)
+                error_number = counts.get(TaskStatus.ERROR, 0)
+                not_completed_number = counts.get(TaskStatus.PENDING, 0) + counts.get(TaskStatus.RUNNING, 0)
+                
+                running_number = all_number - not_completed_number - paused_number - error_number
+                task.info = f"{running_number}/{all_number} ({paused_number}|{error_number})"
+                
+                if not_completed_number > 0:
+                    await event.wait()
+                    continue
+                if error_number > 0:
+                    raise Exception("file download failed")
+                if paused_number > 0:
+                    raise asyncio.CancelledError()
+                break
+        finally:
+            self._owner_events.pop(task.id, None)
+            if task.sync:
+                self._save_sync_manifest(task, synced)
             
         task.torrent_status = TorrentTaskStatus.DONE
 
+    def _local_file_path(self, task : TorrentTask, remote_path : str) -> str:
+        if task.local_dir is None:
+            return None
+        return os.path.join(task.local_dir, *remote_path.split("/"))
+
+    async def _local_file_matches(self, local_path : str, file : FileNode) -> bool:
+        # 大小一致就认为相同，有哈希时再核对gcid；大小未知时无法判断，按不同处理
+        if file.size is None or not os.path.isfile(local_path) or os.path.getsize(local_path) != file.size:
+            return False
+        if not file.hash:
+            return True
+        return (await asyncio.to_thread(ComputeGcid, local_path)) == file.hash.upper()
+
+    async def _create_sync_tasks(self, task : TorrentTask, node : NodeBase) -> Dict[str, tuple[Dict[str, Any], str]]:
+        # 和上次同步的清单比较，只为新增或变化的文件创建下载任务；返回{下载路径: (远程元数据, 下载任务id)}，
+        # 任务id为None表示文件没有变化
+        await self.client.InvalidateNode(node.id, True)
+        manifest = self._sync_manifest.Get(node.id)
+        synced : Dict[str, tuple[Dict[str, Any], str]] = {}
+
+        async def _sync_file(remote_path : str, file : FileNode):
+            entry = {"id": file.id, "size": file.size, "mtime": file.modified_time, "hash": file.hash}
+            local_path = self._local_file_path(task, remote_path)
+            if remote_path in manifest:
+                unchanged = manifest[remote_path] == entry
+                if unchanged and local_path is not None:
+                    unchanged = os.path.isfile(local_path) and (file.size is None or os.path.getsize(local_path) == file.size)
+            else:
+                # 清单里没有记录(第一次同步或清单丢失)时和本地文件比较，已经下载过的(比如之前PullRemote到同一目录)不再重新下载
+                unchanged = local_path is not None and await self._local_file_matches(local_path, file)
+            if unchanged:
+                synced[remote_path] = (entry, None)
+                return
+            # 旧文件会让aria2另存为新名字，内置下载器也可能沿用旧的进度，先删掉
+            if (task.engine or self.default_engine) == ENGINE_HTTP:
+                self.http_downloader.Discard(remote_path)
+            elif local_path is not None and os.path.isfile(local_path):
+                os.remove(local_path)
+            synced[remote_path] = (entry, await self._init_file_download_task(file.id, remote_path, task.id, True, task.engine, file.size))
+
+        if isinstance(node, FileNode):
+            await _sync_file(task.name, node)
+        elif isinstance(node, DirNode):
+            async for child_path, child in self.client.Walk(node, WALK_CONCURRENCY):
+                if isinstance(child, FileNode):
+                    await _sync_file(task.name + child_path, child)
+        else:
+            raise Exception("unknown node type")
+
+        orphans = [remote_path for remote_path in manifest if remote_path not in synced]
+        if task.delete_orphans and task.local_dir is not None:
+            for remote_path in orphans:
+                local_path = self._local_file_path(task, remote_path)
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                    logging.info(f"deleted orphan {local_path}")
+        changed = sum(1 for _, task_id in synced.values() if task_id is not None)
+        logging.info(f"sync of {task.name}: {changed} changed, {len(synced) - changed} unchanged, {len(orphans)} orphans")
+        return synced
+
+    def _save_sync_manifest(self, task : TorrentTask, synced : Dict[str, tuple[Dict[str, Any], str]]):
+        # 只记录确实已经下载完成的文件，失败的文件下次同步时重新下载
+        manifest : Dict[str, Dict[str, Any]] = {}
+        for remote_path, (entry, task_id) in synced.items():
+            file_task = self.tasks.Get(task_id) if task_id is not None else None
+            if task_id is None or (file_task is not None and file_task.status == TaskStatus.DONE):
+                manifest[remote_path] = entry
+        self._sync_manifest.Set(task.node_id, manifest)
+
     async def _on_torrent_task_cancelled(self, task : TorrentTask):
         file_download_tasks = await self._get_file_download_queue(task.id)
         for file_download_task in file_download_tasks:
@@ -231,6 +767,7 @@ class TaskManager:
                     await self._on_torrent_local_downloading(task)
                 else:
                     break
+                self._save_task(task)
         except asyncio.CancelledError:
             await self._on_torrent_task_cancelled(task)
             raise
@@ -238,73 +775,176 @@ class TaskManager:
 
 
     #region 文件下载部分
-    async def _init_file_download_task(self, node_id : str, remote_path : str, owner_id : str) -> str:
-        queue = await self._get_file_download_queue(owner_id)
-        for task in queue:
+    async def _init_file_download_task(self, node_id : str, remote_path : str, owner_id : str, redownload : bool = False, engine : str = None,
+                                       size : int = None) -> str:
+        for task in self.tasks.ByNode(node_id):
             if not isinstance(task, FileDownloadTask):
                 continue
-            if task.node_id == node_id:
-                if task.status in {TaskStatus.PAUSED, TaskStatus.ERROR}:
+            if task.owner_id == owner_id:
+                if redownload and task.status == TaskStatus.DONE:
+                    # 同步时文件有变化，已完成的任务从头再下载一次
+                    task.file_download_status = FileDownloadTaskStatus.PENDING
+                    task.remote_path = remote_path
+                    task.size = size
+                    task.gid = None
+                    task.url = None
                     task.status = TaskStatus.PENDING
+                    self._schedule(task)
+                elif task.status in {TaskStatus.PAUSED, TaskStatus.ERROR}:
+                    task.status = TaskStatus.PENDING
+                    self._schedule(task)
                 return task.id
         task = FileDownloadTask(node_id, remote_path, owner_id)
+        task.engine = engine or self.default_engine
+        task.size = size
+        # 子任务继承所属任务的优先级和截止时间
+        owner = self.tasks.Get(owner_id)
+        if owner is not None:
+            task.priority = owner.priority
+            task.deadline = owner.deadline
         task.handler = self._file_download_task_handler
         await self._append_task(task)
         return task.id
     
     async def _on_file_download_task_pending(self, task : FileDownloadTask):
         task.url = await self.client.GetFileUrlByNodeId(task.node_id)
-        task.gid = await addUri(task.url, task.remote_path)
+        if task.engine == ENGINE_HTTP:
+            task.file_download_status = FileDownloadTaskStatus.DOWNLOADING
+            return
+        # 重试时沿用之前的后端，已下载的部分文件在那台机器上；小文件只用一个连接
+        connections = self.budget.Connections(task.size)
+        options = {"split": str(connections), "max-connection-per-server": str(connections)}
+        task.aria2_backend, task.gid = await self.aria2.AddUri(task.url, task.remote_path, task.aria2_backend, options)
         task.file_download_status = FileDownloadTaskStatus.DOWNLOADING
 
+    async def _on_file_download_task_downloading_http(self, task : FileDownloadTask):
+        def _on_progress(downloaded : int, size : int):
+            task.info = f"{downloaded * 100 // size}%" if size > 0 else f"{downloaded} bytes"
+
+        try:
+            await self.http_downloader.Download(task.url, task.remote_path, _on_progress, task.node_id, self.budget.Connections(task.size))
+        except HttpDownloadError as e:
+            task.file_download_status = FileDownloadTaskStatus.PENDING
+            if e.DeadLink:
+                raise DeadLinkError(f"download link is dead, {e}")
+            raise
+        task.file_download_status = FileDownloadTaskStatus.DONE
+
     async def _on_file_download_task_downloading(self, task : FileDownloadTask):
-        wait_seconds = 3
+        if task.engine == ENGINE_HTTP:
+            await self._on_file_download_task_downloading_http(task)
+            return
         while True:
-            status = await tellStatus(task.gid)
-            if status in {Aria2Status.REMOVED, Aria2Status.ERROR}:
+            status = await self._aria2_monitor.Wait(task.aria2_backend, task.gid)
+            if status == Aria2Status.ERROR:
+                task.file_download_status = FileDownloadTaskStatus.PENDING
+                error_code, error_message = await self.aria2.TellError(task.aria2_backend, task.gid)
+                if error_code in DEAD_LINK_ERROR_CODES:
+                    raise DeadLinkError(f"download link is dead, aria2 error {error_code}: {error_message}")
+                raise Exception(f"aria2 download failed, error {error_code}: {error_message}")
+            elif status == Aria2Status.REMOVED:
                 task.file_download_status = FileDownloadTaskStatus.PENDING
                 raise Exception("failed to query status")
             elif status == Aria2Status.PAUSED:
-                await unpause(task.gid)
+                await self.aria2.Unpause(task.aria2_backend, task.gid)
             elif status == Aria2Status.COMPLETE:
                 break
-            await asyncio.sleep(wait_seconds)
         task.file_download_status = FileDownloadTaskStatus.DONE
 
     async def _file_download_task_handler(self, task : FileDownloadTask):
+        dead_link_retry = 0
         try:
             while True:
                 if task.file_download_status == FileDownloadTaskStatus.PENDING:
                     await self._on_file_download_task_pending(task)
                 elif task.file_download_status == FileDownloadTaskStatus.DOWNLOADING:
-                    await self._on_file_download_task_downloading(task)
+                    try:
+                        await self._on_file_download_task_downloading(task)
+                    except DeadLinkError as e:
+                        # 链接过期或失效，丢弃缓存的链接后重新获取
+                        dead_link_retry += 1
+                        if dead_link_retry > MAX_DEAD_LINK_RETRY:
+                            raise
+                        logging.warning(f"{e}, re-resolving url of {task.node_id}")
+                        if task.gid is not None:
+                            await self.aria2.RemoveDownloadResult(task.aria2_backend, task.gid)
+                        task.gid = None
+                        await self.client.InvalidateFileUrl(task.node_id)
                 else:
                     break
+                self._save_task(task)
         except asyncio.CancelledError:
             gid = task.gid
             if gid is not None:
-                await pause(gid)
+                await self.aria2.Pause(task.aria2_backend, gid)
             raise
 
     #endregion
 
-    def _load_tasks_from_db(self):
+    #region 文件上传部分
+    async def _on_upload_task_pending(self, task : UploadTask):
+        size = os.path.getsize(task.local_path)
+        if task.gcid is None or task.size != size:
+            task.info = "hashing"
+            task.gcid = await asyncio.to_thread(ComputeGcid, task.local_path)
+            task.size = size
+        father = await self.client.EnsureDir(task.remote_dir)
+        task.father_id = father.id
+        task.file_info, task.oss_params = await self.client.CreateUpload(father, os.path.basename(task.local_path), task.size, task.gcid)
+        task.upload_id = None
+        task.parts = {}
+        if task.oss_params is None:
+            # 服务端已有相同内容的文件，不需要传输
+            task.info = "instant"
+            await self._on_upload_task_finished(task)
+            return
+        task.upload_status = UploadTaskStatus.UPLOADING
+
+    async def _on_upload_task_uploading(self, task : UploadTask):
+        part_size = PartSize(task.size)
+        uploaded = sum(min(part_size, task.size - (number - 1) * part_size) for number in task.parts)
+
+        def _on_part_done(number : int, etag : str, length : int):
+            nonlocal uploaded
+            uploaded += length
+            task.info = f"{uploaded * 100 // max(task.size, 1)}%"
+            self._save_task(task)
+
+        uploader = OssUploader(task.oss_params, self.client.proxy_address)
         try:
-            self.taskQueues = pickle.load(open(DB_PATH, "rb"))
-            for queue in self.taskQueues.values():
-                for task in queue:
-                    if task.status == TaskStatus.RUNNING:
-                        task.status = TaskStatus.PENDING
-                    if isinstance(task, TorrentTask):
-                        task.handler = self._torrent_task_handler
-                        task.info = ""
-                    if isinstance(task, FileDownloadTask):
-                        task.handler = self._file_download_task_handler
-        except:
-            pass
-    
-    def _dump_tasks_to_db(self):
-        pickle.dump(self.taskQueues, open(DB_PATH, "wb"))
+            if task.upload_id is None:
+                task.upload_id = await uploader.Initiate()
+                self._save_task(task)
+            await uploader.Upload(task.local_path, task.upload_id, task.parts, on_part_done = _on_part_done)
+        except OssError as e:
+            if e.CredentialExpired:
+                # 临时凭证过期后只能重新创建文件，已上传的分片作废
+                task.upload_status = UploadTaskStatus.PENDING
+            raise
+        finally:
+            await uploader.Close()
+        await self._on_upload_task_finished(task)
+
+    async def _on_upload_task_finished(self, task : UploadTask):
+        node = await self.client.FinishUpload(task.father_id, task.file_info)
+        if node is not None:
+            self.tasks.SetNodeId(task, node.id)
+        task.upload_status = UploadTaskStatus.DONE
+
+    async def _upload_task_handler(self, task : UploadTask):
+        while True:
+            if task.upload_status == UploadTaskStatus.PENDING:
+                await self._on_upload_task_pending(task)
+            elif task.upload_status == UploadTaskStatus.UPLOADING:
+                await self._on_upload_task_uploading(task)
+            else:
+                break
+            self._save_task(task)
+    #endregion
+
+    def _load_tasks_from_db(self):
+        self._store.ImportLegacy(LEGACY_DB_PATH)
+        self._adopt_tasks(self._store.LoadUnfinished(TaskStatus.DONE.value))
 
     #endregion
 
@@ -312,46 +952,158 @@ class TaskManager:
 
     def Start(self):
         self._load_tasks_from_db()
-        if self.loop is None:
-            self.loop = asyncio.create_task(self._loop())
+        if self._started:
+            return
+        self._started = True
+        if self._aria2_monitor is None:
+            self._aria2_monitor = Aria2Monitor(self.aria2)
+        self._aria2_monitor.Start()
+        if self._offline_monitor is None:
+            self._offline_monitor = OfflineTaskMonitor(self.client)
+        self._offline_monitor.Start()
+        self.http_downloader.SetRateLimit(self.budget.Limits().speed)
+        self._budget_task = asyncio.create_task(self._budget_loop())
+        for tag in self.tasks.Tags():
+            for task in self.tasks.ByStatus(tag, TaskStatus.PENDING):
+                self._schedule(task)
+        for tag in self._ready_queues:
+            if tag not in self._dispatchers:
+                self._dispatchers[tag] = asyncio.create_task(self._dispatch(tag))
 
     def Stop(self):
-        if self.loop is not None:
-            self.loop.cancel()
-            self.loop = None
-        self._dump_tasks_to_db()
+        self._started = False
+        for dispatcher in self._dispatchers.values():
+            dispatcher.cancel()
+        self._dispatchers.clear()
+        if self._budget_task is not None:
+            self._budget_task.cancel()
+            self._budget_task = None
+        if self._url_lookahead is not None:
+            self._url_lookahead.cancel()
+            self._url_lookahead = None
+        if self._aria2_monitor is not None:
+            self._aria2_monitor.Stop()
+        if self._offline_monitor is not None:
+            self._offline_monitor.Stop()
+        self._store.Close()
         
     
-    async def CreateTorrentTask(self, torrent : str, remote_base_path : str) -> str:
+    async def CreateTorrentTask(self, torrent : str, remote_base_path : str, engine : str = None) -> str:
         task = TorrentTask(torrent)
         task.remote_base_path = remote_base_path
+        task.engine = engine
         task.handler = self._torrent_task_handler
         await self._append_task(task)
         return task.id
 
-    async def PullRemote(self, path : str) -> str:
+    async def PullRemote(self, path : str, engine : str = None) -> str:
         target = await self.client.PathToNode(path)
         if target is None:
             raise Exception("target not found")
-        queue = await self._get_torrent_queue() 
-        for task in queue:
-            if not isinstance(task, TorrentTask):
-                continue
-            if task.node_id == target.id:
+        self._ensure_node_loaded(target.id)
+        for task in self.tasks.ByNode(target.id):
+            if isinstance(task, TorrentTask):
                 return task.id
         task = TorrentTask(None)
         task.name = target.name
         task.node_id = target.id
+        task.engine = engine
         task.handler = self._torrent_task_handler
         task.torrent_status = TorrentTaskStatus.LOCAL_DOWNLOADING
         await self._append_task(task)
         return task.id
     
+    async def CreateUploadTasks(self, local_path : str, remote_dir : str) -> list[str]:
+        # 上传本地文件；上传目录时保留目录结构，每个文件一个任务
+        if not remote_dir.startswith("/"):
+            remote_dir = (await self.client.GetCwd()).rstrip("/") + "/" + remote_dir
+        remote_dir = remote_dir.rstrip("/")
+        local_path = os.path.abspath(local_path)
+        files : list[tuple[str, str]] = []
+        if os.path.isfile(local_path):
+            files.append((local_path, remote_dir))
+        elif os.path.isdir(local_path):
+            base_dir = remote_dir + "/" + os.path.basename(local_path)
+            for dir_path, _, file_names in os.walk(local_path):
+                relative_dir = os.path.relpath(dir_path, local_path).replace(os.sep, "/")
+                target_dir = base_dir if relative_dir == "." else base_dir + "/" + relative_dir
+                files.extend((os.path.join(dir_path, file_name), target_dir) for file_name in sorted(file_names))
+        else:
+            raise Exception("local path not found")
+        task_ids : list[str] = []
+        for file_path, target_dir in files:
+            task = UploadTask(file_path, target_dir or "/")
+            task.handler = self._upload_task_handler
+            await self._append_task(task)
+            task_ids.append(task.id)
+        return task_ids
+
+    async def SyncRemote(self, path : str, local_dir : str = None, delete_orphans : bool = False, engine : str = None) -> str:
+        # 把远程目录同步到本地：和上次同步的清单比较，只下载新增或变化的文件
+        target = await self.client.PathToNode(path)
+        if target is None:
+            raise Exception("target not found")
+        if local_dir is None:
+            if (engine or self.default_engine) == ENGINE_HTTP:
+                local_dir = self.http_downloader.base_path
+            elif os.path.isdir(self.aria2.Backend(None).base_path):
+                local_dir = self.aria2.Backend(None).base_path
+        self._ensure_node_loaded(target.id)
+        task : TorrentTask = None
+        for existing in self.tasks.ByNode(target.id):
+            if isinstance(existing, TorrentTask):
+                task = existing
+                break
+        if task is not None and task.status in {TaskStatus.PENDING, TaskStatus.RUNNING}:
+            return task.id
+        if task is None:
+            task = TorrentTask(None)
+            task.name = target.name
+            task.node_id = target.id
+            task.handler = self._torrent_task_handler
+            self.tasks.Add(task)
+        task.sync = True
+        task.engine = engine
+        task.local_dir = local_dir
+        task.delete_orphans = delete_orphans
+        task.torrent_status = TorrentTaskStatus.LOCAL_DOWNLOADING
+        task.status = TaskStatus.PENDING
+        self._save_task(task)
+        self._schedule(task)
+        return task.id
+
+    async def ChangeTaskPriority(self, task_id : str, delta : int, deadline : float = None) -> int:
+        # 调整任务的优先级(以及截止时间)，TorrentTask的未完成子任务一起调整；返回新的优先级
+        task = await self._get_task_by_id(task_id)
+        if task is None:
+            raise Exception("task not found")
+        tasks = [task]
+        if isinstance(task, TorrentTask):
+            self._ensure_owner_loaded(task.id)
+            tasks.extend(child for child in self.tasks.ByOwner(task.id) if child.status != TaskStatus.DONE)
+        priority = task.priority + delta
+        for item in tasks:
+            item.priority = priority
+            if deadline is not None:
+                item.deadline = deadline
+            self._save_task(item)
+            # 重新入队，按新的优先级排序
+            self._schedule(item)
+        return priority
+
+    def SetSchedulePolicy(self, policy : str):
+        if policy not in SCHEDULE_POLICIES:
+            raise Exception(f"unknown schedule policy {policy}")
+        self.policy = policy
+        for queue in self._ready_queues.values():
+            queue.SetPolicy(policy)
+
     async def QueryTasks(self, tag : str, filter_status : TaskStatus = None):
-        queue = self.taskQueues.get(tag, [])
+        if filter_status in {None, TaskStatus.DONE}:
+            self._load_history()
         if filter_status is None:
-            return queue
-        return [task for task in queue if task.status == filter_status]    
+            return self.tasks.ByTag(tag)
+        return self.tasks.ByStatus(tag, filter_status)
     
     async def StopTask(self, task_id : str):
         task = await self._get_task_by_id(task_id)
@@ -362,5 +1114,6 @@ class TaskManager:
         task = await self._get_task_by_id(task_id)
         if task is not None:
             task.Resume()
+            self._schedule(task)
 
     #endregion
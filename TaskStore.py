@@ -0,0 +1,103 @@
+import sqlite3
+import logging
+import pickle
+import os
+from typing import Any, Iterable
+
+class TaskStore:
+    # 每次任务状态变化都立即写入SQLite(WAL模式)，崩溃时最多丢失最后一次变化
+    def __init__(self, path : str):
+        self._path : str = path
+        self._conn : sqlite3.Connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self._path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    tag TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    owner_id TEXT,
+                    node_id TEXT,
+                    data BLOB NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_node ON tasks (node_id)")
+        self._conn = conn
+        return conn
+
+    def _row(self, task : Any) -> tuple[Any, ...]:
+        return (task.id, task.TAG, task.status.value, getattr(task, "owner_id", None), getattr(task, "node_id", None),
+                pickle.dumps(task))
+
+    def _query(self, where : str, params : tuple[Any, ...]) -> list[Any]:
+        try:
+            rows = self._connect().execute(f"SELECT data FROM tasks WHERE {where} ORDER BY rowid", params).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"failed to load tasks, exception occurred: {e}")
+            return []
+        tasks : list[Any] = []
+        for (data,) in rows:
+            try:
+                tasks.append(pickle.loads(data))
+            except Exception as e:
+                logging.error(f"failed to unpickle task, exception occurred: {e}")
+        return tasks
+
+    def Save(self, tasks : Iterable[Any]) -> None:
+        try:
+            conn = self._connect()
+            with conn:
+                conn.executemany("""
+                    INSERT INTO tasks (id, tag, status, owner_id, node_id, data) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        tag = excluded.tag,
+                        status = excluded.status,
+                        owner_id = excluded.owner_id,
+                        node_id = excluded.node_id,
+                        data = excluded.data""", [self._row(task) for task in tasks])
+        except sqlite3.Error as e:
+            logging.error(f"failed to save tasks, exception occurred: {e}")
+
+    def LoadUnfinished(self, done_status : str) -> list[Any]:
+        return self._query("status != ?", (done_status,))
+
+    def LoadFinished(self, done_status : str) -> list[Any]:
+        return self._query("status = ?", (done_status,))
+
+    def LoadById(self, task_id : str) -> Any:
+        tasks = self._query("id = ?", (task_id,))
+        return tasks[0] if len(tasks) > 0 else None
+
+    def LoadByOwner(self, owner_id : str) -> list[Any]:
+        return self._query("owner_id = ?", (owner_id,))
+
+    def LoadByNode(self, node_id : str) -> list[Any]:
+        return self._query("node_id = ?", (node_id,))
+
+    def ImportLegacy(self, legacy_path : str) -> int:
+        # 导入旧版本整体pickle的task.db，导入后改名避免重复导入
+        if not os.path.exists(legacy_path):
+            return 0
+        try:
+            with open(legacy_path, "rb") as file:
+                taskQueues : dict[str, list[Any]] = pickle.load(file)
+        except Exception as e:
+            logging.error(f"failed to import {legacy_path}, exception occurred: {e}")
+            return 0
+        tasks = [task for queue in taskQueues.values() for task in queue]
+        self.Save(tasks)
+        os.replace(legacy_path, legacy_path + ".imported")
+        logging.info(f"imported {len(tasks)} tasks from {legacy_path}")
+        return len(tasks)
+
+    def Close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+from datetime import datetime, time as daytime
+from typing import Any, Dict
+
+BUDGET_CONFIG_PATH = "budget.json"
+
+# 没有配置文件时使用的默认配置，速度单位为字节/秒，0表示不限速
+DEFAULT_BUDGET_CONFIG : Dict[str, Any] = {
+    "max_download_speed" : 0,
+    "max_connections" : 16,
+    # 自适应并发下载数的起点，之后在[1, max_connections]内按吞吐量调整
+    "max_downloads" : 5,
+    "connections_per_download" : 4,
+    # 不超过这个大小的文件只用一个连接，按大小折算连接数，小文件可以更密集地并发
+    "small_file_size" : 16 << 20,
+    "interval" : 5,
+    # 按时段覆盖上面的限制，例如 {"start": "09:00", "end": "18:00", "max_download_speed": 2097152}
+    "schedules" : [],
+}
+
+# 吞吐量变化超过这个比例才认为增减并发有效果
+ADAPT_TOLERANCE = 0.05
+# 吞吐量达到限速的这个比例时认为带宽已经用满，不再增加并发
+SATURATED_RATIO = 0.9
+
+class BudgetLimits:
+    __slots__ = ("speed", "connections", "downloads")
+
+    def __init__(self, speed : int, connections : int, downloads : int):
+        self.speed : int = speed
+        self.connections : int = connections
+        self.downloads : int = downloads
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BudgetLimits) and (self.speed, self.connections, self.downloads) == (other.speed, other.connections, other.downloads)
+
+class BudgetSchedule:
+    # 每天[start, end)时段内生效的限制，end早于start表示跨越午夜
+    def __init__(self, start : daytime, end : daytime, overrides : Dict[str, int]):
+        self.start : daytime = start
+        self.end : daytime = end
+        self.overrides : Dict[str, int] = overrides
+
+    @classmethod
+    def FromConfig(cls, config : Dict[str, Any]) -> "BudgetSchedule":
+        overrides = {key : config[key] for key in ("max_download_speed", "max_connections", "max_downloads") if key in config}
+        return cls(daytime.fromisoformat(config["start"]), daytime.fromisoformat(config["end"]), overrides)
+
+    def Contains(self, now : daytime) -> bool:
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+class TransferGate:
+    # 按连接数和任务数准入：任务按自己占用的连接数扣减容量，两个上限都可以随时调整
+    def __init__(self, capacity : int, task_limit : int = None):
+        self.capacity : int = capacity
+        self.task_limit : int = task_limit if task_limit is not None else capacity
+        self.used : int = 0
+        self.running : int = 0
+        # 容量变化时set并换成新的Event，等待者被唤醒后重新检查
+        self._changed : asyncio.Event = asyncio.Event()
+
+    def _admissible(self, cost : int) -> bool:
+        if self.running >= self.task_limit:
+            return False
+        # 单个任务需要的连接超过总容量时，等其他任务都结束后单独运行
+        return self.used + cost <= self.capacity or self.running == 0
+
+    async def Acquire(self, cost : int = 1) -> None:
+        while not self._admissible(cost):
+            await self._changed.wait()
+        self.used += cost
+        self.running += 1
+
+    def Release(self, cost : int = 1) -> None:
+        self.used -= cost
+        self.running -= 1
+        self._notify()
+
+    def SetLimits(self, capacity : int, task_limit : int) -> None:
+        if capacity == self.capacity and task_limit == self.task_limit:
+            return
+        self.capacity = capacity
+        self.task_limit = task_limit
+        self._notify()
+
+    def _notify(self) -> None:
+        # 同步唤醒，不需要另外调度协程
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+class TransferBudget:
+    # 全局的下载速度和连接数预算，支持按时段调整，并根据观测到的吞吐量自适应并发下载数
+    def __init__(self, max_download_speed : int = 0, max_connections : int = 16, max_downloads : int = 5,
+                 connections_per_download : int = 4, small_file_size : int = 16 << 20, interval : float = 5,
+                 schedules : list[BudgetSchedule] = None):
+        self.max_download_speed : int = max_download_speed
+        self.max_connections : int = max_connections
+        self.max_downloads : int = max_downloads
+        self.connections_per_download : int = connections_per_download
+        self.small_file_size : int = small_file_size
+        self.interval : float = interval
+        self.schedules : list[BudgetSchedule] = schedules or []
+        # 自适应得到的并发下载数，从max_downloads开始，最多每个连接一个下载
+        self.download_limit : int = min(max_downloads, max_connections)
+        self._last_throughput : float = 0
+        self._last_step : int = 0
+        self._last_limits : BudgetLimits = None
+
+    @classmethod
+    def FromConfig(cls, path : str = BUDGET_CONFIG_PATH) -> "TransferBudget":
+        config : Dict[str, Any] = DEFAULT_BUDGET_CONFIG
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                config = {**DEFAULT_BUDGET_CONFIG, **json.load(file)}
+        return cls(
+            max_download_speed = config["max_download_speed"],
+            max_connections = config["max_connections"],
+            max_downloads = config["max_downloads"],
+            connections_per_download = config["connections_per_download"],
+            small_file_size = config["small_file_size"],
+            interval = config["interval"],
+            schedules = [BudgetSchedule.FromConfig(schedule) for schedule in config["schedules"]])
+
+    def Limits(self, now : datetime = None) -> BudgetLimits:
+        # 后面的时段覆盖前面的
+        values = {
+            "max_download_speed" : self.max_download_speed,
+            "max_connections" : self.max_connections,
+            "max_downloads" : self.max_downloads,
+        }
+        current = (now or datetime.now()).time()
+        for schedule in self.schedules:
+            if schedule.Contains(current):
+                values.update(schedule.overrides)
+        return BudgetLimits(values["max_download_speed"], max(1, values["max_connections"]), max(1, values["max_downloads"]))
+
+    def Connections(self, size : int) -> int:
+        # 大小未知时按大文件处理
+        if size is None:
+            return self.connections_per_download
+        return max(1, min(self.connections_per_download, -(-size // max(self.small_file_size, 1))))
+
+    def Adapt(self, throughput : float, running : int, limits : BudgetLimits) -> int:
+        # 爬山法在[1, 连接数上限]内调整并发下载数：增加并发带来了吞吐量提升就继续增加，没有提升就撤回，吞吐量下降就减少；
+        # 小文件每个只占一个连接，所以并发下载数可以一直涨到连接数上限，连接是否够用由TransferGate按连接数准入
+        if limits != self._last_limits:
+            # 时段切换后从新的起点重新试探
+            self._last_limits = limits
+            self.download_limit = min(limits.downloads, limits.connections)
+            self._last_throughput = 0
+            self._last_step = 0
+            return self.download_limit
+        if running < self.download_limit:
+            # 并发没有用满，这段时间的吞吐量说明不了上限是否合适
+            self._last_step = 0
+        elif limits.speed > 0 and throughput >= limits.speed * SATURATED_RATIO:
+            self._last_step = 0
+        elif self._last_throughput <= 0 or throughput > self._last_throughput * (1 + ADAPT_TOLERANCE):
+            self._last_step = 1
+        elif throughput < self._last_throughput * (1 - ADAPT_TOLERANCE):
+            self._last_step = -1
+        else:
+            self._last_step = -1 if self._last_step > 0 else 0
+        download_limit = max(1, min(limits.connections, self.download_limit + self._last_step))
+        # 记录实际的变化，到达边界时不算作一次试探
+        self._last_step = download_limit - self.download_limit
+        self.download_limit = download_limit
+        self._last_throughput = throughput
+        return self.download_limit
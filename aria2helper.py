@@ -1,5 +1,15 @@
 import httpx, json
+import asyncio
+import logging
+import os
+import random
 from enum import Enum
+from typing import Any, Dict
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 class Aria2Status(Enum):
     ACTIVE = "active"
@@ -7,66 +17,324 @@ class Aria2Status(Enum):
     PAUSED = "paused"
     ERROR = "error"
     COMPLETE = "complete"
-    REMOVED = "removed" 
-
-ARIA_ADDRESS = "http://100.96.0.2:6800/jsonrpc"
-ARIA_SECRET = "jfaieofjosiefjoiaesjfoiasejf"
-BASE_PATH = "/downloads"
-
-client = httpx.AsyncClient()
-
-async def addUri(uri, path):
-    jsonreq = json.dumps({
-        "jsonrpc" : "2.0",
-        "id" : "pikpak",
-        "method" : "aria2.addUri",
-        "params" : [ f"token:{ARIA_SECRET}", [uri], 
-            {
-                "dir" : BASE_PATH,
-                "out" : path
-            }]
-    })
-    response = await client.post(ARIA_ADDRESS, data=jsonreq)
-    result = json.loads(response.text)
-    return result["result"]
-
-
-async def tellStatus(gid) -> Aria2Status:
-    jsonreq = json.dumps({
-        "jsonrpc" : "2.0",
-        "id" : "pikpak",
-        "method" : "aria2.tellStatus",
-        "params" : [ f"token:{ARIA_SECRET}", gid]
-    })
-    response = await client.post(ARIA_ADDRESS, data=jsonreq)
-    result = json.loads(response.text)
-    if "error" in result:
-        return Aria2Status.REMOVED
-    return Aria2Status(result["result"]["status"])
-
-async def pause(gid):
-    jsonreq = json.dumps({
-        "jsonrpc" : "2.0",
-        "id" : "pikpak",
-        "method" : "aria2.pause",
-        "params" : [ f"token:{ARIA_SECRET}", gid]
-    })
-    await client.post(ARIA_ADDRESS, data=jsonreq)
-
-async def unpause(gid):
-    jsonreq = json.dumps({
-        "jsonrpc" : "2.0",
-        "id" : "pikpak",
-        "method" : "aria2.unpause",
-        "params" : [ f"token:{ARIA_SECRET}", gid]
-    })
-    await client.post(ARIA_ADDRESS, data=jsonreq)
-
-async def remove(gid):
-    jsonreq = json.dumps({
-        "jsonrpc" : "2.0",
-        "id" : "pikpak",
-        "method" : "aria2.remove",
-        "params" : [ f"token:{ARIA_SECRET}", gid]
-    })
-    await client.post(ARIA_ADDRESS, data=jsonreq)
\ No newline at end of file
+    REMOVED = "removed"
+
+ARIA2_CONFIG_PATH = "aria2.json"
+
+# 没有配置文件时使用的默认配置
+DEFAULT_ARIA2_CONFIG : Dict[str, Any] = {
+    "timeout" : 10,
+    "pool" : {
+        "max_connections" : 16,
+        "max_keepalive_connections" : 8,
+        "keepalive_expiry" : 30,
+    },
+    "retry" : {
+        "attempts" : 4,
+        "backoff" : 0.5,
+        "max_backoff" : 10,
+    },
+    "poll_interval" : 3,
+    "backends" : [
+        {
+            "name" : "default",
+            "address" : "http://100.96.0.2:6800/jsonrpc",
+            "secret" : "jfaieofjosiefjoiaesjfoiasejf",
+            "base_path" : "/downloads",
+            "weight" : 1,
+        }
+    ],
+}
+
+class Aria2RpcError(Exception):
+    def __init__(self, code : int, message : str):
+        super().__init__(f"aria2 rpc error {code}: {message}")
+        self.code : int = code
+        self.message : str = message
+
+class Aria2Backend:
+    def __init__(self, name : str, address : str, secret : str, base_path : str, weight : float = 1,
+                 websocket_address : str = None, timeout : float = 10, pool : Dict[str, Any] = None, retry : Dict[str, Any] = None):
+        self.name : str = name
+        self.address : str = address
+        self.secret : str = secret
+        self.base_path : str = base_path
+        self.weight : float = weight
+        if websocket_address is None:
+            websocket_address = address.replace("https://", "wss://").replace("http://", "ws://")
+        self.websocket_address : str = websocket_address
+
+        pool = pool or DEFAULT_ARIA2_CONFIG["pool"]
+        retry = retry or DEFAULT_ARIA2_CONFIG["retry"]
+        self._retry_attempts : int = retry.get("attempts", 1)
+        self._retry_backoff : float = retry.get("backoff", 0.5)
+        self._retry_max_backoff : float = retry.get("max_backoff", 10)
+        self._client : httpx.AsyncClient = httpx.AsyncClient(
+            timeout = httpx.Timeout(timeout),
+            limits = httpx.Limits(
+                max_connections = pool.get("max_connections"),
+                max_keepalive_connections = pool.get("max_keepalive_connections"),
+                keepalive_expiry = pool.get("keepalive_expiry")))
+
+    async def _post(self, payload : Dict[str, Any]) -> Dict[str, Any]:
+        # 网络错误和5xx按指数退避加随机抖动重试，JSON-RPC错误直接返回给调用方
+        data = json.dumps(payload)
+        attempt = 0
+        while True:
+            try:
+                response = await self._client.post(self.address, content=data)
+                if response.status_code < 500:
+                    return json.loads(response.text)
+                error : Exception = Exception(f"aria2 {self.name} responded {response.status_code}")
+            except httpx.TransportError as e:
+                error = e
+            attempt += 1
+            if attempt >= self._retry_attempts:
+                raise error
+            delay = random.uniform(0, min(self._retry_max_backoff, self._retry_backoff * (2 ** attempt)))
+            logging.warning(f"aria2 {self.name} request failed, retry in {delay:.2f}s, exception occurred: {error}")
+            await asyncio.sleep(delay)
+
+    async def Call(self, method : str, *params : Any) -> Any:
+        result = await self._post({
+            "jsonrpc" : "2.0",
+            "id" : "pikpak",
+            "method" : method,
+            "params" : [ f"token:{self.secret}", *params]
+        })
+        if "error" in result:
+            raise Aria2RpcError(result["error"].get("code"), result["error"].get("message", ""))
+        return result["result"]
+
+    async def MultiCall(self, calls : list[tuple[str, list[Any]]]) -> list[Any]:
+        # 用system.multicall一次请求执行多个调用，失败的调用对应位置为Aria2RpcError
+        if len(calls) == 0:
+            return []
+        result = await self._post({
+            "jsonrpc" : "2.0",
+            "id" : "pikpak",
+            "method" : "system.multicall",
+            "params" : [[{
+                "methodName" : method,
+                "params" : [ f"token:{self.secret}", *params]
+            } for method, params in calls]]
+        })
+        if "error" in result:
+            raise Aria2RpcError(result["error"].get("code"), result["error"].get("message", ""))
+        # 成功时是只有一个元素的列表，失败时是包含code和message的字典
+        return [item[0] if isinstance(item, list) and len(item) > 0 else Aria2RpcError(item.get("code"), item.get("message", ""))
+                for item in result["result"]]
+
+    async def Load(self) -> float:
+        stat = await self.Call("aria2.getGlobalStat")
+        return (int(stat["numActive"]) + int(stat["numWaiting"])) / max(self.weight, 1e-6)
+
+    async def Close(self) -> None:
+        await self._client.aclose()
+
+class Aria2Client:
+    def __init__(self, backends : list[Aria2Backend], poll_interval : float = 3):
+        if len(backends) == 0:
+            raise Exception("at least one aria2 backend is required")
+        self._backends : Dict[str, Aria2Backend] = {backend.name : backend for backend in backends}
+        self._default : Aria2Backend = backends[0]
+        self.poll_interval : float = poll_interval
+
+    @classmethod
+    def FromConfig(cls, path : str = ARIA2_CONFIG_PATH) -> "Aria2Client":
+        config : Dict[str, Any] = DEFAULT_ARIA2_CONFIG
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                config = {**DEFAULT_ARIA2_CONFIG, **json.load(file)}
+        backends = [Aria2Backend(
+                name = backend.get("name", f"aria2-{index}"),
+                address = backend["address"],
+                secret = backend.get("secret", ""),
+                base_path = backend.get("base_path", "/downloads"),
+                weight = backend.get("weight", 1),
+                websocket_address = backend.get("websocket_address"),
+                timeout = backend.get("timeout", config["timeout"]),
+                pool = backend.get("pool", config["pool"]),
+                retry = backend.get("retry", config["retry"]))
+            for index, backend in enumerate(config["backends"])]
+        return cls(backends, config.get("poll_interval", 3))
+
+    def Backends(self) -> list[Aria2Backend]:
+        return list(self._backends.values())
+
+    def Backend(self, name : str) -> Aria2Backend:
+        # 旧任务没有记录后端时使用默认后端
+        if name is None:
+            return self._default
+        if name not in self._backends:
+            raise Exception(f"unknown aria2 backend {name}")
+        return self._backends[name]
+
+    async def _pick_backend(self) -> Aria2Backend:
+        # 选择按权重折算后排队下载最少的后端，查询失败的后端不参与分配
+        backends = self.Backends()
+        if len(backends) == 1:
+            return backends[0]
+        loads = await asyncio.gather(*[backend.Load() for backend in backends], return_exceptions=True)
+        candidates = [(load, index) for index, load in enumerate(loads) if not isinstance(load, BaseException)]
+        if len(candidates) == 0:
+            raise Exception("no aria2 backend is reachable")
+        _, index = min(candidates)
+        return backends[index]
+
+    async def AddUri(self, uri : str, path : str, backend_name : str = None, options : Dict[str, str] = None) -> tuple[str, str]:
+        backend = self.Backend(backend_name) if backend_name is not None else await self._pick_backend()
+        gid = await backend.Call("aria2.addUri", [uri], {
+            **(options or {}),
+            "dir" : backend.base_path,
+            "out" : path
+        })
+        return backend.name, gid
+
+    async def DownloadSpeed(self, backend_name : str) -> int:
+        stat = await self.Backend(backend_name).Call("aria2.getGlobalStat")
+        return int(stat["downloadSpeed"])
+
+    async def ChangeGlobalOption(self, backend_name : str, options : Dict[str, str]) -> None:
+        # aria2的选项值都是字符串
+        await self.Backend(backend_name).Call("aria2.changeGlobalOption", {key : str(value) for key, value in options.items()})
+
+    async def TellStatus(self, backend_name : str, gid : str) -> Aria2Status:
+        try:
+            result = await self.Backend(backend_name).Call("aria2.tellStatus", gid, ["status"])
+        except Aria2RpcError:
+            return Aria2Status.REMOVED
+        return Aria2Status(result["status"])
+
+    async def TellStatusBatch(self, backend_name : str, gids : list[str]) -> Dict[str, Aria2Status]:
+        results = await self.Backend(backend_name).MultiCall([("aria2.tellStatus", [gid, ["gid", "status"]]) for gid in gids])
+        return {gid : Aria2Status.REMOVED if isinstance(result, Aria2RpcError) else Aria2Status(result["status"])
+                for gid, result in zip(gids, results)}
+
+    async def TellError(self, backend_name : str, gid : str) -> tuple[str, str]:
+        try:
+            result = await self.Backend(backend_name).Call("aria2.tellStatus", gid, ["errorCode", "errorMessage"])
+        except Aria2RpcError as e:
+            return None, e.message
+        return result.get("errorCode"), result.get("errorMessage", "")
+
+    async def Pause(self, backend_name : str, gid : str) -> None:
+        await self.Backend(backend_name).Call("aria2.pause", gid)
+
+    async def Unpause(self, backend_name : str, gid : str) -> None:
+        await self.Backend(backend_name).Call("aria2.unpause", gid)
+
+    async def Remove(self, backend_name : str, gid : str) -> None:
+        await self.Backend(backend_name).Call("aria2.remove", gid)
+
+    async def RemoveDownloadResult(self, backend_name : str, gid : str) -> None:
+        try:
+            await self.Backend(backend_name).Call("aria2.removeDownloadResult", gid)
+        except Aria2RpcError:
+            pass
+
+    async def Close(self) -> None:
+        for backend in self.Backends():
+            await backend.Close()
+
+class Aria2Monitor:
+    # 共享的aria2状态监视器：按后端批量轮询所有被等待的下载，并通过WebSocket通知立即唤醒
+    NOTIFICATIONS = {
+        "aria2.onDownloadStart",
+        "aria2.onDownloadPause",
+        "aria2.onDownloadStop",
+        "aria2.onDownloadComplete",
+        "aria2.onDownloadError",
+        "aria2.onBtDownloadComplete",
+    }
+    SETTLED_STATUSES = {Aria2Status.PAUSED, Aria2Status.ERROR, Aria2Status.COMPLETE, Aria2Status.REMOVED}
+
+    def __init__(self, client : Aria2Client):
+        self._client : Aria2Client = client
+        self._waiters : Dict[tuple[str, str], list[asyncio.Future]] = {}
+        self._wakeup : asyncio.Event = asyncio.Event()
+        self._poll_task : asyncio.Task = None
+        self._websocket_tasks : list[asyncio.Task] = []
+
+    def Start(self) -> None:
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll_loop())
+        if len(self._websocket_tasks) == 0 and websockets is not None:
+            self._websocket_tasks = [asyncio.create_task(self._websocket_loop(backend)) for backend in self._client.Backends()]
+
+    def Stop(self) -> None:
+        for task in [self._poll_task, *self._websocket_tasks]:
+            if task is not None:
+                task.cancel()
+        self._poll_task = None
+        self._websocket_tasks = []
+
+    async def Wait(self, backend_name : str, gid : str) -> Aria2Status:
+        # 等待下载离开active/waiting状态，返回新的状态
+        key = (self._client.Backend(backend_name).name, gid)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append(future)
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            waiters = self._waiters.get(key, [])
+            if future in waiters:
+                waiters.remove(future)
+            if len(waiters) == 0:
+                self._waiters.pop(key, None)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            try:
+                if len(self._waiters) == 0:
+                    await self._wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout = self._client.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"aria2 monitor poll failed, exception occurred: {e}")
+                await asyncio.sleep(self._client.poll_interval)
+
+    async def _poll(self) -> None:
+        gids_by_backend : Dict[str, list[str]] = {}
+        for backend_name, gid in self._waiters.keys():
+            gids_by_backend.setdefault(backend_name, []).append(gid)
+        backend_names = list(gids_by_backend.keys())
+        results = await asyncio.gather(*[self._client.TellStatusBatch(name, gids_by_backend[name]) for name in backend_names], return_exceptions=True)
+        for backend_name, statuses in zip(backend_names, results):
+            if isinstance(statuses, BaseException):
+                logging.error(f"aria2 {backend_name} status query failed, exception occurred: {statuses}")
+                continue
+            for gid, status in statuses.items():
+                if status not in self.SETTLED_STATUSES:
+                    continue
+                for future in self._waiters.pop((backend_name, gid), []):
+                    if not future.done():
+                        future.set_result(status)
+
+    async def _websocket_loop(self, backend : Aria2Backend) -> None:
+        backoff_seconds = 1
+        while True:
+            try:
+                async with websockets.connect(backend.websocket_address) as connection:
+                    backoff_seconds = 1
+                    async for message in connection:
+                        notification : Dict[str, Any] = json.loads(message)
+                        if notification.get("method") not in self.NOTIFICATIONS:
+                            continue
+                        gids = [event.get("gid") for event in notification.get("params", [])]
+                        if any((backend.name, gid) in self._waiters for gid in gids):
+                            self._wakeup.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"aria2 {backend.name} websocket disconnected, exception occurred: {e}")
+            await asyncio.sleep(backoff_seconds)
+            backoff_seconds = min(backoff_seconds * 2, 60)
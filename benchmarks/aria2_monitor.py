@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import time
+from typing import Dict
+from mock_aria2 import MockAria2
+
+import aria2helper
+from aria2helper import Aria2Backend, Aria2Client, Aria2Monitor, Aria2Status
+
+# 对着本地模拟的aria2测量Aria2Monitor：同时等待的下载应该每轮只产生一次system.multicall请求，
+# 打开WebSocket时下载结束后几毫秒内就能察觉，只靠轮询时平均要等半个轮询间隔
+# 用法: python benchmarks/aria2_monitor.py --downloads 10 100 1000 --poll-interval 3
+
+async def run(downloads : int, duration : float, poll_interval : float, fail_rate : float, use_websocket : bool) -> Dict[str, float]:
+    server = MockAria2(duration = duration, fail_rate = fail_rate)
+    address, websocket_address = await server.Start()
+    backend = Aria2Backend("mock", address, "", "/downloads", websocket_address = websocket_address, retry = {"attempts" : 1})
+    client = Aria2Client([backend], poll_interval)
+    monitor = Aria2Monitor(client)
+    # 关掉WebSocket时只剩轮询
+    module_websockets = aria2helper.websockets
+    if not use_websocket:
+        aria2helper.websockets = None
+    try:
+        monitor.Start()
+        await client.ChangeGlobalOption("mock", {"max-concurrent-downloads" : downloads})
+        gids = [(await client.AddUri(f"http://example.invalid/{i}", f"file{i}.bin", "mock"))[1] for i in range(downloads)]
+        requests_before = server.http_requests
+        settled : Dict[str, float] = {}
+
+        async def wait(gid : str) -> Aria2Status:
+            status = await monitor.Wait("mock", gid)
+            settled[gid] = time.perf_counter()
+            return status
+
+        statuses = await asyncio.gather(*[wait(gid) for gid in gids])
+        latencies = [settled[gid] - server.finished[gid] for gid in gids]
+        return {
+            "complete" : statuses.count(Aria2Status.COMPLETE),
+            "error" : statuses.count(Aria2Status.ERROR),
+            "requests" : server.http_requests - requests_before,
+            "tell_status" : server.calls.get("aria2.tellStatus", 0),
+            "mean_ms" : sum(latencies) / len(latencies) * 1e3,
+            "max_ms" : max(latencies) * 1e3,
+        }
+    finally:
+        aria2helper.websockets = module_websockets
+        monitor.Stop()
+        await client.Close()
+        await server.Close()
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--downloads", type = int, nargs = "+", default = [10, 100, 1000])
+    parser.add_argument("--duration", type = float, default = 1, help = "seconds each mock download stays active")
+    parser.add_argument("--poll-interval", type = float, default = 3)
+    parser.add_argument("--fail-rate", type = float, default = 0.1)
+    args = parser.parse_args()
+    print(f"{'downloads':>10} {'websocket':>10} {'complete':>9} {'error':>6} {'requests':>9} {'tellStatus':>11} {'mean ms':>9} {'max ms':>9}")
+    for downloads in args.downloads:
+        for use_websocket in (False, True):
+            result = await run(downloads, args.duration, args.poll_interval, args.fail_rate, use_websocket)
+            print(f"{downloads:>10} {str(use_websocket):>10} {result['complete']:>9} {result['error']:>6} {result['requests']:>9} "
+                  f"{result['tell_status']:>11} {result['mean_ms']:>9.1f} {result['max_ms']:>9.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+import time
+from range_server import RangeServer
+
+from HttpDownloader import HttpDownloader, ChunkBitmap
+
+# 对着本地的Range服务测量内置下载器：不同连接数下的吞吐量，以及下载中途断开后能否按分块位图续传
+# (续传时只请求位图里缺少的分块，已完成的分块不会再下载)
+# 用法: python benchmarks/http_download.py --size 256 --connections 1 4 8
+
+async def throughput(url : str, size : int, digest : str, connections : int, chunk_size : int) -> tuple[float, bool]:
+    with tempfile.TemporaryDirectory() as base_path:
+        downloader = HttpDownloader(base_path, connections, chunk_size)
+        try:
+            start = time.perf_counter()
+            await downloader.Download(url, "file.bin", connections = connections)
+            elapsed = time.perf_counter() - start
+        finally:
+            await downloader.Close()
+        with open(downloader.LocalPath("file.bin"), "rb") as file:
+            ok = hashlib.sha1(file.read()).hexdigest() == digest
+    return size / elapsed, ok
+
+async def resume(server : RangeServer, url : str, size : int, digest : str, connections : int, chunk_size : int, cut_fraction : float) -> None:
+    with tempfile.TemporaryDirectory() as base_path:
+        downloader = HttpDownloader(base_path, connections, chunk_size)
+        local_path = downloader.LocalPath("file.bin")
+        try:
+            server.cut_after = int(size * cut_fraction)
+            try:
+                await downloader.Download(url, "file.bin", identity = "file")
+                raise Exception("download was not interrupted")
+            except Exception as e:
+                print(f"interrupted after {server.bytes_sent / 2**20:.1f} MiB: {type(e).__name__}")
+            bitmap = ChunkBitmap.Load(local_path + ".chunks", size, chunk_size, "file")
+            done = [index for index in range(bitmap.count) if bitmap.IsDone(index)]
+            print(f"chunk bitmap: {len(done)}/{bitmap.count} chunks done, {bitmap.DoneBytes() / 2**20:.1f} MiB")
+
+            server.cut_after = None
+            server.ResetStats()
+            await downloader.Download(url, "file.bin", identity = "file")
+        finally:
+            await downloader.Close()
+        # 探测请求只发送1个字节，其余都应该是缺少的分块
+        refetched = [start // chunk_size for _, start, _ in server.requests[1:]]
+        expected = size - bitmap.DoneBytes() + 1
+        with open(local_path, "rb") as file:
+            ok = hashlib.sha1(file.read()).hexdigest() == digest
+        print(f"resumed: {server.bytes_sent / 2**20:.1f} MiB sent (expected {expected / 2**20:.1f} MiB), "
+              f"done chunks re-requested: {sorted(set(refetched) & set(done))}, content ok: {ok}, "
+              f"bitmap removed: {not os.path.exists(local_path + '.chunks')}")
+        if server.bytes_sent != expected or len(set(refetched) & set(done)) > 0 or not ok:
+            raise Exception("resume did not continue from the chunk bitmap")
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type = int, default = 64, help = "file size in MiB")
+    parser.add_argument("--connections", type = int, nargs = "+", default = [1, 4, 8])
+    parser.add_argument("--chunk-size", type = int, default = 4, help = "chunk size in MiB")
+    parser.add_argument("--cut-fraction", type = float, default = 0.5, help = "fraction of the file sent before the connection is cut")
+    args = parser.parse_args()
+    size, chunk_size = args.size << 20, args.chunk_size << 20
+    content = random.Random(0).randbytes(size)
+    digest = hashlib.sha1(content).hexdigest()
+    server = RangeServer({"/file.bin": content})
+    url = await server.Start() + "/file.bin"
+    try:
+        print(f"{'connections':>12} {'MiB/s':>10} {'content ok':>11}")
+        for connections in args.connections:
+            speed, ok = await throughput(url, size, digest, connections, chunk_size)
+            print(f"{connections:>12} {speed / 2**20:>10.1f} {str(ok):>11}")
+        server.ResetStats()
+        await resume(server, url, size, digest, max(args.connections), chunk_size, args.cut_fraction)
+    finally:
+        await server.Close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
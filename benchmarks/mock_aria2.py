@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Dict
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 本地模拟的aria2 JSON-RPC服务：HTTP端口接受调用，WebSocket端口推送下载完成/失败通知；
+# 下载不会真的进行，只是在duration秒后按fail_rate随机变为complete或error
+# 单独运行: python benchmarks/mock_aria2.py --port 6800 --websocket-port 6801
+
+class Aria2Error(Exception):
+    def __init__(self, code : int, message : str):
+        super().__init__(message)
+        self.code : int = code
+        self.message : str = message
+
+class MockAria2:
+    def __init__(self, secret : str = "", duration : float = 1, fail_rate : float = 0, max_concurrent_downloads : int = 5):
+        self.secret : str = secret
+        self.duration : float = duration
+        self.fail_rate : float = fail_rate
+        self.options : Dict[str, str] = {"max-concurrent-downloads" : str(max_concurrent_downloads)}
+        # gid -> 下载状态，字段名与aria2.tellStatus的返回一致
+        self.downloads : Dict[str, Dict[str, str]] = {}
+        # gid -> 下载结束(变为complete或error)的时间，用来测量客户端多久后察觉
+        self.finished : Dict[str, float] = {}
+        self._waiting : list[str] = []
+        self._next_gid : int = 1
+        self._sockets : set = set()
+        self._timers : set[asyncio.Task] = set()
+        self._http_server : asyncio.Server = None
+        self._websocket_server = None
+        # 统计：HTTP请求数和每个方法被调用的次数(包括multicall里的子调用)
+        self.http_requests : int = 0
+        self.calls : Dict[str, int] = {}
+
+    async def Start(self, host : str = "127.0.0.1", port : int = 0, websocket_port : int = 0) -> tuple[str, str]:
+        # 返回JSON-RPC地址和WebSocket地址，端口为0时由系统分配
+        self._http_server = await asyncio.start_server(self._serve_http, host, port)
+        self._websocket_server = await websockets.serve(self._serve_websocket, host, websocket_port)
+        port = self._http_server.sockets[0].getsockname()[1]
+        websocket_port = self._websocket_server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/jsonrpc", f"ws://{host}:{websocket_port}/jsonrpc"
+
+    async def Close(self) -> None:
+        for timer in list(self._timers):
+            timer.cancel()
+        self._http_server.close()
+        self._websocket_server.close()
+        await self._http_server.wait_closed()
+        await self._websocket_server.wait_closed()
+
+    def _max_active(self) -> int:
+        return int(self.options.get("max-concurrent-downloads", "5"))
+
+    def _count(self, status : str) -> int:
+        return sum(1 for download in self.downloads.values() if download["status"] == status)
+
+    def _start_waiting(self) -> None:
+        while len(self._waiting) > 0 and self._count("active") < self._max_active():
+            gid = self._waiting.pop(0)
+            self.downloads[gid]["status"] = "active"
+            timer = asyncio.ensure_future(self._finish(gid))
+            self._timers.add(timer)
+            timer.add_done_callback(self._timers.discard)
+
+    async def _finish(self, gid : str) -> None:
+        await asyncio.sleep(self.duration)
+        download = self.downloads.get(gid)
+        if download is None or download["status"] != "active":
+            return
+        if random.random() < self.fail_rate:
+            download.update({"status" : "error", "errorCode" : "3", "errorMessage" : "Resource not found"})
+            method = "aria2.onDownloadError"
+        else:
+            download.update({"status" : "complete", "completedLength" : download["totalLength"]})
+            method = "aria2.onDownloadComplete"
+        self.finished[gid] = time.perf_counter()
+        self._start_waiting()
+        message = json.dumps({"jsonrpc" : "2.0", "method" : method, "params" : [{"gid" : gid}]})
+        for socket in list(self._sockets):
+            try:
+                await socket.send(message)
+            except websockets.ConnectionClosed:
+                self._sockets.discard(socket)
+
+    def _call(self, method : str, params : list[Any]) -> Any:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if len(params) == 0 or params[0] != f"token:{self.secret}":
+            raise Aria2Error(1, "Unauthorized")
+        params = params[1:]
+        if method == "aria2.addUri":
+            gid = f"{self._next_gid:016x}"
+            self._next_gid += 1
+            options = params[1] if len(params) > 1 else {}
+            self.downloads[gid] = {"gid" : gid, "status" : "waiting", "totalLength" : "1048576", "completedLength" : "0",
+                                   "dir" : options.get("dir", ""), "out" : options.get("out", "")}
+            self._waiting.append(gid)
+            self._start_waiting()
+            return gid
+        if method == "aria2.tellStatus":
+            download = self.downloads.get(params[0])
+            if download is None:
+                raise Aria2Error(1, f"GID {params[0]} is not found")
+            keys = params[1] if len(params) > 1 else list(download.keys())
+            return {key : download[key] for key in keys if key in download}
+        if method == "aria2.getGlobalStat":
+            return {"downloadSpeed" : str(self._count("active") * 1048576), "uploadSpeed" : "0",
+                    "numActive" : str(self._count("active")), "numWaiting" : str(len(self._waiting)),
+                    "numStopped" : str(len(self.downloads) - self._count("active") - len(self._waiting))}
+        if method == "aria2.changeGlobalOption":
+            self.options.update(params[0])
+            self._start_waiting()
+            return "OK"
+        raise Aria2Error(1, f"No such method: {method}")
+
+    def _handle(self, request : Dict[str, Any]) -> Dict[str, Any]:
+        response : Dict[str, Any] = {"jsonrpc" : "2.0", "id" : request.get("id")}
+        try:
+            if request.get("method") == "system.multicall":
+                self.calls["system.multicall"] = self.calls.get("system.multicall", 0) + 1
+                results = []
+                for call in request["params"][0]:
+                    try:
+                        results.append([self._call(call["methodName"], call.get("params", []))])
+                    except Aria2Error as e:
+                        results.append({"code" : e.code, "message" : e.message})
+                response["result"] = results
+            else:
+                response["result"] = self._call(request.get("method"), request.get("params", []))
+        except Aria2Error as e:
+            response["error"] = {"code" : e.code, "message" : e.message}
+        return response
+
+    async def _serve_http(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        # 只支持aria2客户端用到的POST和keep-alive
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers : Dict[str, str] = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if line == "":
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                self.http_requests += 1
+                try:
+                    response = json.dumps(self._handle(json.loads(body))).encode()
+                    status = "200 OK"
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    response = json.dumps({"jsonrpc" : "2.0", "id" : None, "error" : {"code" : -32700, "message" : str(e)}}).encode()
+                    status = "400 Bad Request"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(response)}\r\n\r\n".encode() + response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_websocket(self, socket) -> None:
+        self._sockets.add(socket)
+        try:
+            await socket.wait_closed()
+        finally:
+            self._sockets.discard(socket)
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type = int, default = 6800)
+    parser.add_argument("--websocket-port", type = int, default = 6801)
+    parser.add_argument("--secret", default = "")
+    parser.add_argument("--duration", type = float, default = 5, help = "seconds each download stays active")
+    parser.add_argument("--fail-rate", type = float, default = 0.1)
+    args = parser.parse_args()
+    server = MockAria2(args.secret, args.duration, args.fail_rate)
+    address, websocket_address = await server.Start(port = args.port, websocket_port = args.websocket_port)
+    print(f"listening on {address}, notifications on {websocket_address}")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import time
+import tracemalloc
+from synthetic import SyntheticApi, MakeFileSystem
+
+# 测量目录树中每个节点占用的内存：用合成的API加载指定数量的文件，再像搜索和查找那样取一遍所有节点的路径；
+# 只统计文件系统对象自身新分配的内存，不含合成API里的数据
+# 用法: python benchmarks/node_memory.py --nodes 1000000
+
+async def run(nodes : int, files_per_dir : int) -> tuple[int, int, float]:
+    api = SyntheticApi()
+    dirs = max(1, nodes // files_per_dir)
+    for d in range(dirs):
+        api.Add(f"VD{d:024d}", f"Season {d:05d}", None, True)
+    for i in range(nodes):
+        api.Add(f"VF{i:024d}", f"Some.Show.S{i // files_per_dir:05d}E{i % files_per_dir:04d}.1080p.mkv", f"VD{i // files_per_dir:024d}", False)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    client = MakeFileSystem(api)
+    baseline = tracemalloc.get_traced_memory()[0]
+    root = await client.PathToNode("/")
+    async for _ in client.Walk(root, include_dirs = True):
+        pass
+    for node in list(client._nodes.values()):
+        await client.NodeToPath(root, node)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    return len(client._nodes), used, elapsed
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type = int, default = 1000000)
+    parser.add_argument("--files-per-dir", type = int, default = 1000)
+    args = parser.parse_args()
+    count, used, elapsed = await run(args.nodes, args.files_per_dir)
+    print(f"{count} nodes: {used / 1e6:.1f} MB, {used / count:.0f} bytes/node ({elapsed:.1f}s)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
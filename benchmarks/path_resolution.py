@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import random
+import time
+from synthetic import SyntheticApi, MakeFileSystem
+
+# 测量大目录下按路径查找、改名、删除和重新列目录的耗时随目录大小的变化；
+# 每种操作的单次耗时应该基本不随目录变大而增长
+# 用法: python benchmarks/path_resolution.py --sizes 1000 10000 100000
+
+async def run(size : int, operations : int, duplicates : float) -> tuple[float, float, float, float]:
+    api = SyntheticApi()
+    api.Add("big", "big", None, True)
+    for i in range(size):
+        # 一部分文件同名，覆盖同名子节点的索引
+        name = f"file{i % int(size * (1 - duplicates)) if duplicates > 0 else i}.bin"
+        api.Add(f"f{i}", name, "big", False)
+    client = MakeFileSystem(api)
+    names = [api.tree[f"f{i}"][0] for i in range(size)]
+    await client.GetChildren(await client.PathToNode("/big"))
+
+    start = time.perf_counter()
+    for name in random.choices(names, k = operations):
+        await client.PathToNode(f"/big/{name}")
+    lookup = (time.perf_counter() - start) / operations
+
+    count = min(operations, size)
+    start = time.perf_counter()
+    for i in range(count):
+        await client.Rename(f"/big/{names[i]}", f"renamed{i}.bin")
+    rename = (time.perf_counter() - start) / count
+
+    # 服务端改名后重新列目录，所有子节点都要合并一次
+    node = await client.PathToNode("/big")
+    await client.InvalidateNode(node.id)
+    start = time.perf_counter()
+    await client.GetChildren(node)
+    relist = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        await client.Delete([f"/big/renamed{i}.bin"])
+    delete = (time.perf_counter() - start) / count
+    return lookup, rename, relist, delete
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 10000, 100000])
+    parser.add_argument("--operations", type = int, default = 1000)
+    parser.add_argument("--duplicates", type = float, default = 0.1, help = "fraction of children sharing a name with a sibling")
+    args = parser.parse_args()
+    print(f"{'children':>10} {'lookup us':>10} {'rename us':>10} {'delete us':>10} {'relist ms':>10}")
+    for size in args.sizes:
+        lookup, rename, relist, delete = await run(size, args.operations, args.duplicates)
+        print(f"{size:>10} {lookup * 1e6:>10.1f} {rename * 1e6:>10.1f} {delete * 1e6:>10.1f} {relist * 1e3:>10.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import random
+import re
+import sys
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 本地的HTTP文件服务，支持单个Range请求，可以注入故障：
+# 按概率返回错误状态码、在累计发送一定字节后掐断连接、或者假装不支持Range
+
+# 每次写入socket的大小
+SEND_SIZE = 64 << 10
+
+class RangeServer:
+    def __init__(self, files : Dict[str, bytes], ranged : bool = True):
+        # 路径(如"/file.bin") -> 内容
+        self.files : Dict[str, bytes] = files
+        self.ranged : bool = ranged
+        # 按error_rate的概率返回error_status
+        self.error_rate : float = 0
+        self.error_status : int = 503
+        # 累计发送的正文字节数超过cut_after后，正在发送和之后的响应都在中途断开连接；None表示不注入
+        self.cut_after : int = None
+        # 统计：收到的请求(路径, Range起点, Range终点)和发送的正文字节数
+        self.requests : list[tuple[str, int, int]] = []
+        self.bytes_sent : int = 0
+        self._server : asyncio.Server = None
+
+    async def Start(self, host : str = "127.0.0.1", port : int = 0) -> str:
+        # 返回服务地址，端口为0时由系统分配
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return f"http://{host}:{self._server.sockets[0].getsockname()[1]}"
+
+    async def Close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    def ResetStats(self) -> None:
+        self.requests = []
+        self.bytes_sent = 0
+
+    def _parse_range(self, value : str, size : int) -> tuple[int, int]:
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+        if match is None or (match.group(1) == "" and match.group(2) == ""):
+            return None
+        if match.group(1) == "":
+            # 后缀形式"bytes=-N"表示最后N个字节
+            return max(0, size - int(match.group(2))), size - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) != "" else size - 1
+        return start, min(end, size - 1)
+
+    async def _respond(self, writer : asyncio.StreamWriter, status : str, headers : Dict[str, str], body : bytes) -> bool:
+        # 返回连接是否还能继续使用
+        head = f"HTTP/1.1 {status}\r\n" + "".join(f"{key}: {value}\r\n" for key, value in headers.items()) + "\r\n"
+        writer.write(head.encode())
+        for offset in range(0, len(body), SEND_SIZE):
+            data = body[offset:offset + SEND_SIZE]
+            if self.cut_after is not None and self.bytes_sent + len(data) > self.cut_after:
+                data = data[:max(0, self.cut_after - self.bytes_sent)]
+                writer.write(data)
+                self.bytes_sent += len(data)
+                await writer.drain()
+                return False
+            writer.write(data)
+            self.bytes_sent += len(data)
+            await writer.drain()
+        return True
+
+    async def _serve(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = (await reader.readline()).decode()
+                if not request_line:
+                    break
+                method, path, _ = request_line.split(" ", 2)
+                headers : Dict[str, str] = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if line == "":
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                content = self.files.get(path)
+                span = self._parse_range(headers["range"], len(content)) if self.ranged and content is not None and "range" in headers else None
+                self.requests.append((path, *(span or (None, None))))
+                if content is None:
+                    alive = await self._respond(writer, "404 Not Found", {"Content-Length": "0"}, b"")
+                elif random.random() < self.error_rate:
+                    alive = await self._respond(writer, f"{self.error_status} Injected", {"Content-Length": "0"}, b"")
+                elif span is None:
+                    body = content if method != "HEAD" else b""
+                    alive = await self._respond(writer, "200 OK", {"Content-Length": str(len(content))}, body)
+                elif span[0] >= len(content):
+                    alive = await self._respond(writer, "416 Range Not Satisfiable",
+                                                {"Content-Range": f"bytes */{len(content)}", "Content-Length": "0"}, b"")
+                else:
+                    start, end = span
+                    body = content[start:end + 1] if method != "HEAD" else b""
+                    alive = await self._respond(writer, "206 Partial Content",
+                                                {"Content-Range": f"bytes {start}-{end}/{len(content)}", "Content-Length": str(end - start + 1)}, body)
+                if not alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import sys
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PikPakFileSystem import PikPakFileSystem
+
+class SyntheticApi:
+    # 在内存中模拟PikPak的目录接口，用于不联网地测量目录树本身的开销
+    def __init__(self, page_size : int = 1000):
+        self.page_size : int = page_size
+        # id -> (名字, 父目录id, 是否目录)
+        self.tree : Dict[str, tuple[str, str, bool]] = {}
+        self.children : Dict[str, list[str]] = {}
+        self.requests : int = 0
+        self.username : str = "benchmark"
+        self.password : str = "benchmark"
+
+    def Add(self, id : str, name : str, father_id : str, is_dir : bool) -> None:
+        self.tree[id] = (name, father_id, is_dir)
+        self.children.setdefault(father_id, []).append(id)
+
+    def _info(self, id : str) -> Dict[str, Any]:
+        name, father_id, is_dir = self.tree[id]
+        return {"id": id, "name": name, "parent_id": father_id, "kind": "drive#folder" if is_dir else "drive#file",
+                "size": "0" if is_dir else "1048576", "modified_time": "2024-01-01T00:00:00+00:00",
+                "hash": "" if is_dir else hashlib.sha1(id.encode()).hexdigest().upper()}
+
+    async def file_list(self, size : int = 100, parent_id : str = None, next_page_token : str = None, additional_filters : Dict[str, Any] = None) -> Dict[str, Any]:
+        self.requests += 1
+        ids = self.children.get(parent_id, [])
+        start = int(next_page_token or 0)
+        end = start + self.page_size
+        return {"files": [self._info(id) for id in ids[start:end]], "next_page_token": str(end) if end < len(ids) else ""}
+
+    async def file_rename(self, id : str, new_file_name : str) -> Dict[str, Any]:
+        _, father_id, is_dir = self.tree[id]
+        self.tree[id] = (new_file_name, father_id, is_dir)
+        return self._info(id)
+
+    async def delete_to_trash(self, ids : list[str]) -> Dict[str, Any]:
+        for id in ids:
+            _, father_id, _ = self.tree.pop(id)
+            self.children[father_id].remove(id)
+        return {}
+
+def MakeFileSystem(api : SyntheticApi, **kwargs) -> PikPakFileSystem:
+    # 关闭限速，只测量本地的开销
+    client = PikPakFileSystem(api_rate = 0, **kwargs)
+    client._pikpak_client = api
+    return client
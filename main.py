@@ -1,14 +1,17 @@
 import asyncio, nest_asyncio
+import concurrent.futures
+import argparse
 import cmd2
 from functools import wraps
 import logging
 import threading
+import time
 import colorlog
-from PikPakFileSystem import PikPakFileSystem
+from PikPakFileSystem import PikPakFileSystem, BatchResult
 import os
 from tabulate import tabulate
 import types
-from TaskManager import TaskManager, TaskStatus, TorrentTask, FileDownloadTask
+from TaskManager import TaskManager, TaskStatus, TorrentTask, FileDownloadTask, UploadTask, ENGINE_ARIA2, ENGINE_HTTP, SCHEDULE_POLICIES
 
 LogFormatter = colorlog.ColoredFormatter(
         "%(log_color)s%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -34,7 +37,31 @@ def setup_logging():
 
 setup_logging()
 MainLoop : asyncio.AbstractEventLoop = None
-Client = PikPakFileSystem(auth_cache_path = "token.json", proxy_address="http://127.0.0.1:7897")
+# 单次Tab补全最多等待的秒数
+COMPLETION_TIMEOUT = 0.2
+Client = PikPakFileSystem(auth_cache_path = "token.json", proxy_address="http://127.0.0.1:7897", metadata_cache_path = "metadata.db", prefetch_children = 8)
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def ParseSize(text : str) -> int:
+    # 解析"1.5G"、"700M"、"1024"这样的大小
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    try:
+        return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def ParseDuration(text : str) -> float:
+    # 解析"90s"、"30m"、"2h"这样的时长，没有单位时按分钟
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:] in DURATION_UNITS else "m"
+    try:
+        return float(text.rstrip("smhd")) * DURATION_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: {text}")
 
 class RunSync:
     _current_task : asyncio.Task = None
@@ -166,27 +193,35 @@ class App(cmd2.Cmd):
         await Client.Login(args.username, args.password)
         await self.print("Logged in successfully")
 
-    async def _path_completer(self, text, line, begidx, endidx, ignore_files):   
-        father_path, son_name = await Client.SplitPath(text)
-        children_names = await Client.GetChildrenNames(father_path, ignore_files)
+    def _path_completer(self, text, line, begidx, endidx, ignore_files):
+        # 补全在IO线程中执行，只读取内存中的目录树并限制等待时间，避免网络请求卡住输入
+        future = asyncio.run_coroutine_threadsafe(Client.CompletePath(text, ignore_files), MainLoop)
+        try:
+            son_name, candidates = future.result(timeout = COMPLETION_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logging.debug(f"path completion of {text} timed out")
+            return []
         matches : list[str] = []
-        for child_name in children_names:
-            if child_name.startswith(son_name):
-                self.display_matches.append(child_name)
-                if son_name == "":
-                    matches.append(text + child_name)
-                elif text.endswith(son_name):
-                    matches.append(text[:text.rfind(son_name)] + child_name)
-        if len(matches) == 1 and await Client.IsDir(matches[0]):
+        is_dirs : list[bool] = []
+        for child_name, is_dir in candidates:
+            self.display_matches.append(child_name)
+            if son_name == "":
+                matches.append(text + child_name)
+            elif text.endswith(son_name):
+                matches.append(text[:text.rfind(son_name)] + child_name)
+            else:
+                continue
+            is_dirs.append(is_dir)
+        if len(matches) == 1 and is_dirs[0]:
             if matches[0].endswith(son_name):
                 matches[0] += "/"
             self.allow_appended_space = False
             self.allow_closing_quote = False
         return matches
 
-    @RunSync
-    async def complete_ls(self, text, line, begidx, endidx):
-        return await self._path_completer(text, line, begidx, endidx, False)
+    def complete_ls(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
 
     ls_parser = cmd2.Cmd2ArgumentParser()
     ls_parser.add_argument("path", help="path", default="", nargs="?")
@@ -197,14 +232,46 @@ class App(cmd2.Cmd):
         List files in a directory
         """
         if await Client.IsDir(args.path):
-            for child_name in await Client.GetChildrenNames(args.path, False):
-                await self.print(child_name)
+            # 每页合并成一次输出，避免每个名字都跨线程打印一次
+            async for children_names in Client.ListChildrenNames(args.path, False):
+                await self.print("\n".join(children_names))
         else:
             await self.print(await Client.GetFileUrlByPath(args.path))
     
+    def complete_find(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, True)
+
+    find_parser = cmd2.Cmd2ArgumentParser()
+    find_parser.add_argument("path", help="directory to search", default="", nargs="?")
+    find_parser.add_argument("-n", "--name", help="name glob, case insensitive, e.g. *.mkv")
+    find_parser.add_argument("--min-size", help="minimum file size, e.g. 1G", type=ParseSize)
+    find_parser.add_argument("--max-size", help="maximum file size, e.g. 500M", type=ParseSize)
+    find_parser.add_argument("-t", "--type", help="type", choices=["file", "dir"])
+    find_parser.add_argument("-l", "--limit", help="stop after this many matches", type=int)
+    @cmd2.with_argparser(find_parser)
     @RunSync
-    async def complete_cd(self, text, line, begidx, endidx):
-        return await self._path_completer(text, line, begidx, endidx, True)
+    async def do_find(self, args):
+        """
+        Find files or directories by name, size and type
+        """
+        async for path, node in Client.Find(args.path, args.name, args.min_size, args.max_size, args.type, args.limit):
+            await self.print(path)
+
+    search_parser = cmd2.Cmd2ArgumentParser()
+    search_parser.add_argument("query", help="words that must all appear in the name", nargs="+")
+    search_parser.add_argument("-l", "--limit", help="maximum number of results", type=int, default=50)
+    @cmd2.with_argparser(search_parser)
+    @RunSync
+    async def do_search(self, args):
+        """
+        Search names in the locally loaded tree, best matches first
+        """
+        results = await Client.Search(" ".join(args.query), args.limit)
+        if len(results) > 0:
+            await self.print("\n".join(path for path, _ in results))
+
+    def complete_cd(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, True)
 
     cd_parser = cmd2.Cmd2ArgumentParser()
     cd_parser.add_argument("path", help="path", default="", nargs="?")
@@ -223,15 +290,22 @@ class App(cmd2.Cmd):
         """
         await self.print(await Client.GetCwd())
 
+    @RunSync
+    async def do_prefetch_stats(self, args):
+        """
+        Print directory prefetch hit/miss counters
+        """
+        stats = Client.GetPrefetchStats()
+        await self.print(tabulate([list(stats.values())], list(stats.keys()), tablefmt="grid"))
+
     def do_clear(self, args):
         """
         Clear the terminal screen
         """
         os.system('cls' if os.name == 'nt' else 'clear')
 
-    @RunSync
-    async def complete_rm(self, text, line, begidx, endidx):
-        return await self._path_completer(text, line, begidx, endidx, False)
+    def complete_rm(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
 
     rm_parser = cmd2.Cmd2ArgumentParser()
     rm_parser.add_argument("paths", help="paths", default="", nargs="+")
@@ -239,13 +313,62 @@ class App(cmd2.Cmd):
     @RunSync
     async def do_rm(self, args):
         """
-        Remove a file or directory
+        Remove files or directories, the last path component may be a glob
         """
-        await Client.Delete(args.paths)
+        await self._print_batch_result(await Client.Delete(args.paths))
+
+    async def _print_batch_result(self, result : BatchResult):
+        if len(result.failed) > 0:
+            await self.print(tabulate(result.failed, ["path", "error"], tablefmt="grid"))
+        await self.print(f"{len(result.succeeded)} succeeded, {len(result.failed)} failed")
 
+    def complete_mv(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
+
+    mv_parser = cmd2.Cmd2ArgumentParser()
+    mv_parser.add_argument("sources", help="paths to move, the last path component may be a glob", nargs="+")
+    mv_parser.add_argument("target", help="target directory, or the new path when moving a single item")
+    @cmd2.with_argparser(mv_parser)
+    @RunSync
+    async def do_mv(self, args):
+        """
+        Move or rename files and directories
+        """
+        if await Client.IsDir(args.target):
+            await self._print_batch_result(await Client.Move(args.sources, args.target))
+            return
+        if len(args.sources) != 1:
+            await self.print("Target must be a directory when moving multiple items")
+            return
+        # 目标不是已有目录时按"移动到目标所在目录并改名"处理
+        father_path, new_name = await Client.SplitPath(args.target)
+        source_father_path, source_name = await Client.SplitPath(args.sources[0])
+        source = args.sources[0]
+        if await Client.PathToNode(father_path) is not await Client.PathToNode(source_father_path):
+            result = await Client.Move(args.sources, father_path)
+            if len(result.failed) > 0:
+                await self._print_batch_result(result)
+                return
+            source = father_path.rstrip("/") + "/" + source_name
+        if new_name != source_name:
+            await Client.Rename(source, new_name)
+
+    def complete_cp(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
+
+    cp_parser = cmd2.Cmd2ArgumentParser()
+    cp_parser.add_argument("sources", help="paths to copy, the last path component may be a glob", nargs="+")
+    cp_parser.add_argument("target", help="target directory")
+    @cmd2.with_argparser(cp_parser)
     @RunSync
-    async def complete_mkdir(self, text, line, begidx, endidx):
-        return await self._path_completer(text, line, begidx, endidx, True)
+    async def do_cp(self, args):
+        """
+        Copy files and directories into a directory
+        """
+        await self._print_batch_result(await Client.Copy(args.sources, args.target))
+
+    def complete_mkdir(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, True)
 
     mkdir_parser = cmd2.Cmd2ArgumentParser()
     mkdir_parser.add_argument("path", help="new directory path")
@@ -259,33 +382,63 @@ class App(cmd2.Cmd):
 
     download_parser = cmd2.Cmd2ArgumentParser()
     download_parser.add_argument("torrent", help="torrent")
+    download_parser.add_argument("-e", "--engine", help="download engine, defaults to aria2", choices=[ENGINE_ARIA2, ENGINE_HTTP])
     @cmd2.with_argparser(download_parser)
     @RunSync
     async def do_download(self, args):
         """
         Download a file or directory
         """
-        task_id = await self.task_manager.CreateTorrentTask(args.torrent, await Client.GetCwd())
+        task_id = await self.task_manager.CreateTorrentTask(args.torrent, await Client.GetCwd(), args.engine)
         await self.print(f"Task {task_id} created")
 
-    @RunSync
-    async def complete_pull(self, text, line, begidx, endidx):
-        return await self._path_completer(text, line, begidx, endidx, False)
+    def complete_pull(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
 
     pull_parser = cmd2.Cmd2ArgumentParser()
     pull_parser.add_argument("target", help="pull target")
+    pull_parser.add_argument("-e", "--engine", help="download engine, defaults to aria2", choices=[ENGINE_ARIA2, ENGINE_HTTP])
     @cmd2.with_argparser(pull_parser)
     @RunSync
     async def do_pull(self, args):
         """
         Pull a file or directory
         """
-        task_id = await self.task_manager.PullRemote(args.target)
+        task_id = await self.task_manager.PullRemote(args.target, args.engine)
         await self.print(f"Task {task_id} created")
         
 
+    def complete_sync(self, text, line, begidx, endidx):
+        return self._path_completer(text, line, begidx, endidx, False)
+
+    sync_parser = cmd2.Cmd2ArgumentParser()
+    sync_parser.add_argument("target", help="remote file or directory")
+    sync_parser.add_argument("-l", "--local-dir", help="aria2 download directory as seen from this machine, used to verify and delete local files")
+    sync_parser.add_argument("-d", "--delete", help="delete local files that no longer exist remotely", action="store_true")
+    sync_parser.add_argument("-e", "--engine", help="download engine, defaults to aria2", choices=[ENGINE_ARIA2, ENGINE_HTTP])
+    @cmd2.with_argparser(sync_parser)
+    @RunSync
+    async def do_sync(self, args):
+        """
+        Download only new or changed files of a remote file or directory
+        """
+        task_id = await self.task_manager.SyncRemote(args.target, args.local_dir, args.delete, args.engine)
+        await self.print(f"Task {task_id} created")
+
+    push_parser = cmd2.Cmd2ArgumentParser()
+    push_parser.add_argument("local_path", help="local file or directory", completer=cmd2.Cmd.path_complete)
+    push_parser.add_argument("remote_dir", help="remote directory, defaults to the current directory", default="", nargs="?")
+    @cmd2.with_argparser(push_parser)
+    @RunSync
+    async def do_push(self, args):
+        """
+        Upload a local file or directory
+        """
+        task_ids = await self.task_manager.CreateUploadTasks(args.local_path, args.remote_dir)
+        await self.print(f"{len(task_ids)} upload tasks created")
+
     query_parser = cmd2.Cmd2ArgumentParser()
-    query_parser.add_argument("-t", "--type", help="type", nargs="?", choices=["torrent", "file"], default="torrent")
+    query_parser.add_argument("-t", "--type", help="type", nargs="?", choices=["torrent", "file", "upload"], default="torrent")
     query_parser.add_argument("-f", "--filter", help="filter", nargs="?", choices=[member.value for member in TaskStatus])
     @cmd2.with_argparser(query_parser)
     @RunSync
@@ -297,14 +450,70 @@ class App(cmd2.Cmd):
         if args.type == "torrent":
             tasks = await self.task_manager.QueryTasks(TorrentTask.TAG, filter_status)
             # 格式化输出所有task信息id，status，lastStatus的信息，输出表格
-            table = [[task.id, task.status.value, task.torrent_status.value, task.info] for task in tasks if isinstance(task, TorrentTask)]
-            headers = ["id", "status", "details", "progress"]
+            table = [[task.id, task.status.value, task.torrent_status.value, task.priority, task.info] for task in tasks if isinstance(task, TorrentTask)]
+            headers = ["id", "status", "details", "priority", "progress"]
             await self.print(tabulate(table, headers, tablefmt="grid"))
         elif args.type == "file":
             tasks = await self.task_manager.QueryTasks(FileDownloadTask.TAG, filter_status)
-            table = [[task.id, task.status.value, task.file_download_status, task.remote_path] for task in tasks if isinstance(task, FileDownloadTask)]
-            headers = ["id", "status", "details", "remote_path"]
+            table = [[task.id, task.status.value, task.file_download_status.value, task.priority, task.engine, task.info, task.remote_path] for task in tasks if isinstance(task, FileDownloadTask)]
+            headers = ["id", "status", "details", "priority", "engine", "progress", "remote_path"]
             await self.print(tabulate(table, headers, tablefmt="grid"))
+        elif args.type == "upload":
+            tasks = await self.task_manager.QueryTasks(UploadTask.TAG, filter_status)
+            table = [[task.id, task.status.value, task.upload_status.value, task.info, task.local_path] for task in tasks if isinstance(task, UploadTask)]
+            headers = ["id", "status", "details", "progress", "local_path"]
+            await self.print(tabulate(table, headers, tablefmt="grid"))
+
+    prioritize_parser = cmd2.Cmd2ArgumentParser()
+    prioritize_parser.add_argument("task_id", help="task id")
+    prioritize_parser.add_argument("-b", "--by", help="how many levels to raise, defaults to 1", type=int, default=1)
+    prioritize_parser.add_argument("-d", "--deadline", help="finish within this duration, e.g. 30m or 2h, used by the deadline policy", type=ParseDuration)
+    @cmd2.with_argparser(prioritize_parser)
+    @RunSync
+    async def do_prioritize(self, args):
+        """
+        Raise the priority of a task, and of its files for a torrent task
+        """
+        deadline = time.time() + args.deadline if args.deadline is not None else None
+        priority = await self.task_manager.ChangeTaskPriority(args.task_id, args.by, deadline)
+        await self.print(f"Task {args.task_id} priority {priority}")
+
+    deprioritize_parser = cmd2.Cmd2ArgumentParser()
+    deprioritize_parser.add_argument("task_id", help="task id")
+    deprioritize_parser.add_argument("-b", "--by", help="how many levels to lower, defaults to 1", type=int, default=1)
+    @cmd2.with_argparser(deprioritize_parser)
+    @RunSync
+    async def do_deprioritize(self, args):
+        """
+        Lower the priority of a task, and of its files for a torrent task
+        """
+        priority = await self.task_manager.ChangeTaskPriority(args.task_id, -args.by)
+        await self.print(f"Task {args.task_id} priority {priority}")
+
+    policy_parser = cmd2.Cmd2ArgumentParser()
+    policy_parser.add_argument("policy", help="fair: round robin between torrents; smallest: as fair, smallest files of each torrent first; deadline: earliest deadline first, then fair", choices=SCHEDULE_POLICIES)
+    @cmd2.with_argparser(policy_parser)
+    @RunSync
+    async def do_policy(self, args):
+        """
+        Choose how queued tasks of the same priority are ordered
+        """
+        self.task_manager.SetSchedulePolicy(args.policy)
+
+    @RunSync
+    async def do_budget(self, args):
+        """
+        Show the current download budget and observed throughput
+        """
+        budget = self.task_manager.budget
+        limits = budget.Limits()
+        table = [
+            ["speed limit", f"{limits.speed} B/s" if limits.speed > 0 else "unlimited"],
+            ["connections", limits.connections],
+            ["downloads", f"{budget.download_limit}/{limits.connections}"],
+            ["throughput", f"{int(self.task_manager.throughput)} B/s"],
+        ]
+        await self.print(tabulate(table, tablefmt="grid"))
 
     taskid_parser = cmd2.Cmd2ArgumentParser()
     taskid_parser.add_argument("task_id", help="task id")